@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, Response
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, Response, send_file
 import openai
 import os
 import sys
@@ -16,12 +16,12 @@ import ssl
 import certifi
 import urllib3
 import re
-import glob
 import uuid
-import zipfile
-import tempfile
+import threading
 from pathlib import Path
 from functools import lru_cache, wraps
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import Counter, deque
 from werkzeug.utils import secure_filename
 
 # 分析モジュールをインポート
@@ -32,8 +32,34 @@ from tools.analysis import (
     VOCABULARY_MAPPING,
     generate_insights,
     cluster_and_analyze_conversations,
-    get_text_embedding
+    get_text_embedding,
+    embed_texts,
+    extract_nouns_and_verbs,
+    find_science_terms,
+    SCIENCE_TERM_SETS
+)
+from tools.keyword_matcher import KeywordMatcher
+from tools.text_vectorizer import VECTORIZER_AVAILABLE, tfidf_matrix
+from storage.jsonl_segments import SegmentedLogStore
+from storage.gcs_events import GcsEventLog
+from storage.write_behind import WriteBehindQueue
+from storage.sqlite_store import SQLiteStore
+from storage.backends import LocalBackend, build_backend
+from storage.date_manifest import DateManifest
+from storage.log_cache import TieredLogCache
+from storage.student_index import StudentLogIndex, student_key
+from storage.student_history import (
+    new_history_doc,
+    is_current as is_current_history_doc,
+    invalidated_doc as invalidated_history_doc,
+    apply_summary,
+    apply_conversation,
+    render_history,
 )
+from storage.local_files import get_lock_for_path
+from storage.export_archive import ExportArtifacts, csv_chunks
+from storage.analytics_store import DailyAggregateStore
+from storage.insight_cache import InsightCache, insight_key
 
 # Optional analysis libraries (may not be available in all environments)
 try:
@@ -46,10 +72,7 @@ except ImportError as e:
     KMeans = None
     ANALYSIS_LIBS_AVAILABLE = False
 
-import threading
-import tempfile as _tempfile
-import fcntl as _fcntl
-import errno as _errno
+import atexit
 import redis as _redis
 import rq as _rq
 from rq.job import Job as _RQJob
@@ -59,6 +82,14 @@ from rq.job import Job as _RQJob
 LEARNING_PROGRESS_FILE = os.environ.get('LEARNING_PROGRESS_FILE', 'learning_progress.json')
 PROMPTS_DIR = Path('prompts')
 
+# 学習ログのローカル保存形式
+# 'json'  : 従来の日次JSON配列（logs/learning_log_YYYYMMDD.json を毎回全体書き換え）
+# 'jsonl' : 追記専用セグメント（logs/learning_log_YYYYMMDD/seg_*.jsonl に1行ずつ追記）
+# 読み込み時はどちらの形式も常に参照するため、途中で切り替えてもログは失われない
+LOG_STORAGE_FORMAT = os.environ.get('LOG_STORAGE_FORMAT', 'json').lower()
+LOG_SEGMENT_MAX_BYTES = int(os.environ.get('LOG_SEGMENT_MAX_BYTES', str(4 * 1024 * 1024)))
+learning_log_segments = SegmentedLogStore('logs', 'learning_log_', max_segment_bytes=LOG_SEGMENT_MAX_BYTES)
+
 # ストレージ設定：ローカルJSON（デフォルト）またはGCS（本番環境）
 # 開発環境ではローカルJSONを優先し、本番環境でGCSを有効化
 # 本番では FLASK_ENV=production のほか Cloud Run の環境変数 (K_SERVICE) や
@@ -71,6 +102,25 @@ USE_GCS = (
 
 bucket = None
 
+# GCS クライアントの HTTP 接続プールの大きさ（複数日のログを並列に読み込むため既定の 10 より大きくする）
+GCS_HTTP_POOL_SIZE = int(os.getenv('GCS_HTTP_POOL_SIZE', '32'))
+
+def _build_storage_client(storage, credentials, project):
+    """接続プールを拡張した HTTP セッションで GCS クライアントを作成"""
+    try:
+        import google.auth.credentials
+        from google.auth.transport.requests import AuthorizedSession
+        from requests.adapters import HTTPAdapter
+
+        scoped = google.auth.credentials.with_scopes_if_required(credentials, storage.Client.SCOPE)
+        http = AuthorizedSession(scoped)
+        adapter = HTTPAdapter(pool_connections=GCS_HTTP_POOL_SIZE, pool_maxsize=GCS_HTTP_POOL_SIZE)
+        http.mount('https://', adapter)
+        return storage.Client(credentials=credentials, project=project, _http=http)
+    except Exception as e:
+        print(f"[INIT] GCS HTTP pool tuning failed ({type(e).__name__}: {e}), using default client")
+        return storage.Client(credentials=credentials, project=project)
+
 if USE_GCS:
     try:
         from google.cloud import storage
@@ -92,7 +142,7 @@ if USE_GCS:
             # 認証成功 = GCS 接続準備完了と見なす
             # Note: Cloud Resource Manager API が無効なため、バケットメタデータテストはスキップ
             # 実際の読み書きは ADC を使って gsutil 互換の JSON API で実行
-            storage_client = storage.Client(credentials=credentials, project=gcp_project)
+            storage_client = _build_storage_client(storage, credentials, gcp_project)
             bucket = storage_client.bucket(bucket_name)
             
             print(f"[INIT] GCS bucket '{bucket_name}' configured for use (project: {gcp_project})")
@@ -112,6 +162,19 @@ if USE_GCS:
 else:
     print(f"[INIT] Local storage mode (USE_GCS={USE_GCS})")
 
+# GCS への学習ログ・エラーログの書き込み方式
+# 'blob'   : 日次JSONをダウンロード→追記→アップロード（従来）
+# 'events' : 1イベント1オブジェクトでアップロードし、バックグラウンドで
+#            GCS compose により日次ファイル（*.jsonl）へ集約する
+GCS_LOG_WRITE_MODE = os.getenv('GCS_LOG_WRITE_MODE', 'blob').lower()
+GCS_COMPACT_INTERVAL_SEC = float(os.getenv('GCS_COMPACT_INTERVAL_SEC', '60'))
+learning_log_events = None
+error_log_events = None
+if USE_GCS and bucket and GCS_LOG_WRITE_MODE == 'events':
+    learning_log_events = GcsEventLog(bucket, 'events/learning_log/', lambda d: f"logs/learning_log_{d}.jsonl")
+    error_log_events = GcsEventLog(bucket, 'events/error_log/', lambda d: f"error_logs/error_log_{d}.jsonl")
+    print(f"[INIT] GCS log write mode: events (compact every {GCS_COMPACT_INTERVAL_SEC:.0f}s)")
+
 # Firestore optional runtime storage
 USE_FIRESTORE = os.getenv('USE_FIRESTORE', '0').lower() in ('1', 'true', 'yes')
 FIRESTORE_DATABASE = os.getenv('FIRESTORE_DATABASE')  # e.g. 'rika' for non-default DB
@@ -146,105 +209,6 @@ def now_jst_isoformat():
     """日本時間の現在時刻を ISO フォーマットで返す"""
     return now_jst().isoformat()
 
-# File lock and atomic write utilities to avoid concurrent write corruption.
-# Uses fcntl.flock on Unix-like systems. Also provides an in-process
-# threading.Lock fallback for environments without fcntl.
-_file_locks = {}
-_file_locks_lock = threading.Lock()
-
-
-def _get_lock_for_path(path):
-    """Return a threading.Lock object for the given path (process-local).
-    This is used as a fallback for platforms without fcntl, and to
-    serialize atomic replace operations within the same process.
-    """
-    with _file_locks_lock:
-        lock = _file_locks.get(path)
-        if lock is None:
-            lock = threading.Lock()
-            _file_locks[path] = lock
-        return lock
-
-
-def _atomic_write_json(path, data):
-    """Atomically write JSON-serializable `data` to `path`.
-
-    Implementation details:
-    - Write to a temporary file in the same directory
-    - fsync the file and directory to ensure durability
-    - os.replace to atomically move into place
-    - Use an in-process lock to avoid races within the same process
-      and also use POSIX fcntl locks when available to coordinate
-      between processes on the same host.
-    """
-    import json
-    import os
-
-    dirpath = os.path.dirname(os.path.abspath(path)) or '.'
-    basename = os.path.basename(path)
-    tmp = None
-    lock = _get_lock_for_path(path)
-    with lock:
-        # create temp file in same directory
-        fd, tmp = _tempfile.mkstemp(prefix=basename, dir=dirpath)
-        try:
-            with os.fdopen(fd, 'w', encoding='utf-8') as f:
-                # If fcntl available, acquire exclusive lock on temp file
-                try:
-                    _fcntl.flock(f.fileno(), _fcntl.LOCK_EX)
-                except Exception:
-                    pass
-                json.dump(data, f, ensure_ascii=False, indent=2)
-                f.flush()
-                try:
-                    os.fsync(f.fileno())
-                except Exception:
-                    pass
-
-            # ensure directory entry is flushed
-            try:
-                dirfd = os.open(dirpath, os.O_DIRECTORY)
-                try:
-                    os.fsync(dirfd)
-                finally:
-                    os.close(dirfd)
-            except Exception:
-                pass
-
-            # atomic replace
-            os.replace(tmp, path)
-            tmp = None
-        finally:
-            if tmp and os.path.exists(tmp):
-                try:
-                    os.remove(tmp)
-                except Exception:
-                    pass
-
-
-def _read_json_file(path):
-    """Read JSON from path safely; returns parsed JSON or None if file missing/invalid."""
-    import json
-    import os
-
-    if not os.path.exists(path):
-        return None
-
-    lock = _get_lock_for_path(path)
-    with lock:
-        try:
-            with open(path, 'r', encoding='utf-8') as f:
-                try:
-                    # Try to acquire shared lock where available
-                    _fcntl.flock(f.fileno(), _fcntl.LOCK_SH)
-                except Exception:
-                    pass
-                data = json.load(f)
-                return data
-        except Exception:
-            return None
-
-
 # 開発用デバッグエンドポイントは削除済み
 
 def allowed_file(filename):
@@ -360,9 +324,86 @@ def require_teacher_auth(f):
 # デフォルトはローカルファイルだが、コンテナ環境ではボリュームにマウントした
 # パスを環境変数 `SESSION_STORAGE_FILE` で指定して永続化できる。
 SESSION_STORAGE_FILE = os.environ.get('SESSION_STORAGE_FILE', 'session_storage.json')
+SUMMARY_STORAGE_FILE = 'summary_storage.json'
+
+# ローカル保存エンジン
+# 'json'   : 従来の単一JSONファイル（更新のたびに全体を読み直して書き換え）
+# 'sqlite' : WALモードのSQLite（セッション・サマリー・進捗をキー単位で upsert）
+# sqlite を初めて有効にしたときは既存のJSONファイルを自動で取り込む
+LOCAL_STORAGE_ENGINE = os.environ.get('LOCAL_STORAGE_ENGINE', 'json').lower()
+SQLITE_DB_FILE = os.environ.get('SQLITE_DB_FILE', 'science_buddy.db')
+local_db = None
+if LOCAL_STORAGE_ENGINE == 'sqlite':
+    try:
+        local_db = SQLiteStore(SQLITE_DB_FILE)
+        imported = local_db.import_legacy_json(SESSION_STORAGE_FILE, SUMMARY_STORAGE_FILE, LEARNING_PROGRESS_FILE)
+        print(f"[INIT] SQLite storage engine at {SQLITE_DB_FILE} (imported: {imported})")
+    except Exception as e:
+        print(f"[INIT] SQLite storage init failed: {e}, using JSON files")
+        local_db = None
+
+# ストレージバックエンド（起動時に一度だけ選択）
+# 'auto'      : Firestore / GCS が有効ならそれを優先し、ローカルをフォールバックにする（デフォルト）
+# 'local'     : ローカルファイル（JSON / SQLite / JSONL セグメント）のみ
+# 'gcs'       : GCS → ローカル
+# 'firestore' : Firestore → GCS → ローカル
+# 'memory'    : プロセス内メモリのみ（ベンチマーク・動作確認用、再起動で消える）
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'auto').lower()
+# 学習ログの日付一覧は GCS 上の小さなマニフェスト（logs/_log_dates.json）から読む
+# （バケットの一覧取得を毎リクエスト行わない）。読み込み結果はプロセス内で TTL 秒キャッシュ
+LOG_DATE_MANIFEST_TTL_SEC = float(os.environ.get('LOG_DATE_MANIFEST_TTL_SEC', '30'))
+log_date_manifest = DateManifest(bucket, ttl=LOG_DATE_MANIFEST_TTL_SEC) if USE_GCS and bucket else None
+# GCS から読んだ過去日の学習ログのキャッシュ（メモリ LRU + ディスク）
+# 日付と GCS の世代番号をキーにし、当日と LOG_CACHE_MUTABLE_DAYS 日前までだけ再検証する
+LOG_CACHE_ENABLED = os.getenv('LOG_CACHE_ENABLED', '1').lower() in ('1', 'true', 'yes')
+LOG_CACHE_MEMORY_DAYS = int(os.getenv('LOG_CACHE_MEMORY_DAYS', '32'))
+LOG_CACHE_DIR = os.getenv('LOG_CACHE_DIR', 'log_cache')
+LOG_CACHE_DISK_MAX_MB = int(os.getenv('LOG_CACHE_DISK_MAX_MB', '512'))
+LOG_CACHE_MUTABLE_DAYS = int(os.getenv('LOG_CACHE_MUTABLE_DAYS', '1'))
+learning_log_cache = None
+if LOG_CACHE_ENABLED and USE_GCS and bucket:
+    learning_log_cache = TieredLogCache(
+        memory_items=LOG_CACHE_MEMORY_DAYS,
+        disk_dir=LOG_CACHE_DIR or None,
+        disk_max_bytes=LOG_CACHE_DISK_MAX_MB * 1024 * 1024,
+    )
+# 学習者別の履歴ドキュメント（JSON エンジン時の保存先）
+STUDENT_HISTORY_DIR = os.getenv('STUDENT_HISTORY_DIR', 'student_history')
+local_backend = LocalBackend(
+    log_dir='logs',
+    session_file=SESSION_STORAGE_FILE,
+    summary_file=SUMMARY_STORAGE_FILE,
+    progress_file=LEARNING_PROGRESS_FILE,
+    db=local_db,
+    log_format=LOG_STORAGE_FORMAT,
+    segments=learning_log_segments,
+    history_dir=STUDENT_HISTORY_DIR,
+)
+storage_backend = build_backend(
+    STORAGE_BACKEND,
+    local_backend,
+    bucket=bucket if USE_GCS else None,
+    firestore_client=firestore_client if USE_FIRESTORE else None,
+    learning_events=learning_log_events,
+    error_events=error_log_events,
+    compact_interval=GCS_COMPACT_INTERVAL_SEC,
+    date_manifest=log_date_manifest,
+    log_cache=learning_log_cache,
+    mutable_days=LOG_CACHE_MUTABLE_DAYS,
+)
+print(f"[INIT] Storage backend: {storage_backend.describe()}")
+
+# 学習者別ログインデックス（(組, 出席番号) → ログのある日付・レコード位置）
+# 削除しても次回以降の読み込み時、または tools/rebuild_student_index.py で作り直せる
+STUDENT_LOG_INDEX_FILE = os.environ.get('STUDENT_LOG_INDEX_FILE', 'student_log_index.db')
+try:
+    student_log_index = StudentLogIndex(STUDENT_LOG_INDEX_FILE)
+except Exception as e:
+    print(f"[INIT] Student log index disabled: {e}")
+    student_log_index = None
 
 def save_session_to_db(student_id, unit, stage, conversation_data):
-    """セッションデータをデータベースに保存（GCS優先、ローカルはフォールバック）"""
+    """セッションデータを保存（ストレージバックエンド経由）"""
     session_entry = {
         'timestamp': now_jst_isoformat(),
         'student_id': student_id,
@@ -370,94 +411,17 @@ def save_session_to_db(student_id, unit, stage, conversation_data):
         'stage': stage,  # 'prediction' or 'reflection'
         'conversation': conversation_data
     }
-    # Firestore 優先（環境変数で有効化されている場合）
-    if USE_FIRESTORE and firestore_client:
-        try:
-            key = f"{student_id}_{unit}_{stage}"
-            firestore_client.collection('sb_session_storage').document(key).set(session_entry)
-            print(f"[SESSION_SAVE] Firestore - {key}")
-            return
-        except Exception as e:
-            print(f"[SESSION_SAVE] Firestore failed: {e}, falling back to next storage")
-
-    # 次に GCS を試行
-    if USE_GCS and bucket:
-        try:
-            _save_session_gcs(session_entry)
-            print(f"[SESSION_SAVE] GCS - {student_id}_{unit}_{stage}")
-            return  # GCS保存成功したらローカル保存は不要
-        except Exception as e:
-            print(f"[SESSION_SAVE] GCS failed: {e}, falling back to local")
-
-    # 開発環境または全失敗時: ローカル保存
-    _save_session_local(session_entry)
-
-def _save_session_local(session_entry):
-    """セッションをローカルファイルに保存"""
-    try:
-        sessions = _read_json_file(SESSION_STORAGE_FILE) or {}
-        student_id = session_entry['student_id']
-        unit = session_entry['unit']
-        stage = session_entry['stage']
-        key = f"{student_id}_{unit}_{stage}"
-        sessions[key] = session_entry
-        _atomic_write_json(SESSION_STORAGE_FILE, sessions)
-        print(f"[SESSION_SAVE] Local - {key}")
-    except Exception as e:
-        print(f"[SESSION_SAVE] Local Error: {e}")
-
-def _save_session_gcs(session_entry):
-    """セッションをGCSに保存"""
-    try:
-        from google.cloud import storage
-        student_id = session_entry['student_id']
-        unit = session_entry['unit']
-        stage = session_entry['stage']
-        key = f"{student_id}_{unit}_{stage}"
-        
-        # GCSのパス: sessions/{student_id}/{unit}/{stage}.json
-        gcs_path = f"sessions/{student_id}/{unit}/{stage}.json"
-        blob = bucket.blob(gcs_path)
-        blob.upload_from_string(
-            json.dumps(session_entry, ensure_ascii=False, indent=2),
-            content_type='application/json'
-        )
-        print(f"[SESSION_SAVE] GCS - {gcs_path}")
-    except Exception as e:
-        print(f"[SESSION_SAVE] GCS Error: {e}")
+    storage_backend.save_session(session_entry)
+    # 履歴ドキュメントがまだ無い学習者は、最初のサマリー保存時にまとめて作る
+    _update_student_history(
+        student_id,
+        lambda doc: apply_conversation(doc, unit, stage, conversation_data),
+        build_missing=False,
+    )
 
 def load_session_from_db(student_id, unit, stage):
-    """セッションデータをデータベースから復元（GCS優先）"""
-    # 本番環境: GCS優先
-    if USE_GCS and bucket:
-        try:
-            conversation = _load_session_gcs(student_id, unit, stage)
-            if conversation is not None:
-                print(f"[SESSION_LOAD] GCS - {student_id}_{unit}_{stage}")
-                return conversation
-        except Exception as e:
-            print(f"[SESSION_LOAD] GCS failed: {e}, trying local")
-    
-    # 開発環境またはGCS失敗時: ローカルから読み込み
-    conversation = _load_session_local(student_id, unit, stage)
-    if conversation:
-        print(f"[SESSION_LOAD] Local - {student_id}_{unit}_{stage}")
-    return conversation
-
-def _load_session_local(student_id, unit, stage):
-    """セッションをローカルファイルから復元"""
-    try:
-        sessions = _read_json_file(SESSION_STORAGE_FILE)
-        if not sessions:
-            return []
-        key = f"{student_id}_{unit}_{stage}"
-        if key in sessions:
-            print(f"[SESSION_LOAD] Local - {key}")
-            return sessions[key].get('conversation', [])
-    except Exception as e:
-        print(f"[SESSION_LOAD] Local Error: {e}")
-    
-    return []
+    """セッションデータを復元（ストレージバックエンド経由）"""
+    return storage_backend.load_session(student_id, unit, stage) or []
 
 
 # -----------------------------
@@ -476,6 +440,188 @@ except Exception as e:
     rq_queue = None
 
 
+# -----------------------------
+# Write-behind persistence queue
+# -----------------------------
+# ASYNC_PERSISTENCE=1 のとき、/chat・/reflect_chat のセッション保存と学習ログ保存を
+# バックグラウンドスレッドで実行し、児童への応答を OpenAI の応答時間だけで返す。
+# キューが満杯のときは呼び出し元で同期実行する（書き込みは捨てない）。
+ASYNC_PERSISTENCE = os.getenv('ASYNC_PERSISTENCE', '0').lower() in ('1', 'true', 'yes')
+persistence_queue = None
+if ASYNC_PERSISTENCE:
+    persistence_queue = WriteBehindQueue(
+        max_items=int(os.getenv('PERSISTENCE_QUEUE_MAX', '1000')),
+        batch_size=int(os.getenv('PERSISTENCE_BATCH_SIZE', '20')),
+        workers=int(os.getenv('PERSISTENCE_WORKERS', '2')),
+        max_retries=int(os.getenv('PERSISTENCE_MAX_RETRIES', '3')),
+        name='persist',
+    )
+    # プロセス終了時（gunicorn の graceful shutdown を含む）に未書き込み分を書き出す
+    atexit.register(persistence_queue.shutdown, float(os.getenv('PERSISTENCE_SHUTDOWN_TIMEOUT', '10')))
+    print(f"[INIT] Write-behind persistence enabled (max={persistence_queue.max_items})")
+
+
+def persist_in_background(fn, *args, coalesce_key=None, **kwargs):
+    """永続化処理を write-behind キューに積む（無効時はその場で同期実行）
+
+    Args:
+        fn: 保存関数（save_session_to_db / save_learning_log など）
+        coalesce_key: 同じキーの未実行タスクは最新のものに置き換える
+    """
+    if persistence_queue is None:
+        fn(*args, **kwargs)
+        return
+    persistence_queue.submit(fn, *args, coalesce_key=coalesce_key, **kwargs)
+
+
+# -----------------------------
+# 似た発言の検索インデックス
+# -----------------------------
+# 予想・考察の対話での児童の発言を埋め込み、近傍探索インデックス（IVF・int8量子化）に追加する。
+# 埋め込みは API 呼び出しを伴うので、学習ログの保存とは別の専用キューでまとめて行う。
+# 削除しても tools/rebuild_similarity_index.py で作り直せる
+SIMILARITY_INDEX_DIR = os.getenv('SIMILARITY_INDEX_DIR', 'similarity_index')
+SIMILARITY_BATCH_SIZE = int(os.getenv('SIMILARITY_BATCH_SIZE', '64'))
+SIMILARITY_NPROBE = int(os.getenv('SIMILARITY_NPROBE', '8'))
+SIMILARITY_MAX_PENDING = max(1, int(os.getenv('SIMILARITY_MAX_PENDING', '10000')))
+similarity_index = None
+similarity_queue = None
+# 追加待ちの発言と、あふれて捨てた発言の日付（次のフラッシュでバックフィル対象に記録する）
+_similarity_pending = deque()
+_similarity_dropped_dates = set()
+_similarity_lock = threading.Lock()
+try:
+    from storage.similarity_index import SimilarityIndex, message_key
+    similarity_index = SimilarityIndex(SIMILARITY_INDEX_DIR, nprobe=SIMILARITY_NPROBE)
+    similarity_queue = WriteBehindQueue(max_items=100, batch_size=1, workers=1, max_retries=0, name='similarity')
+    atexit.register(similarity_queue.shutdown, float(os.getenv('PERSISTENCE_SHUTDOWN_TIMEOUT', '10')))
+except Exception as e:
+    print(f"[INIT] Similarity index disabled: {e}")
+    similarity_index = None
+
+
+def _similarity_entry(date, log):
+    """学習ログ1件を似た発言インデックスの項目にする（予想・考察の児童の発言以外は None）"""
+    stage = _ANALYSIS_STAGES.get(log.get('log_type'))
+    data = log.get('data') or {}
+    message = (data.get('user_message') or '').strip() if isinstance(data, dict) else ''
+    if not stage or not message:
+        return None
+    return {
+        'key': message_key(log.get('timestamp', ''), log.get('student_number'), stage, message),
+        'unit': log.get('unit'),
+        'stage': stage,
+        'date': date,
+        'timestamp': log.get('timestamp', ''),
+        'student_number': str(log.get('student_number')),
+        'class_num': log.get('class_num'),
+        'seat_num': log.get('seat_num'),
+        'class_display': log.get('class_display'),
+        'message': message,
+    }
+
+
+def _embed_similarity_entries(entries):
+    """発言を埋め込み、(埋め込み, 埋め込めなかった件数) を返す
+
+    埋め込めなかった発言の日付はバックフィル対象として記録する
+    """
+    embeddings = embed_texts([entry['message'] for entry in entries])
+    missing = [entry['date'] for entry, embedding in zip(entries, embeddings) if embedding is None]
+    if missing:
+        print(f"[SIMILAR] {len(missing)} message(s) not embedded; marked {sorted(set(missing))} for backfill")
+        similarity_index.mark_backfill(missing)
+    return embeddings, len(missing)
+
+
+def index_similar_messages(entries):
+    """発言を埋め込んでインデックスに追加し、追加した件数を返す（埋め込めなかった発言は追加しない）"""
+    if not entries:
+        return 0
+    embeddings, _ = _embed_similarity_entries(entries)
+    return similarity_index.add(entries, embeddings)
+
+
+def backfill_similarity_index():
+    """バックフィル対象の日付のログを入れ直し、入れ直した日付の数を返す（追加済みの発言は飛ばす）"""
+    done = 0
+    for date, marks in sorted(similarity_index.backfill_marks().items()):
+        entries = [entry for entry in (_similarity_entry(date, log) for log in load_learning_logs(date)) if entry]
+        if not entries:
+            # 発言があったはずの日が読めない（読み込み失敗）: 印は残して次の機会に回す
+            continue
+        embeddings, missing = _embed_similarity_entries(entries)
+        added = similarity_index.add(entries, embeddings)
+        if missing:
+            # まだ埋め込めない（印は付け直してある）: 残りの日付は次の機会に回す
+            break
+        similarity_index.clear_backfill(date, marks)
+        done += 1
+        print(f"[SIMILAR] backfilled {date}: {added}/{len(entries)} messages added")
+    return done
+
+
+def _flush_similarity_pending():
+    """追加待ちの発言をまとめてインデックスに追加する（similarity_queue のワーカーで実行）
+
+    追加に失敗したバッチとあふれて捨てた発言は日付ごとにバックフィル対象として記録し、
+    すべて追加できたときに記録済みの日付をログから入れ直す
+    """
+    failed = False
+    while True:
+        with _similarity_lock:
+            batch = [_similarity_pending.popleft()
+                     for _ in range(min(SIMILARITY_BATCH_SIZE, len(_similarity_pending)))]
+            missed = set(_similarity_dropped_dates)
+            _similarity_dropped_dates.clear()
+        if batch:
+            try:
+                embeddings, missing = _embed_similarity_entries(batch)
+                similarity_index.add(batch, embeddings)
+                failed = failed or bool(missing)
+            except Exception as e:
+                failed = True
+                missed.update(entry['date'] for entry in batch)
+                print(f"[SIMILAR] index update failed for {len(batch)} message(s), marked for backfill: {e}")
+        if missed:
+            try:
+                similarity_index.mark_backfill(missed)
+            except Exception as e:
+                # 記録できなければ次のフラッシュでもう一度記録する
+                failed = True
+                with _similarity_lock:
+                    _similarity_dropped_dates.update(missed)
+                print(f"[SIMILAR] could not mark {sorted(missed)} for backfill: {e}")
+                break
+        if not batch:
+            break
+    if not failed:
+        try:
+            backfill_similarity_index()
+        except Exception as e:
+            print(f"[SIMILAR] backfill failed: {e}")
+
+
+def queue_similar_message(date, log):
+    """保存した学習ログの発言をインデックスへの追加待ちに積む（追加はバックグラウンドでまとめて行う）
+
+    追加待ちが SIMILARITY_MAX_PENDING 件を超えたら古い発言から捨て、その日付をバックフィル対象にする
+    """
+    if similarity_index is None:
+        return
+    entry = _similarity_entry(date, log)
+    if entry is None:
+        return
+    with _similarity_lock:
+        if len(_similarity_pending) >= SIMILARITY_MAX_PENDING:
+            dropped = _similarity_pending.popleft()
+            _similarity_dropped_dates.add(dropped['date'])
+            print(f"[SIMILAR] pending queue full ({SIMILARITY_MAX_PENDING}); "
+                  f"dropped a message from {dropped['date']}, marked for backfill")
+        _similarity_pending.append(entry)
+    similarity_queue.submit(_flush_similarity_pending, coalesce_key='similarity')
+
+
 def perform_summary_job(conversation, unit, student_id, class_number, student_number, stage='prediction', model_override='gpt-4o-mini'):
     """Background job function: given a conversation and metadata, call OpenAI,
     extract summary, save to storage (GCS or local), update progress and logs,
@@ -519,25 +665,6 @@ def perform_summary_job(conversation, unit, student_id, class_number, student_nu
         print(f"[JOB_SUMMARY] Error: {e}")
         raise
 
-def _load_session_gcs(student_id, unit, stage):
-    """セッションをGCSから復元"""
-    try:
-        from google.cloud import storage
-        
-        # GCSのパス: sessions/{student_id}/{unit}/{stage}.json
-        gcs_path = f"sessions/{student_id}/{unit}/{stage}.json"
-        blob = bucket.blob(gcs_path)
-        
-        if blob.exists():
-            content = blob.download_as_string().decode('utf-8')
-            data = json.loads(content)
-            print(f"[SESSION_LOAD] GCS - {gcs_path}")
-            return data.get('conversation', [])
-    except Exception as e:
-        print(f"[SESSION_LOAD] GCS Error: {e}")
-    
-    return None
-
 # OpenAI APIの設定
 api_key = os.getenv('OPENAI_API_KEY')
 # デフォルトモデル（環境変数で変更可能）
@@ -587,97 +714,85 @@ def remove_markdown_formatting(text):
 
 # 学習進行状況管理機能
 def load_learning_progress():
-    """学習進行状況を読み込み（ローカル JSON のみ）"""
-    # ローカルファイルから読み込み
-    data = _read_json_file(LEARNING_PROGRESS_FILE)
-    if not data:
-        return {}
-    return data
+    """学習進行状況を読み込み（ストレージバックエンド経由）"""
+    return storage_backend.load_progress() or {}
 
 def save_learning_progress(progress_data):
-    """学習進行状況を保存（ローカル JSON のみ）"""
-    # まず Firestore に保存（環境変数で有効化されていれば）
-    if USE_FIRESTORE and firestore_client:
-        try:
-            # progress_data は {student_id: {unit: {...}}}
-            batch = firestore_client.batch()
-            count = 0
-            for student_id, student_obj in progress_data.items():
-                doc_ref = firestore_client.collection('sb_learning_progress').document(str(student_id))
-                batch.set(doc_ref, student_obj)
-                count += 1
-                if count >= 500:
-                    batch.commit()
-                    batch = firestore_client.batch()
-                    count = 0
-            if count > 0:
-                batch.commit()
-            print(f"[PROGRESS_SAVE] Firestore: imported {len(progress_data)} student progress entries")
-            return
-        except Exception as e:
-            print(f"[PROGRESS_SAVE] Firestore failed: {e}, falling back to local file")
+    """学習進行状況を保存（ストレージバックエンド経由）"""
+    storage_backend.save_progress(progress_data)
+
+def _new_unit_progress():
+    """単元の進行状況の初期値"""
+    return {
+        "current_stage": "prediction",
+        "last_access": now_jst_isoformat(),
+        "stage_progress": {
+            "prediction": {
+                "started": False,
+                "conversation_count": 0,
+                "summary_created": False,
+                "last_message": ""
+            },
+            "experiment": {
+                "started": False,
+                "completed": False
+            },
+            "reflection": {
+                "started": False,
+                "conversation_count": 0,
+                "summary_created": False
+            }
+        },
+        "conversation_history": [],
+        "reflection_conversation_history": []
+    }
 
-    # ローカルファイルに保存（フォールバック）
-    try:
-        _atomic_write_json(LEARNING_PROGRESS_FILE, progress_data)
-        print(f"[PROGRESS_SAVE] Local file saved successfully")
-    except Exception as e:
-        print(f"[PROGRESS_SAVE] Error: {e}")
+def load_student_progress_record(class_number, student_number):
+    """学習者1人分の進行状況 {unit: {...}} を読み込む（他の学習者のデータは読まない）
 
-def get_student_progress(class_number, student_number, unit):
-    """特定の学習者の単元進行状況を取得"""
+    研究室（5組）の旧ID `lab_{番号}` に保存された進行状況があれば、
+    新ID `5_{番号}` へ移行してから返す。
+
+    Returns:
+        (student_id, {unit: progress})
+    """
     normalized_class = normalize_class_value(class_number)
     class_number = normalized_class if normalized_class is not None else class_number
-    legacy_ids = []
-    if class_number == '5':
-        legacy_ids.append(f"lab_{student_number}")
     student_id = f"{class_number}_{student_number}"
-    progress_data = load_learning_progress()
-    for legacy_id in legacy_ids:
-        if legacy_id in progress_data and student_id not in progress_data:
-            progress_data[student_id] = progress_data.pop(legacy_id)
-            save_learning_progress(progress_data)
-            break
-    
-    if student_id not in progress_data:
-        progress_data[student_id] = {}
-    
-    if unit not in progress_data[student_id]:
-        progress_data[student_id][unit] = {
-            "current_stage": "prediction",
-            "last_access": now_jst_isoformat(),
-            "stage_progress": {
-                "prediction": {
-                    "started": False,
-                    "conversation_count": 0,
-                    "summary_created": False,
-                    "last_message": ""
-                },
-                "experiment": {
-                    "started": False,
-                    "completed": False
-                },
-                "reflection": {
-                    "started": False,
-                    "conversation_count": 0,
-                    "summary_created": False
-                }
-            },
-            "conversation_history": [],
-            "reflection_conversation_history": []
-        }
-    
-    return progress_data[student_id][unit]
+    record = storage_backend.load_student_progress(student_id)
+    if record is None and class_number == '5':
+        legacy_id = f"lab_{student_number}"
+        legacy_record = storage_backend.load_student_progress(legacy_id)
+        if legacy_record is not None:
+            storage_backend.save_student_progress(student_id, legacy_record)
+            storage_backend.delete_student_progress(legacy_id)
+            print(f"[PROGRESS] migrated {legacy_id} -> {student_id}")
+            record = legacy_record
+    return student_id, record or {}
+
+def get_student_progress(class_number, student_number, unit):
+    """特定の学習者の単元進行状況を取得"""
+    return get_student_progress_many(class_number, student_number, [unit])[unit]
+
+def get_student_progress_many(class_number, student_number, units):
+    """学習者の複数単元の進行状況をまとめて取得（読み込みは1回のみ）
+
+    Returns:
+        {unit: progress} - 未着手の単元は初期値
+    """
+    _, record = load_student_progress_record(class_number, student_number)
+    return {unit: record.get(unit) or _new_unit_progress() for unit in units}
 
 def update_student_progress(class_number, student_number, unit, prediction_summary_created=False, reflection_summary_created=False):
-    """学習者の進行状況を更新（フラグのみ保存）"""
-    normalized_class = normalize_class_value(class_number)
-    class_number = normalized_class if normalized_class is not None else class_number
-    progress_data = load_learning_progress()
-    student_id = f"{class_number}_{student_number}"
+    """学習者の進行状況を更新（フラグのみ保存）
+
+    この学習者のレコードだけを1回読み込み、内容が変わった場合のみ書き戻す。
+    """
+    student_id, record = load_student_progress_record(class_number, student_number)
     
     # 現在の進行状況を取得
-    current_progress = get_student_progress(class_number, student_number, unit)
+    previous = record.get(unit)
+    current_progress = json.loads(json.dumps(previous)) if previous else _new_unit_progress()
     
     # 予想・考察の完了フラグのみ更新
     if prediction_summary_created:
@@ -685,12 +800,10 @@ def update_student_progress(class_number, student_number, unit, prediction_summa
     if reflection_summary_created:
         current_progress["stage_progress"]["reflection"]["summary_created"] = True
     
-    # 進行状況を保存
-    if student_id not in progress_data:
-        progress_data[student_id] = {}
-    progress_data[student_id][unit] = current_progress
-    
-    save_learning_progress(progress_data)
+    # 変更があった場合のみ保存（ページ表示のたびに書き込まない）
+    if current_progress != previous:
+        record[unit] = current_progress
+        storage_backend.save_student_progress(student_id, record)
     return current_progress
 
 
@@ -776,6 +889,15 @@ def extract_message_from_json_response(response):
         return response
 
 
+# 代表的な日本語の経験/理由を示す語句（簡易）
+SUBSTANTIVE_KEYWORDS = [
+    'あった', 'あります', '見た', '見ました', '思う', '思います',
+    'なった', 'になった', 'だから', 'ため', 'ことが', '見', 'できた', 
+    '変わ', '気づ', '観察', '理由', '大きく', '小さく', '温', '冷',
+    'なる', 'ます', 'です', 'から', 'ので'
+]
+
+
 def has_substantive_content(text):
     """短い文字数判定ではなく、意味のある発言かを判定する軽量ヘルパー。
     
@@ -785,20 +907,11 @@ def has_substantive_content(text):
     - 空文字や意味のない1文字の羅列のみを除外
     """
     try:
-        import re
         if not text or len(text.strip()) == 0:
             return False
 
-        # 代表的な日本語の経験/理由を示す語句（簡易）
-        keywords = [
-            'あった', 'あります', '見た', '見ました', '思う', '思います',
-            'なった', 'になった', 'だから', 'ため', 'ことが', '見', 'できた', 
-            '変わ', '気づ', '観察', '理由', '大きく', '小さく', '温', '冷',
-            'なる', 'ます', 'です', 'から', 'ので'
-        ]
-        for k in keywords:
-            if k in text:
-                return True
+        if KEYWORD_MATCHER.contains(text, 'substantive'):
+            return True
 
         # 記号等をスペースに置換してトークン化
         cleaned = re.sub(r"[^\w\u3040-\u30ff\u4e00-\u9fff]", ' ', text)
@@ -1039,7 +1152,7 @@ def render_prompt_template(template: str, **placeholders):
 
 
 # 学習ログを保存する関数
-def save_learning_log(student_number, unit, log_type, data, class_number=None):
+def save_learning_log(student_number, unit, log_type, data, class_number=None, timestamp=None):
     """学習ログをGCSまたはローカルJSONに保存
     
     Args:
@@ -1048,6 +1161,8 @@ def save_learning_log(student_number, unit, log_type, data, class_number=None):
         log_type: ログタイプ
         data: ログデータ
         class_number: クラス番号 (例: "1", "2") - 省略時は student_number から自動解析
+        timestamp: 記録時刻（now_jst_isoformat() の形式）。省略時は現在時刻。
+            persist_in_background で遅れて保存するときは投入時の時刻を渡す
     """
     class_number = normalize_class_value(class_number) or class_number
     # parse_student_info を使って正しくパースする
@@ -1072,8 +1187,10 @@ def save_learning_log(student_number, unit, log_type, data, class_number=None):
             seat_num = None
             class_display = str(student_number)
     
+    if timestamp is None:
+        timestamp = now_jst_isoformat()
     log_entry = {
-        'timestamp': now_jst_isoformat(),
+        'timestamp': timestamp,
         'student_number': student_number,
         'class_num': class_num,
         'seat_num': seat_num,
@@ -1083,153 +1200,149 @@ def save_learning_log(student_number, unit, log_type, data, class_number=None):
         'data': data
     }
     
-    if USE_GCS and bucket:
-        # 本番環境: GCSにも保存する（ローカル保存は必ず実施）
+    # 日付も記録時刻から決める（キューで遅れて保存しても日をまたいでずれない）
+    log_date = datetime.fromisoformat(timestamp).astimezone().strftime('%Y%m%d')
+    locator = storage_backend.append_log(log_date, log_entry)
+    if student_log_index is not None:
         try:
-            log_date = datetime.now().strftime('%Y%m%d')
-            log_filename = f"logs/learning_log_{log_date}.json"
-            
-            print(f"[LOG_SAVE] GCS START - path: {log_filename}, class: {class_display}, unit: {unit}, type: {log_type}")
-            
-            blob = bucket.blob(log_filename)
-            logs = []
-            try:
-                content = blob.download_as_string()
-                logs = json.loads(content.decode('utf-8'))
-            except Exception:
-                logs = []
-            
-            logs.append(log_entry)
-            
-            blob.upload_from_string(
-                json.dumps(logs, ensure_ascii=False, indent=2).encode('utf-8'),
-                content_type='application/json'
-            )
-            print(f"[LOG_SAVE] GCS SUCCESS - saved to GCS (local copy will also be written)")
+            student_log_index.add(log_date, log_entry, locator)
         except Exception as e:
-            print(f"[LOG_SAVE] GCS ERROR - {type(e).__name__}: {str(e)}, continue with local save")
-            import traceback
-            traceback.print_exc()
-    
-    # ローカルファイルにも必ず保存
-    log_filename = f"learning_log_{datetime.now().strftime('%Y%m%d')}.json"
-    os.makedirs('logs', exist_ok=True)
-    log_file = f"logs/{log_filename}"
-    
-    logs = []
-    if os.path.exists(log_file):
-        try:
-            with open(log_file, 'r', encoding='utf-8') as f:
-                logs = json.load(f)
-        except (json.JSONDecodeError, FileNotFoundError):
-            logs = []
-    
-    logs.append(log_entry)
-    
-    with open(log_file, 'w', encoding='utf-8') as f:
-        json.dump(logs, f, ensure_ascii=False, indent=2)
+            print(f"[INDEX] posting update failed: {e}")
+    queue_similar_message(log_date, log_entry)
+
+# 複数日の学習ログを読み込むスレッドプール（GCS の HTTP 接続プールと同程度に制限）
+LOG_LOAD_WORKERS = int(os.getenv('LOG_LOAD_WORKERS', '8'))
+_log_load_executor = ThreadPoolExecutor(max_workers=max(1, LOG_LOAD_WORKERS), thread_name_prefix='log-load')
+
+# エクスポート（CSV / zip）の成果物の作成先。EXPORT_ARTIFACT_MAX_AGE_SEC 秒より古いものは削除する。
+# GCS 使用時は EXPORT_GCS_PREFIX 以下にも置き、RQ ワーカーと Web で共有する
+EXPORT_DIR = os.getenv('EXPORT_DIR', 'exports')
+EXPORT_GCS_PREFIX = os.getenv('EXPORT_GCS_PREFIX', 'exports/')
+EXPORT_JOB_TIMEOUT_SEC = int(os.getenv('EXPORT_JOB_TIMEOUT_SEC', '3600'))
+EXPORT_ARTIFACT_MAX_AGE_SEC = int(os.getenv('EXPORT_ARTIFACT_MAX_AGE_SEC', str(24 * 3600)))
+export_artifacts = ExportArtifacts(EXPORT_DIR, max_age=EXPORT_ARTIFACT_MAX_AGE_SEC)
 
 # 学習ログを読み込む関数
 def load_learning_logs(date=None):
-    """指定日の学習ログを読み込み（GCS優先）"""
+    """指定日の学習ログを読み込み（ストレージバックエンド経由）"""
     if date is None:
         date = datetime.now().strftime('%Y%m%d')
-    
-    # 本番環境: GCS優先
-    if USE_GCS and bucket:
-        # GCS から読み込み
+    return storage_backend.load_logs(date) or []
+
+def load_learning_logs_range(dates, on_error=()):
+    """複数日の学習ログを並列に読み込み、(date, logs) を dates の順に返すジェネレータ
+
+    先読みする日数は LOG_LOAD_WORKERS 日分までに制限するので、呼び出し側が
+    1日ずつ処理して捨てればメモリ使用量は期間の長さによらず一定になる。
+    読み込みに失敗した日は logs の代わりに on_error を返す（既定は空リスト。
+    ログの無い日と区別したいときは None などを渡す）。
+    """
+    pending = deque()
+    dates = iter(dates)
+    while True:
+        while len(pending) < LOG_LOAD_WORKERS:
+            d = next(dates, None)
+            if d is None:
+                break
+            pending.append((d, _log_load_executor.submit(load_learning_logs, d)))
+        if not pending:
+            return
+        d, future = pending.popleft()
         try:
-            log_filename = f"logs/learning_log_{date}.json"
-            print(f"[LOG_LOAD] GCS START - loading logs from: {log_filename}")
-            
-            blob = bucket.blob(log_filename)
+            yield d, future.result()
+        except Exception as e:
+            print(f"[LOG_LOAD] Error loading logs for {d}: {type(e).__name__}: {e}")
+            yield d, list(on_error) if on_error is not None else None
+
+def _is_mutable_log_date(date):
+    """当日（と LOG_CACHE_MUTABLE_DAYS 日前まで）は他のプロセスからまだ書き込まれうる"""
+    return date >= (datetime.now() - timedelta(days=LOG_CACHE_MUTABLE_DAYS)).strftime('%Y%m%d')
+
+def index_log_day(date, logs=None):
+    """1日分の学習ログで学習者インデックスを作り直し、その日の全レコードを返す"""
+    if storage_backend is local_backend:
+        # ローカルの追記専用セグメントはレコード位置（segment:offset）まで記録する
+        pairs = list(local_backend.iter_logs_with_locators(date))
+    else:
+        pairs = [('', log) for log in (logs if logs is not None else load_learning_logs(date))]
+    postings = []
+    for locator, log in pairs:
+        key = student_key(log)
+        if key is not None:
+            postings.append((key[0], key[1], locator))
+    student_log_index.index_day(date, postings, len(pairs))
+    return [log for _, log in pairs]
+
+def rebuild_student_log_index():
+    """全日付の学習ログから学習者インデックスを作り直す（オフライン用）"""
+    student_log_index.clear()
+    total = 0
+    for date in sorted(get_available_log_dates()):
+        records = index_log_day(date)
+        total += len(records)
+        print(f"[INDEX] {date}: {len(records)} records")
+    return total
+
+def rebuild_similarity_index():
+    """全日付の学習ログから似た発言の検索インデックスを作り直す（オフライン用）"""
+    similarity_index.clear()
+    total = 0
+    for date, logs in load_learning_logs_range(sorted(get_available_log_dates())):
+        entries = [entry for entry in (_similarity_entry(date, log) for log in logs) if entry]
+        added = index_similar_messages(entries)
+        total += added
+        print(f"[SIMILAR] {date}: {added}/{len(entries)} messages")
+    return total
+
+def load_student_logs(class_num, seat_num, dates=None):
+    """1人の学習者のログだけを読み込む（学習者インデックスで対象の日・レコードに絞る）
+
+    Args:
+        class_num / seat_num: 組・出席番号
+        dates: 対象日付（省略時は全日付）。結果はこの日付順に並ぶ
+    """
+    if dates is None:
+        dates = get_available_log_dates()
+    target = (int(class_num), int(seat_num))
+
+    def _own(logs):
+        return [log for log in logs if student_key(log) == target]
+
+    if student_log_index is None:
+        return [log for _, logs in load_learning_logs_range(dates) for log in _own(logs)]
+
+    indexed = set(student_log_index.indexed_dates())
+    postings = student_log_index.lookup(*target)
+    by_date = {}
+    to_load = []
+    for d in dates:
+        if d in indexed and not _is_mutable_log_date(d):
+            locators = postings.get(d)
+            if not locators:
+                # この日にはこの学習者のログが無い
+                by_date[d] = []
+                continue
+            if storage_backend is local_backend and all(locators):
+                records = [local_backend.read_log_at(d, loc) for loc in locators]
+                if all(r is not None for r in records):
+                    by_date[d] = _own(records)
+                    continue
+        to_load.append(d)
+
+    for d, logs in load_learning_logs_range(to_load):
+        by_date[d] = _own(logs)
+        if d not in indexed and not _is_mutable_log_date(d) and logs:
             try:
-                content = blob.download_as_string()
-                logs = json.loads(content.decode('utf-8'))
-                # 正常化: ネストしたリストを再帰的にフラット化し、辞書のみを残す
-                def _flatten(items):
-                    for it in items:
-                        if isinstance(it, list):
-                            yield from _flatten(it)
-                        elif isinstance(it, dict):
-                            yield it
-
-                if isinstance(logs, list):
-                    logs = list(_flatten(logs))
-                log_count = len(logs)
-                print(f"[LOG_LOAD] GCS SUCCESS - loaded {log_count} logs from {date}")
-                return logs
+                index_log_day(d, logs)
             except Exception as e:
-                print(f"[LOG_LOAD] GCS file not found: {log_filename}")
-        except Exception as e:
-            print(f"[LOG_LOAD] GCS ERROR - {type(e).__name__}: {str(e)}")
-            import traceback
-            traceback.print_exc()
-    
-    # 開発環境またはGCS失敗時: ローカルファイルから読み込み
-    log_filename = f"learning_log_{date}.json"
-    log_file = f"logs/{log_filename}"
-    
-    if not os.path.exists(log_file):
-        return []
-    
-    try:
-        with open(log_file, 'r', encoding='utf-8') as f:
-            logs = json.load(f)
-            # 正常化: ネストしたリストを再帰的にフラット化
-            def _flatten(items):
-                for it in items:
-                    if isinstance(it, list):
-                        yield from _flatten(it)
-                    elif isinstance(it, dict):
-                        yield it
-
-            if isinstance(logs, list):
-                logs = list(_flatten(logs))
-            return logs
-    except (json.JSONDecodeError, FileNotFoundError):
-        return []
+                print(f"[INDEX] indexing {d} failed: {e}")
+
+    return [log for d in dates for log in by_date.get(d, [])]
 
 def get_available_log_dates():
-    """利用可能な全ログの日付リストを取得（GCS優先、メモリ効率重視）"""
-    dates = set()
-    
-    # GCSから取得（本番環境、メモリ効率的に）
-    if USE_GCS and bucket:
-        try:
-            print(f"[DATES] Checking GCS bucket for log files...")
-            # ページネーションを使用して段階的に処理（メモリ効率化）
-            page_iterator = bucket.list_blobs(prefix='logs/learning_log_', page_size=50)
-            blob_count = 0
-            for blob in page_iterator:
-                blob_count += 1
-                if blob_count > 1000:  # 最大 1000 ブロブまでに制限
-                    print(f"[DATES] Reached limit of 1000 blobs, stopping enumeration")
-                    break
-                
-                filename = os.path.basename(blob.name)
-                if filename.startswith('learning_log_') and filename.endswith('.json'):
-                    date_str = filename[13:-5]  # learning_log_YYYYMMDD.json
-                    if len(date_str) == 8 and date_str.isdigit():
-                        dates.add(date_str)
-            print(f"[DATES] Found {len(dates)} dates in GCS (scanned {blob_count} blobs)")
-        except Exception as e:
-            print(f"[DATES] GCS ERROR: {str(e)}, falling back to local")
-    
-    # ローカルファイルも確認（開発環境用、フォールバック）
-    if len(dates) == 0:
-        log_files = glob.glob("logs/learning_log_*.json")
-        for file in log_files:
-            filename = os.path.basename(file)
-            if filename.startswith('learning_log_') and filename.endswith('.json'):
-                date_str = filename[13:-5]
-                if len(date_str) == 8 and date_str.isdigit():
-                    dates.add(date_str)
-        print(f"[DATES] Fallback: Found {len(dates)} dates in local")
-    
-    dates_list = sorted(list(dates), reverse=True)  # 新しい順
+    """利用可能な全ログの日付リストを取得（新しい順）"""
+    dates_list = sorted(storage_backend.list_log_dates(), reverse=True)  # 新しい順
     print(f"[DATES] Total found {len(dates_list)} log dates: {dates_list[:5]}")
-    
     return dates_list
 
 # エラーログ管理機能
@@ -1265,103 +1378,17 @@ def save_error_log(student_number, class_number, error_message, error_type, stag
         'additional_info': additional_info or {}
     }
     
-    # GCSに保存
-    if USE_GCS and bucket:
-        try:
-            _save_error_log_gcs(error_entry)
-            print(f"[ERROR_LOG] GCS saved - {class_display}")
-        except Exception as e:
-            print(f"[ERROR_LOG] GCS save failed: {e}")
-    
-    # ローカルにも保存
-    try:
-        _save_error_log_local(error_entry)
-        print(f"[ERROR_LOG] Local saved - {class_display}")
-    except Exception as e:
-        print(f"[ERROR_LOG] Local save failed: {e}")
-
-def _save_error_log_local(error_entry):
-    """エラーログをローカルファイルに保存"""
-    os.makedirs('logs', exist_ok=True)
-    error_log_file = f"logs/error_log_{datetime.now().strftime('%Y%m%d')}.json"
-    
-    logs = []
-    if os.path.exists(error_log_file):
-        try:
-            with open(error_log_file, 'r', encoding='utf-8') as f:
-                logs = json.load(f)
-        except (json.JSONDecodeError, FileNotFoundError):
-            logs = []
-    
-    logs.append(error_entry)
-    
-    with open(error_log_file, 'w', encoding='utf-8') as f:
-        json.dump(logs, f, ensure_ascii=False, indent=2)
-
-def _save_error_log_gcs(error_entry):
-    """エラーログをGCSに保存"""
     try:
-        from google.cloud import storage
-        
-        date = datetime.now().strftime('%Y%m%d')
-        gcs_path = f"error_logs/error_log_{date}.json"
-        blob = bucket.blob(gcs_path)
-        
-        # 既存のエラーログを読み込み
-        logs = []
-        if blob.exists():
-            try:
-                content = blob.download_as_string().decode('utf-8')
-                logs = json.loads(content)
-            except:
-                logs = []
-        
-        # 新しいエラーを追加
-        logs.append(error_entry)
-        
-        # GCSに保存
-        blob.upload_from_string(
-            json.dumps(logs, ensure_ascii=False, indent=2),
-            content_type='application/json'
-        )
-        
-        print(f"[ERROR_LOG_GCS] {gcs_path} saved")
+        storage_backend.append_error(datetime.now().strftime('%Y%m%d'), error_entry)
+        print(f"[ERROR_LOG] saved - {class_display}")
     except Exception as e:
-        print(f"[ERROR_LOG_GCS] Error: {e}")
+        print(f"[ERROR_LOG] save failed: {e}")
 
 def load_error_logs(date=None):
-    """エラーログを読み込み（GCS優先）"""
+    """エラーログを読み込み（ストレージバックエンド経由）"""
     if date is None:
         date = datetime.now().strftime('%Y%m%d')
-    
-    # 本番環境: GCS優先
-    if USE_GCS and bucket:
-        try:
-            gcs_path = f"error_logs/error_log_{date}.json"
-            blob = bucket.blob(gcs_path)
-            
-            if blob.exists():
-                content = blob.download_as_string().decode('utf-8')
-                logs = json.loads(content)
-                print(f"[ERROR_LOAD] GCS - {gcs_path} loaded ({len(logs)} entries)")
-                return logs
-            else:
-                print(f"[ERROR_LOAD] GCS - {gcs_path} not found, trying local")
-        except Exception as e:
-            print(f"[ERROR_LOAD] GCS Error: {e}, trying local")
-    
-    # 開発環境またはGCS失敗時: ローカルから読み込み
-    error_log_file = f"logs/error_log_{date}.json"
-    if not os.path.exists(error_log_file):
-        return []
-    
-    try:
-        with open(error_log_file, 'r', encoding='utf-8') as f:
-            logs = json.load(f)
-            print(f"[ERROR_LOAD] Local - {error_log_file} loaded ({len(logs)} entries)")
-            return logs
-    except (json.JSONDecodeError, FileNotFoundError):
-        return []
+    return storage_backend.load_errors(date) or []
 
 def perform_clustering_analysis(unit_logs, unit_name, class_num):
     """学生の対話をエンベディング＆クラスタリング分析
@@ -1408,17 +1435,33 @@ def perform_clustering_analysis(unit_logs, unit_name, class_num):
             
             print(f"[CLUSTERING] Getting embeddings for {len(student_ids)} students...")
             
-            # OpenAI Embedding API を使用
-            client = openai.OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
-            embeddings_response = client.embeddings.create(
-                input=student_texts,
-                model="text-embedding-3-small"
-            )
+            # OpenAI Embedding API を使用（まとめて送る。一部の学生だけ埋め込めなかった時はその学生を除き、
+            # 誰も埋め込めない時は全員を TF-IDF でベクトル化する）
+            embedded = embed_texts(student_texts)
+            local_vectors = VECTORIZER_AVAILABLE and all(e is None for e in embedded)
+            failed_students = [] if local_vectors else [sid for sid, e in zip(student_ids, embedded) if e is None]
+            if failed_students:
+                print(f"[CLUSTERING] Embedding failed for {len(failed_students)} students")
+                student_ids = [sid for sid, e in zip(student_ids, embedded) if e is not None]
+                student_texts = [t for t, e in zip(student_texts, embedded) if e is not None]
+                embedded = [e for e in embedded if e is not None]
+            if len(student_ids) < 2:
+                clustering_results[phase_name] = {
+                    'clusters': [],
+                    'error': '埋め込みを取得できませんでした' if failed_students else '学生数が少なすぎます',
+                    'failed_students': failed_students
+                }
+                continue
             
-            embeddings = np.array([e.embedding for e in embeddings_response.data])
+            if local_vectors:
+                # API が使えない時は文字 n-gram の TF-IDF（疎行列のまま KMeans に渡す）
+                print(f"[CLUSTERING] Using local TF-IDF vectors for {len(student_ids)} students")
+                embeddings = tfidf_matrix(student_texts)
+            else:
+                embeddings = np.array(embedded)
             
             # クラスタ数を決定（学生数に基づいて、最大5クラスタ）
-            n_clusters = min(max(2, len(student_ids) // 3), 5)
+            n_clusters = min(max(2, len(student_ids) // 3), 5, len(student_ids))
             
             print(f"[CLUSTERING] Performing KMeans clustering with {n_clusters} clusters...")
             
@@ -1445,6 +1488,8 @@ def perform_clustering_analysis(unit_logs, unit_name, class_num):
                     for cid in sorted(clusters.keys())
                 ]
             }
+            if failed_students:
+                clustering_results[phase_name]['failed_students'] = failed_students
             
             print(f"[CLUSTERING] {phase_name}: {len(clusters)} clusters created")
         
@@ -1577,8 +1622,9 @@ def select_unit():
         "金属の温度と体積": "1"  # 1組のみアクセス可能（5組は全て許可）
     }
     
+    progress_by_unit = get_student_progress_many(class_number, student_number, UNITS)
     for unit in UNITS:
-        progress = get_student_progress(class_number, student_number, unit)
+        progress = progress_by_unit[unit]
         needs_resumption = check_resumption_needed(class_number, student_number, unit)
         stage_progress = progress.get('stage_progress', {})
         
@@ -1802,11 +1848,16 @@ def chat():
         session['conversation'] = conversation
         
         # セッションをDBに保存（ブラウザ閉鎖後の復帰対応）
+        # 保存は write-behind キュー経由（ASYNC_PERSISTENCE 無効時は同期保存）
         student_id = f"{session.get('class_number')}_{session.get('student_number')}"
-        save_session_to_db(student_id, unit, 'prediction', conversation)
+        persist_in_background(
+            save_session_to_db, student_id, unit, 'prediction', list(conversation),
+            coalesce_key=f"session:{student_id}_{unit}_prediction"
+        )
         
         # 学習ログを保存
-        save_learning_log(
+        persist_in_background(
+            save_learning_log,
             student_number=session.get('student_number'),
             unit=unit,
             log_type='prediction_chat',
@@ -1814,7 +1865,8 @@ def chat():
                 'user_message': user_message,
                 'ai_response': ai_message
             },
-            class_number=session.get('class_number')
+            class_number=session.get('class_number'),
+            timestamp=now_jst_isoformat()
         )
         
         # 対話が2回以上あれば、予想のまとめを作成可能
@@ -1888,12 +1940,16 @@ def reflect_chat():
         conversation.append({'role': 'assistant', 'content': ai_message})
         session['reflection_conversation'] = conversation
         
-        # セッションをDBに保存
+        # セッションをDBに保存（write-behind キュー経由）
         student_id = f"{session.get('class_number')}_{session.get('student_number')}"
-        save_session_to_db(student_id, unit, 'reflection', conversation)
+        persist_in_background(
+            save_session_to_db, student_id, unit, 'reflection', list(conversation),
+            coalesce_key=f"session:{student_id}_{unit}_reflection"
+        )
         
         # 学習ログを保存
-        save_learning_log(
+        persist_in_background(
+            save_learning_log,
             student_number=session.get('student_number'),
             unit=unit,
             log_type='reflection_chat',
@@ -1901,7 +1957,8 @@ def reflect_chat():
                 'user_message': user_message,
                 'ai_response': ai_message
             },
-            class_number=session.get('class_number')
+            class_number=session.get('class_number'),
+            timestamp=now_jst_isoformat()
         )
         
         user_messages_count = sum(1 for msg in conversation if msg['role'] == 'user')
@@ -2237,7 +2294,7 @@ def sync_session():
         }), 500
 
 def _save_summary_to_db(student_id, unit, stage, summary_text, conversation=None):
-    """サマリーを永続ストレージに保存（GCS優先、ローカルはフォールバック）
+    """サマリーを永続ストレージに保存（ストレージバックエンド経由）
     
     Args:
         student_id: 学習者ID
@@ -2246,100 +2303,17 @@ def _save_summary_to_db(student_id, unit, stage, summary_text, conversation=None
         summary_text: サマリーテキスト
         conversation: 会話データ（オプション）
     """
-    # Firestore 優先
-    if USE_FIRESTORE and firestore_client:
-        try:
-            key = f"{student_id}_{unit}_{stage}"
-            data = {
-                'summary': summary_text,
-                'saved_at': now_jst_isoformat(),
-                'student_id': student_id,
-                'unit': unit,
-                'stage': stage
-            }
-            if conversation:
-                data['conversation'] = conversation
-            
-            firestore_client.collection('sb_summary_storage').document(key).set(data)
-            print(f"[SUMMARY_SAVE] Firestore - {key}")
-            return
-        except Exception as e:
-            print(f"[SUMMARY_SAVE] Firestore failed: {e}, falling back to next storage")
-
-    # 本番環境: GCS優先
-    if USE_GCS and bucket:
-        try:
-            _save_summary_gcs(student_id, unit, stage, summary_text, conversation)
-            print(f"[SUMMARY_SAVE] GCS - {student_id}_{unit}_{stage}")
-            return  # GCS保存成功したらローカル保存は不要
-        except Exception as e:
-            print(f"[SUMMARY_SAVE] GCS failed: {e}, falling back to local")
-    
-    # 開発環境またはGCS失敗時: ローカル保存
-    try:
-        _save_summary_local(student_id, unit, stage, summary_text, conversation)
-        print(f"[SUMMARY_SAVE] Local - {student_id}_{unit}_{stage}")
-    except Exception as e:
-        print(f"[SUMMARY_SAVE] Local failed: {e}")
-
-def _save_summary_gcs(student_id, unit, stage, summary_text, conversation=None):
-    """サマリーをGCSに保存"""
-    try:
-        if not bucket:
-            raise Exception("GCS bucket not initialized")
-        
-        key = f"summaries/{student_id}_{unit}_{stage}"
-        summary_data = {
-            'summary': summary_text,
-            'saved_at': now_jst_isoformat(),
-            'student_id': student_id,
-            'unit': unit,
-            'stage': stage
-        }
-        if conversation:
-            summary_data['conversation'] = conversation
-        
-        blob = bucket.blob(key)
-        blob.upload_from_string(json.dumps(summary_data, ensure_ascii=False), content_type='application/json')
-        print(f"[SUMMARY_SAVE_GCS] {key} saved to GCS")
-    except Exception as e:
-        print(f"[SUMMARY_SAVE_GCS] Error: {e}")
-        raise
-
-
-def _save_summary_local(student_id, unit, stage, summary_text, conversation=None):
-    """サマリーをローカルファイルに保存"""
-    try:
-        summary_file = 'summary_storage.json'
-        
-        # 既存のファイルを読み込む
-        if os.path.exists(summary_file):
-            with open(summary_file, 'r', encoding='utf-8') as f:
-                summaries = json.load(f)
-        else:
-            summaries = {}
-        
-        # キーを作成
-        key = f"{student_id}_{unit}_{stage}"
-        
-        # 新しいサマリーを追加
-        summaries[key] = {
-            'summary': summary_text,
-            'saved_at': now_jst_isoformat(),
-            'student_id': student_id,
-            'unit': unit,
-            'stage': stage
-        }
-        if conversation:
-            summaries[key]['conversation'] = conversation
-        
-        # ファイルに保存
-        with open(summary_file, 'w', encoding='utf-8') as f:
-            json.dump(summaries, f, ensure_ascii=False, indent=2)
-        
-        print(f"[SUMMARY_SAVE_LOCAL] {key} saved to {summary_file}")
-    except Exception as e:
-        print(f"[SUMMARY_SAVE_LOCAL] Error: {e}")
+    summary_entry = {
+        'summary': summary_text,
+        'saved_at': now_jst_isoformat(),
+        'student_id': student_id,
+        'unit': unit,
+        'stage': stage
+    }
+    if conversation:
+        summary_entry['conversation'] = conversation
+    storage_backend.save_summary(summary_entry)
+    _update_student_history(student_id, lambda doc: apply_summary(doc, summary_entry))
 
 
 @app.route('/summary/status/<job_id>', methods=['GET'])
@@ -2359,6 +2333,22 @@ def summary_status(job_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/teacher/api/persistence_metrics')
+@require_teacher_auth
+def persistence_metrics():
+    """write-behind キューの状態（キュー長・書き込み遅延など）を返す"""
+    if persistence_queue is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **persistence_queue.metrics()})
+
+@app.route('/teacher/api/log_cache_metrics')
+@require_teacher_auth
+def log_cache_metrics():
+    """学習ログ読み込みキャッシュのヒット数などを返す"""
+    if learning_log_cache is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **learning_log_cache.metrics()})
+
 @app.route('/teacher/login', methods=['GET', 'POST'])
 def teacher_login():
     """教員ログインページ"""
@@ -2440,13 +2430,9 @@ def teacher_logs():
         logs = []
         try:
             dates = get_available_log_dates()
-            for d in dates:
-                try:
-                    day_logs = load_learning_logs(d)
-                    logs.extend(day_logs)
-                    print(f"[LOGS] Loaded {len(day_logs)} logs from {d} (ALL)")
-                except Exception as e:
-                    print(f"[LOGS] Error loading logs for {d}: {e}")
+            for d, day_logs in load_learning_logs_range(dates):
+                logs.extend(day_logs)
+                print(f"[LOGS] Loaded {len(day_logs)} logs from {d} (ALL)")
         except Exception as e:
             print(f"[LOGS] Error listing dates for ALL: {e}")
             logs = []
@@ -2547,94 +2533,61 @@ def teacher_logs():
 @app.route('/teacher/export')
 @require_teacher_auth
 def teacher_export():
-    """ログをCSVでエクスポート - ダウンロード日までのすべてのログ"""
-    from io import StringIO, BytesIO
-    import csv
-    
-    download_date_str = request.args.get('date', datetime.now().strftime('%Y%m%d'))
+    """ログをCSVでエクスポート - ダウンロード日までのすべてのログ
     
-    # ダウンロード日までのすべてのログを取得
-    all_logs = []
-    available_dates = get_available_log_dates()
+    1日ずつ読み込み・絞り込み・書き出しを行うストリーミング応答で返すので、
+    ログの期間が長くてもメモリ使用量は一定（先読み分の数日分）に収まる。
+    送信した CSV は保存しておき、新しいログが無い間は同じ条件のエクスポートで再利用する。
+    async=1 を付けると RQ ジョブとして作成し、ジョブIDを返す（/teacher/export/status/<job_id>）。
+    """
+    params = _export_params()
+    if request.args.get('async') == '1':
+        return _start_export_job('csv', params)
+    
+    download_date_str = params['date']
+    target_dates = _export_target_dates(download_date_str)
+    key = _export_artifact_key('csv', params, target_dates)
+    filename = _export_filename('csv', download_date_str)
+    
+    if key and _ensure_local_artifact(key, 'csv'):
+        print(f"[EXPORT] Reusing CSV {key}")
+        return send_file(
+            export_artifacts.path(key, 'csv'),
+            mimetype="text/csv; charset=utf-8",
+            as_attachment=True,
+            download_name=filename,
+            conditional=True,
+        )
     
     print(f"[EXPORT] START - exporting logs up to date: {download_date_str}")
-    print(f"[EXPORT] Available dates: {available_dates}")
+    print(f"[EXPORT] Target dates: {target_dates}")
     
-    for date_str in available_dates:
-        # date_str は文字列 (YYYYMMDD format)
-        current_date_raw = date_str if isinstance(date_str, str) else date_str.get('raw', '')
-        # ダウンロード日以下の日付のみを対象
-        if current_date_raw <= download_date_str:
-            try:
-                logs = load_learning_logs(current_date_raw)
-                all_logs.extend(logs)
-                print(f"[EXPORT] Loaded {len(logs)} logs from {current_date_raw}")
-            except Exception as e:
-                print(f"[EXPORT] ERROR loading logs from {current_date_raw}: {str(e)}")
-                continue
-
-    # フロントのフィルタ（現在の表示）に合わせて絞り込み可能にする
-    unit_filter = request.args.get('unit', '')
-    class_filter = request.args.get('class', '')
-    student_filter = request.args.get('student', '')
-
-    def matches_filters(log):
-        if unit_filter and log.get('unit') != unit_filter:
-            return False
-        if class_filter:
-            try:
-                cf_int = normalize_class_value_int(class_filter)
-                if cf_int is not None and log.get('class_num') != cf_int:
-                    return False
-            except Exception:
-                pass
-        if student_filter:
-            try:
-                if int(student_filter) != int(log.get('seat_num') or -1):
-                    return False
-            except Exception:
-                if str(student_filter) != str(log.get('student_number')):
-                    return False
-        return True
-
-    filtered_logs = [log for log in all_logs if matches_filters(log)]
-    
-    # CSVをメモリに作成（UTF-8 BOM付き）
-    output = StringIO()
-    fieldnames = ['timestamp', 'class_display', 'student_number', 'unit', 'log_type', 'content']
-    writer = csv.DictWriter(output, fieldnames=fieldnames)
-    writer.writeheader()
-    
-    for log in filtered_logs:
-        content = ""
-        if log.get('log_type') == 'prediction_chat':
-            content = f"Q: {log['data'].get('user_message', '')}\nA: {log['data'].get('ai_response', '')}"
-        elif log.get('log_type') == 'prediction_summary':
-            content = log['data'].get('summary', '')
-        elif log.get('log_type') == 'reflection_chat':
-            content = f"Q: {log['data'].get('user_message', '')}\nA: {log['data'].get('ai_response', '')}"
-        elif log.get('log_type') == 'final_summary':
-            content = log['data'].get('final_summary', '')
-        
-        writer.writerow({
-            'timestamp': log.get('timestamp', ''),
-            'class_display': log.get('class_display', ''),
-            'student_number': log.get('student_number', ''),
-            'unit': log.get('unit', ''),
-            'log_type': log.get('log_type', ''),
-            'content': content
-        })
+    totals = {'exported': 0}
     
-    # StringIOをUTF-8 BOM付きバイナリにエンコード
-    csv_string = output.getvalue()
-    csv_bytes = '\ufeff'.encode('utf-8') + csv_string.encode('utf-8')  # UTF-8 BOM追加
+    def on_day(current_date_raw, loaded, exported):
+        totals['exported'] += exported
+        print(f"[EXPORT] Loaded {loaded} logs from {current_date_raw}, exported {exported}")
     
-    filename = f"all_learning_logs_up_to_{download_date_str}.csv"
+    chunks = csv_chunks(
+        load_learning_logs_range(target_dates),
+        EXPORT_CSV_FIELDNAMES,
+        _export_csv_row,
+        # フロントのフィルタ（現在の表示）に合わせて絞り込み可能にする
+        _export_log_filter(params),
+        on_day,
+    )
+    if key:
+        chunks = export_artifacts.tee(key, 'csv', chunks)
     
-    print(f"[EXPORT] SUCCESS - exported {len(filtered_logs)} total logs, size: {len(csv_bytes)} bytes")
+    def generate():
+        size = 0
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+        print(f"[EXPORT] SUCCESS - exported {totals['exported']} total logs, size: {size} bytes")
     
     return Response(
-        csv_bytes,
+        generate(),
         mimetype="text/csv; charset=utf-8",
         headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"}
     )
@@ -2642,33 +2595,270 @@ def teacher_export():
 @app.route('/teacher/export_json')
 @require_teacher_auth
 def teacher_export_json():
-    """対話内容をJSONでエクスポート - 単元ごとのディレクトリ構造でzip出力"""
-    from io import BytesIO
+    """対話内容をJSONでエクスポート - 単元ごとのディレクトリ構造でzip出力
+    
+    ログは1日ずつ読み込んで一時 SQLite に退避し、zip はディスク上に
+    1ファイルずつ書き出す（メモリ上に全ログ・zip 全体を持たない）。
+    できあがった zip は新しいログが無い間は同じ条件のダウンロードで再利用し、
+    Range 指定によるダウンロードの再開にも対応する。進捗は /teacher/export_json/status で確認できる。
+    async=1 を付けると RQ ジョブとして作成し、ジョブIDを返す（/teacher/export/status/<job_id>）。
+    """
+    params = _export_params()
+    if request.args.get('async') == '1':
+        return _start_export_job('zip', params)
     
-    download_date_str = request.args.get('date', datetime.now().strftime('%Y%m%d'))
+    try:
+        result = perform_export_job('zip', params)
+    except Exception as e:
+        print(f"[EXPORT_JSON] ERROR - {type(e).__name__}: {e}")
+        return jsonify({'error': 'エクスポートに失敗しました', 'details': str(e)}), 500
     
-    # ダウンロード日までのすべてのログを取得
-    all_logs = []
+    return send_file(
+        export_artifacts.path(result['key'], 'zip'),
+        mimetype="application/zip",
+        as_attachment=True,
+        download_name=result['filename'],
+        conditional=True,
+    )
+
+@app.route('/teacher/export_json/status')
+@require_teacher_auth
+def teacher_export_json_status():
+    """対話内容エクスポート（zip）の作成状況を返す（パラメータは /teacher/export_json と同じ）"""
+    params = _export_params()
+    key = _export_artifact_key('zip', params, _export_target_dates(params['date']))
+    status = export_artifacts.status(key) if key else None
+    if status is None:
+        return jsonify({'state': 'not_started'}), 404
+    return jsonify(status)
+
+@app.route('/teacher/export/status/<job_id>')
+@require_teacher_auth
+def teacher_export_job_status(job_id):
+    """エクスポートジョブの状態（処理済みの日数・行数、完了時はダウンロードURL）を返す"""
+    if rq_queue is None:
+        return jsonify({'error': 'Job queue not available'}), 503
+    try:
+        job = _RQJob.fetch(job_id, connection=rq_queue.connection)
+    except Exception as e:
+        return jsonify({'status': 'not_found', 'error': str(e)}), 404
+    
+    progress = job.meta.get('progress', {})
+    payload = {
+        'status': job.get_status(),
+        'rows': progress.get('records', 0),
+        'progress': progress,
+    }
+    if job.is_finished and job.result:
+        payload['status'] = 'finished'
+        payload['rows'] = job.result.get('rows', payload['rows'])
+        payload['download_url'] = _export_download_url(job.result)
+    elif job.is_failed:
+        payload['status'] = 'failed'
+        payload['error'] = str(job.exc_info) if job.exc_info else 'Unknown error'
+    return jsonify(payload)
+
+@app.route('/teacher/export/download/<artifact>')
+@require_teacher_auth
+def teacher_export_download(artifact):
+    """作成済みのエクスポート（ジョブの成果物）をダウンロード（Range 対応）"""
+    match = re.fullmatch(r'([0-9a-f]{20})\.(csv|zip)', artifact)
+    if not match:
+        return jsonify({'error': 'invalid artifact'}), 400
+    key, ext = match.groups()
+    if not _ensure_local_artifact(key, ext):
+        return jsonify({'error': 'エクスポートが見つかりません（期限切れの可能性があります）'}), 404
+    filename = secure_filename(request.args.get('filename', '')) or artifact
+    return send_file(
+        export_artifacts.path(key, ext),
+        mimetype="text/csv; charset=utf-8" if ext == 'csv' else "application/zip",
+        as_attachment=True,
+        download_name=filename,
+        conditional=True,
+    )
+
+EXPORT_CSV_FIELDNAMES = ['timestamp', 'class_display', 'student_number', 'unit', 'log_type', 'content']
+
+def _export_csv_row(log):
+    """学習ログ1件を CSV の1行に変換"""
+    content = ""
+    if log.get('log_type') == 'prediction_chat':
+        content = f"Q: {log['data'].get('user_message', '')}\nA: {log['data'].get('ai_response', '')}"
+    elif log.get('log_type') == 'prediction_summary':
+        content = log['data'].get('summary', '')
+    elif log.get('log_type') == 'reflection_chat':
+        content = f"Q: {log['data'].get('user_message', '')}\nA: {log['data'].get('ai_response', '')}"
+    elif log.get('log_type') == 'final_summary':
+        content = log['data'].get('final_summary', '')
+    return {
+        'timestamp': log.get('timestamp', ''),
+        'class_display': log.get('class_display', ''),
+        'student_number': log.get('student_number', ''),
+        'unit': log.get('unit', ''),
+        'log_type': log.get('log_type', ''),
+        'content': content
+    }
+
+def _export_dialogue_document(unit, student_id, logs_for_student):
+    """zip 内の talk/{unit}/student_{id}.json の内容"""
+    return {
+        'unit': unit,
+        'student_id': student_id,
+        'class_display': logs_for_student[0].get('class_display', '') if logs_for_student else '',
+        'export_date': now_jst_isoformat(),
+        'logs': logs_for_student
+    }
+
+def _export_filename(kind, download_date_str):
+    if kind == 'csv':
+        return f"all_learning_logs_up_to_{download_date_str}.csv"
+    return f"dialogue_logs_up_to_{download_date_str}.zip"
+
+def _export_target_dates(download_date_str):
+    """ダウンロード日以下のログのある日付（date_str は文字列 YYYYMMDD）"""
     available_dates = get_available_log_dates()
+    return [
+        d for d in (date_str if isinstance(date_str, str) else date_str.get('raw', '') for date_str in available_dates)
+        if d <= download_date_str
+    ]
+
+def _export_artifact_key(kind, params, target_dates):
+    """エクスポート条件と対象ログの版から成果物のキーを作る（作れない場合は None）
     
-    print(f"[EXPORT_JSON] START - exporting logs up to date: {download_date_str}")
+    過去日のログは変わらないので、まだ書き込まれうる日（_is_mutable_log_date）だけ
+    ストレージに版を問い合わせる。新しいログが届くとキーが変わり、作り直しになる。
+    """
+    try:
+        versions = {d: storage_backend.log_version(d) for d in target_dates if _is_mutable_log_date(d)}
+    except Exception as e:
+        print(f"[EXPORT] log version check failed, artifact will not be reused: {type(e).__name__}: {e}")
+        return None
+    return ExportArtifacts.key({'kind': kind, **params, 'dates': target_dates, 'versions': versions})
+
+def _ensure_local_artifact(key, ext):
+    """成果物がローカルに無ければ GCS から取得する。存在すれば True"""
+    if export_artifacts.exists(key, ext):
+        return True
+    if not (USE_GCS and bucket):
+        return False
+    try:
+        blob = bucket.get_blob(f"{EXPORT_GCS_PREFIX}{key}.{ext}")
+        if blob is None:
+            return False
+        export_artifacts.workdir()
+        tmp = f"{export_artifacts.path(key, ext)}.{uuid.uuid4().hex}.tmp"
+        blob.download_to_filename(tmp)
+        os.replace(tmp, export_artifacts.path(key, ext))
+        return True
+    except Exception as e:
+        print(f"[EXPORT] GCS artifact download failed for {key}.{ext}: {e}")
+        return False
+
+def _export_download_url(result):
+    return url_for(
+        'teacher_export_download',
+        artifact=f"{result['key']}.{result['kind']}",
+        filename=result['filename'],
+    )
+
+def perform_export_job(kind, params):
+    """エクスポートの成果物（'csv' または 'zip'）を作る。RQ ワーカーからも呼ばれる
     
-    for date_str in available_dates:
-        # date_str は文字列 (YYYYMMDD format)
-        current_date_raw = date_str if isinstance(date_str, str) else date_str.get('raw', '')
-        if current_date_raw <= download_date_str:
+    同じ条件・同じログの成果物が既にあれば作り直さずに返す。GCS 使用時は
+    成果物を GCS にも置き、別インスタンスからもダウンロードできるようにする。
+    
+    Returns:
+        {'kind', 'key', 'filename', 'rows'}
+    """
+    download_date_str = params['date']
+    target_dates = _export_target_dates(download_date_str)
+    key = _export_artifact_key(kind, params, target_dates) or uuid.uuid4().hex[:20]
+    result = {'kind': kind, 'key': key, 'filename': _export_filename(kind, download_date_str), 'rows': 0}
+    
+    job = _rq.get_current_job()
+    
+    def report_progress(fields):
+        if job is not None:
+            job.meta['progress'] = fields
+            job.save_meta()
+    
+    with get_lock_for_path(f"export:{key}.{kind}"):
+        if _ensure_local_artifact(key, kind):
+            status = export_artifacts.status(key) or {}
+            result['rows'] = status.get('records', 0)
+            print(f"[EXPORT_JOB] Reusing {key}.{kind}")
+            return result
+        
+        export_artifacts.prune()
+        print(f"[EXPORT_JOB] START {kind} - exporting logs up to date: {download_date_str}")
+        if kind == 'csv':
+            result['rows'] = export_artifacts.build_csv(
+                key,
+                load_learning_logs_range(target_dates),
+                len(target_dates),
+                EXPORT_CSV_FIELDNAMES,
+                _export_csv_row,
+                _export_log_filter(params),
+                progress=report_progress,
+            )
+        else:
+            result['rows'] = export_artifacts.build(
+                key,
+                load_learning_logs_range(target_dates),
+                len(target_dates),
+                _export_log_filter(params),
+                _export_dialogue_document,
+                progress=report_progress,
+            )
+        print(f"[EXPORT_JOB] SUCCESS {kind} - exported {result['rows']} total logs")
+        
+        if USE_GCS and bucket:
             try:
-                logs = load_learning_logs(current_date_raw)
-                all_logs.extend(logs)
-                print(f"[EXPORT_JSON] Loaded {len(logs)} logs from {current_date_raw}")
+                bucket.blob(f"{EXPORT_GCS_PREFIX}{key}.{kind}").upload_from_filename(export_artifacts.path(key, kind))
             except Exception as e:
-                print(f"[EXPORT_JSON] ERROR loading logs from {current_date_raw}: {str(e)}")
-                continue
+                print(f"[EXPORT_JOB] GCS upload failed for {key}.{kind}: {e}")
+    return result
+
+def _start_export_job(kind, params):
+    """エクスポートを RQ ジョブとして開始し、ジョブIDまたは作成済みの成果物を返す"""
+    target_dates = _export_target_dates(params['date'])
+    key = _export_artifact_key(kind, params, target_dates)
+    if key and _ensure_local_artifact(key, kind):
+        result = {'kind': kind, 'key': key, 'filename': _export_filename(kind, params['date'])}
+        return jsonify({'status': 'finished', 'download_url': _export_download_url(result)})
+    
+    if rq_queue is None:
+        # Redis/RQ が無い場合はこのリクエスト内で作成する
+        print(f"[EXPORT] RQ queue not available, building {kind} synchronously")
+        try:
+            result = perform_export_job(kind, params)
+        except Exception as e:
+            print(f"[EXPORT] ERROR - {type(e).__name__}: {e}")
+            return jsonify({'error': 'エクスポートに失敗しました', 'details': str(e)}), 500
+        return jsonify({'status': 'finished', 'rows': result['rows'], 'download_url': _export_download_url(result)})
+    
+    job = rq_queue.enqueue(perform_export_job, args=(kind, params), job_timeout=EXPORT_JOB_TIMEOUT_SEC)
+    print(f"[EXPORT] Enqueued {kind} export job: {job.id}")
+    return jsonify({
+        'job_id': job.id,
+        'status': 'queued',
+        'status_url': url_for('teacher_export_job_status', job_id=job.id),
+    })
+
+def _export_params():
+    """エクスポート条件（ダウンロード日とフィルタ）"""
+    return {
+        'date': request.args.get('date', datetime.now().strftime('%Y%m%d')),
+        'unit': request.args.get('unit', ''),
+        'class': request.args.get('class', ''),
+        'student': request.args.get('student', ''),
+    }
 
-    # フィルタリング（テンプレートの現在の表示に合わせる）
-    unit_filter = request.args.get('unit', '')
-    class_filter = request.args.get('class', '')
-    student_filter = request.args.get('student', '')
+def _export_log_filter(params):
+    """フィルタリング（テンプレートの現在の表示に合わせる）"""
+    unit_filter = params['unit']
+    class_filter = params['class']
+    student_filter = params['student']
 
     def matches_filters(log):
         if unit_filter and log.get('unit') != unit_filter:
@@ -2689,57 +2879,7 @@ def teacher_export_json():
                     return False
         return True
 
-    filtered_logs = [log for log in all_logs if matches_filters(log)]
-    
-    # 児童ごと・単元ごとにグループ化
-    # 構造: {unit: {student_id: [logs]}}
-    structured_logs = {}
-    
-    for log in filtered_logs:
-        unit = log.get('unit', 'unknown')
-        student_id = log.get('student_number', 'unknown')
-        
-        if unit not in structured_logs:
-            structured_logs[unit] = {}
-        if student_id not in structured_logs[unit]:
-            structured_logs[unit][student_id] = []
-        
-        structured_logs[unit][student_id].append(log)
-    
-    # Zipファイルをメモリに作成
-    zip_buffer = BytesIO()
-    
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for unit in sorted(structured_logs.keys()):
-            for student_id in sorted(structured_logs[unit].keys()):
-                logs_for_student = structured_logs[unit][student_id]
-                
-                # JSON データの作成
-                json_data = {
-                    'unit': unit,
-                    'student_id': student_id,
-                    'class_display': logs_for_student[0].get('class_display', '') if logs_for_student else '',
-                    'export_date': now_jst_isoformat(),
-                    'logs': logs_for_student
-                }
-                
-                # ファイルパス: talk/{unit}/student_{student_id}.json
-                file_path = f"talk/{unit}/student_{student_id}.json"
-                
-                # JSONファイルをzipに追加
-                json_string = json.dumps(json_data, ensure_ascii=False, indent=2)
-                zip_file.writestr(file_path, json_string.encode('utf-8'))
-    
-    zip_buffer.seek(0)
-    filename = f"dialogue_logs_up_to_{download_date_str}.zip"
-    
-    print(f"[EXPORT_JSON] SUCCESS - exported JSON with {len(filtered_logs)} total logs")
-    
-    return Response(
-        zip_buffer.getvalue(),
-        mimetype="application/zip",
-        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"}
-    )
+    return matches_filters
 
 @app.route('/teacher/student_detail')
 @require_teacher_auth
@@ -2770,31 +2910,27 @@ def student_detail():
     
     # 学習ログを読み込み
     # teacher/logs では 'ALL' をサポートしているため、ここでも同様に処理する
-    if selected_date == 'ALL':
-        logs = []
+    student_logs = []
+    if class_num and seat_num:
+        # 学習者インデックスでこの児童のログがある日・レコードだけを読む
         try:
-            dates = get_available_log_dates()
-            for d in dates:
-                try:
-                    day_logs = load_learning_logs(d)
-                    logs.extend(day_logs)
-                except Exception as e:
-                    print(f"[DETAIL] Error loading logs for {d}: {e}")
-                    continue
+            logs = load_student_logs(class_num, seat_num, None if selected_date == 'ALL' else [selected_date])
         except Exception as e:
-            print(f"[DETAIL] Error listing dates for ALL: {e}")
+            print(f"[DETAIL] Error loading student logs: {e}")
             logs = []
-    else:
-        logs = load_learning_logs(selected_date)
-    
-    # 該当する児童のログを抽出（クラスと出席番号で絞り込み）
-    student_logs = []
-    if class_num and seat_num:
-        student_logs = [log for log in logs if 
-                        log.get('class_num') == class_num and 
-                        log.get('seat_num') == seat_num and 
-                        (not unit or log.get('unit') == unit)]
+        student_logs = [log for log in logs if not unit or log.get('unit') == unit]
     elif student_id:
+        if selected_date == 'ALL':
+            logs = []
+            try:
+                dates = get_available_log_dates()
+                for d, day_logs in load_learning_logs_range(dates):
+                    logs.extend(day_logs)
+            except Exception as e:
+                print(f"[DETAIL] Error listing dates for ALL: {e}")
+                logs = []
+        else:
+            logs = load_learning_logs(selected_date)
         student_logs = [log for log in logs if 
                         str(log.get('student_number')) == str(student_id) and 
                         (not unit or log.get('unit') == unit)]
@@ -2819,6 +2955,18 @@ def student_detail():
     # 単元一覧を取得（フィルター用）
     all_units = list(set([log.get('unit') for log in logs if log.get('unit')]))
     
+    # 各単元の進行状況（この児童の進行状況を1回だけ読み込む）。
+    # 保存済みの記録がある単元だけ表示する（初期値の段階・アクセス時刻は実際の値ではないため）
+    units_data = {unit_name: {} for unit_name in all_units}
+    if class_num and seat_num and all_units:
+        try:
+            _, record = load_student_progress_record(class_num, seat_num)
+            for unit_name in all_units:
+                if record.get(unit_name):
+                    units_data[unit_name] = {'progress_summary': get_progress_summary(record[unit_name])}
+        except Exception as e:
+            print(f"[DETAIL] Error loading progress: {e}")
+    
     return render_template('teacher/student_detail.html',
                          class_num=class_num,
                          seat_num=seat_num,
@@ -2828,9 +2976,48 @@ def student_detail():
                          current_date=selected_date,
                          logs=student_logs,
                          available_dates=available_dates,
-                         units_data={unit_name: {} for unit_name in all_units},
+                         units_data=units_data,
                          teacher_id=session.get('teacher_id', 'teacher'))
 
+@app.route('/teacher/similar_messages')
+@require_teacher_auth
+def similar_messages():
+    """児童の発言に似た発言（予想・考察）をクラス・期間をまたいで検索する（JSON）
+
+    クエリパラメータ:
+        text: 発言（必須）
+        unit / stage: 絞り込む単元・段階（prediction / reflection）
+        student / timestamp: 発言した児童とその時刻（その発言自体を結果から除く）
+        k: 件数（既定10、最大50）
+    """
+    started = time.perf_counter()
+    text = (request.args.get('text') or '').strip()
+    if not text:
+        return jsonify({'error': '発言が指定されていません'}), 400
+    stage = request.args.get('stage') or None
+    if stage not in (None, 'prediction', 'reflection'):
+        return jsonify({'error': f'不明な段階です: {stage}'}), 400
+    if similarity_index is None:
+        return jsonify({'error': '似た発言の検索は利用できません'}), 503
+    k = min(max(request.args.get('k', 10, type=int), 1), 50)
+    embedding = embed_texts([text])[0]
+    if embedding is None:
+        return jsonify({'error': '発言の埋め込みを取得できませんでした'}), 503
+    exclude = ()
+    student, timestamp = request.args.get('student'), request.args.get('timestamp')
+    if student and timestamp:
+        exclude = tuple(message_key(timestamp, student, s, text) for s in ('prediction', 'reflection'))
+    try:
+        results = similarity_index.search(embedding, k=k, unit=request.args.get('unit') or None,
+                                          stage=stage, exclude=exclude)
+    except Exception as e:
+        print(f"[SIMILAR] search failed: {e}")
+        return jsonify({'error': '似た発言の検索に失敗しました'}), 500
+    return jsonify({
+        'results': results,
+        'took_ms': round((time.perf_counter() - started) * 1000, 1),
+    })
+
 
 
 
@@ -2846,44 +3033,41 @@ def analysis_dashboard():
 @app.route('/teacher/analysis')
 @require_teacher_auth
 def teacher_analysis():
-    """教員用分析ダッシュボード（GCSから読み込み）"""
+    """教員用分析ダッシュボード（日別の集計を合算して分析）
+    
+    生ログは集計が無い日・当日に新しいログが届いた日だけ読み込み、
+    それ以外は保存済みの日別・単元別・段階別の集計を合算する。
+    AI分析はキャッシュ済みの結果を使う（refresh=1 で作り直す）。
+    """
     unit = request.args.get('unit', '')
+    refresh = request.args.get('refresh') == '1'
     date = request.args.get('date', '')
+    start_date = request.args.get('start_date', '')
+    end_date = request.args.get('end_date', '')
     
-    logs = []
     analysis_period = date if date else "全期間"
     
     try:
-        # 指定日付のログを読み込み（GCS優先）
         if date:
-            print(f"[ANALYSIS] Loading logs for date={date}, unit={unit}")
-            logs = load_learning_logs(date)
+            print(f"[ANALYSIS] Loading aggregates for date={date}, unit={unit}")
+            target_dates = [date]
+        elif start_date and end_date:
+            # 期間指定：期間内のログのある日（新しい順）
+            print(f"[ANALYSIS] Loading aggregates for {start_date}-{end_date}, unit={unit}")
+            target_dates = [d for d in get_available_log_dates() if start_date <= d <= end_date]
+            analysis_period = f"{start_date}〜{end_date}（{len(target_dates)}日分）"
         else:
             # 全期間の場合、最新30日分を処理
-            print(f"[ANALYSIS] Loading logs for all periods")
+            print(f"[ANALYSIS] Loading aggregates for all periods")
             available_dates = get_available_log_dates()
             target_dates = available_dates[:30]  # 最新30日
-            
-            for target_date in target_dates:
-                try:
-                    date_logs = load_learning_logs(target_date)
-                    if date_logs:
-                        logs.extend(date_logs)
-                    print(f"[ANALYSIS] Loaded {len(date_logs)} logs from {target_date}")
-                except Exception as e:
-                    print(f"[ANALYSIS] Error loading {target_date}: {e}")
-            
             analysis_period = f"全期間（最新{len(target_dates)}日分）"
         
-        print(f"[ANALYSIS] Total logs loaded: {len(logs)}")
-        
-        # 単元でフィルター
-        if unit:
-            logs = [log for log in logs if log.get('unit') == unit]
-            print(f"[ANALYSIS] Filtered to {len(logs)} logs for unit={unit}")
+        day_aggregates = [aggregate for _, aggregate in load_day_aggregates(target_dates)]
         
-        # 簡易分析を実行
-        analysis_result = analyze_logs_simple(logs)
+        # 集計を合算して簡易分析を実行（単元でフィルター）
+        analysis_result = analyze_aggregates(day_aggregates, unit, refresh_insights=refresh)
+        print(f"[ANALYSIS] Total logs: {analysis_result['total_logs']} from {len(target_dates)} days")
         
         return jsonify({
             'success': True,
@@ -2891,7 +3075,7 @@ def teacher_analysis():
             'analysis_period': analysis_period,
             'unit': unit,
             'analysis': analysis_result,
-            'log_count': len(logs)
+            'log_count': analysis_result['total_logs']
         })
         
     except Exception as e:
@@ -2904,98 +3088,414 @@ def teacher_analysis():
         }), 500
 
 
+# -----------------------------
+# 分析用の日別集計（日 × 単元 × 段階）
+# -----------------------------
+# 集計の形式。集計する内容を変えたら上げる（古い形式の集計は作り直される）
+ANALYTICS_AGGREGATE_VERSION = 2
+ANALYTICS_SAMPLE_LIMIT = 20       # 保持するサンプル（AI分析は段階ごとに20件まで使う）
+ANALYTICS_CLUSTER_SAMPLES = 3     # 文字数クラスタごとのサンプル
+ANALYTICS_SCIENCE_TERM_LIMIT = 15  # 検出した理科用語の表示数
+_ANALYSIS_STAGES = {'prediction_chat': 'prediction', 'reflection_chat': 'reflection'}
+# 文字数クラスタ（20文字未満 / 20-60文字 / 60文字以上）
+_LENGTH_BUCKETS = (('short', 20, '簡潔な回答'), ('medium', 60, '標準的な回答'), ('long', None, '詳細な回答'))
+
+ANALYTICS_AGGREGATE_FILE = os.environ.get('ANALYTICS_AGGREGATE_FILE', 'analytics_aggregates.db')
+try:
+    analytics_store = DailyAggregateStore(ANALYTICS_AGGREGATE_FILE, ANALYTICS_AGGREGATE_VERSION)
+except Exception as e:
+    print(f"[INIT] Analytics aggregate store disabled: {e}")
+    analytics_store = None
+
+# AI分析（傾向分析とプロンプト改善提案）の結果キャッシュ。
+# キーは (単元, モデル, プロンプトの版, サンプルしたメッセージ) のハッシュ。
+# プロンプトを変えたら AI_INSIGHTS_PROMPT_VERSION を上げる
+AI_INSIGHTS_MODEL = "gpt-4o-mini"
+AI_INSIGHTS_PROMPT_VERSION = 1
+AI_INSIGHTS_CACHE_FILE = os.environ.get('AI_INSIGHTS_CACHE_FILE', 'ai_insights_cache.db')
+AI_INSIGHTS_CACHE_TTL_SEC = int(os.getenv('AI_INSIGHTS_CACHE_TTL_SEC', str(7 * 24 * 3600)))
+AI_INSIGHTS_CACHE_MAX_ENTRIES = int(os.getenv('AI_INSIGHTS_CACHE_MAX_ENTRIES', '500'))
+try:
+    ai_insights_cache = InsightCache(
+        AI_INSIGHTS_CACHE_FILE,
+        ttl=AI_INSIGHTS_CACHE_TTL_SEC,
+        max_entries=AI_INSIGHTS_CACHE_MAX_ENTRIES,
+    )
+except Exception as e:
+    print(f"[INIT] AI insights cache disabled: {e}")
+    ai_insights_cache = None
+
+# 単元ごとの分析（AI分析を含む）を並列に実行するスレッドプール（全リクエストで共有）。
+# ANALYSIS_UNIT_TIMEOUT_SEC は1単元ごとではなく1リクエスト全体の待ち時間の上限。
+# 間に合わなかった単元は集計のみの部分結果で返し、分析自体は裏で続けてキャッシュに入れる
+ANALYSIS_WORKERS = max(1, int(os.getenv('ANALYSIS_WORKERS', '8')))
+ANALYSIS_UNIT_TIMEOUT_SEC = float(os.getenv('ANALYSIS_UNIT_TIMEOUT_SEC', '30'))
+_analysis_executor = ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS, thread_name_prefix='analysis')
+
+
+def _new_stage_aggregate():
+    return {
+        'chats': 0,
+        'first_index': None,
+        'samples': [],
+        'messages': 0,
+        'message_samples': [],
+        'length_sum': 0,
+        'length_max': 0,
+        'length_min': None,
+        'length_buckets': {name: {'count': 0, 'length_sum': 0, 'samples': []} for name, _, _ in _LENGTH_BUCKETS},
+        'keywords': {group: {} for group, _ in KEYWORD_PATTERNS},
+        'patterns': {name: 0 for name in PATTERN_KEYWORDS},
+        'science_words': 0,
+        'science_hits': 0,
+        'science_terms': [],
+    }
 
-def analyze_logs_simple(logs):
-    """簡易ログ分析（GCSデータ対応、生成AIで傾向分析とプロンプト改善提案）"""
-    # 正常化: ネストしたリストを再帰的にフラット化して辞書リストにする
+
+def _add_chat_to_aggregate(aggregate, log, index, unit):
+    """会話ログ1件を段階の集計に加える"""
+    data = log.get('data', {})
+    aggregate['chats'] += 1
+    if aggregate['first_index'] is None:
+        aggregate['first_index'] = index
+    message = data.get('user_message', '')
+    if len(aggregate['samples']) < ANALYTICS_SAMPLE_LIMIT:
+        aggregate['samples'].append({
+            'student': f"{log.get('class_num', 0)}_{log.get('seat_num', 0)}",
+            'user_message': message,
+            'ai_response': data.get('ai_response', '')
+        })
+    if not message:
+        return
+    
+    aggregate['messages'] += 1
+    if len(aggregate['message_samples']) < ANALYTICS_SAMPLE_LIMIT:
+        aggregate['message_samples'].append(message)
+    
+    length = len(message)
+    aggregate['length_sum'] += length
+    aggregate['length_max'] = max(aggregate['length_max'], length)
+    aggregate['length_min'] = length if aggregate['length_min'] is None else min(aggregate['length_min'], length)
+    for name, limit, _ in _LENGTH_BUCKETS:
+        if limit is None or length < limit:
+            bucket = aggregate['length_buckets'][name]
+            bucket['count'] += 1
+            bucket['length_sum'] += length
+            if len(bucket['samples']) < ANALYTICS_CLUSTER_SAMPLES:
+                bucket['samples'].append(message)
+            break
+    
+    for group, words in _keyword_groups(message).items():
+        counts = aggregate['keywords'][group]
+        for word in words:
+            counts[word] = counts.get(word, 0) + 1
+    
+    for name, count in KEYWORD_MATCHER.present(message, PATTERN_NAMES).items():
+        aggregate['patterns'][name] += count
+    
+    if unit in SCIENCE_TERM_SETS:
+        words = extract_nouns_and_verbs(message)
+        found = find_science_terms(words, unit)
+        aggregate['science_words'] += len(words)
+        aggregate['science_hits'] += len(found)
+        room = ANALYTICS_SCIENCE_TERM_LIMIT - len(aggregate['science_terms'])
+        aggregate['science_terms'].extend(found[:max(0, room)])
+
+
+def aggregate_day_logs(logs):
+    """1日分の学習ログを単元・段階（予想 / 考察）ごとの集計にまとめる
+    
+    Returns:
+        {'units': [{'unit', 'label', 'log_count', 'stages': {stage: 集計}}]}
+        unit は絞り込み用の値（log['unit']）、label は表示用（無い場合は '不明'）
+    """
     def _flatten(items):
         for it in items:
             if isinstance(it, list):
                 yield from _flatten(it)
             elif isinstance(it, dict):
                 yield it
+    
+    entries = {}
+    for index, log in enumerate(_flatten(logs if isinstance(logs, list) else [])):
+        unit = log.get('unit')
+        label = log.get('unit', '不明')
+        entry = entries.get((unit, label))
+        if entry is None:
+            entry = entries[(unit, label)] = {'unit': unit, 'label': label, 'log_count': 0, 'stages': {}}
+        entry['log_count'] += 1
+        stage = _ANALYSIS_STAGES.get(log.get('log_type'))
+        if stage:
+            if stage not in entry['stages']:
+                entry['stages'][stage] = _new_stage_aggregate()
+            _add_chat_to_aggregate(entry['stages'][stage], log, index, label)
+    return {'units': list(entries.values())}
+
+
+def merge_stage_aggregates(aggregates):
+    """同じ単元・段階の集計（日付順）を1つに合算する"""
+    merged = _new_stage_aggregate()
+    for aggregate in aggregates:
+        merged['chats'] += aggregate['chats']
+        merged['samples'].extend(aggregate['samples'][:ANALYTICS_SAMPLE_LIMIT - len(merged['samples'])])
+        merged['messages'] += aggregate['messages']
+        merged['message_samples'].extend(
+            aggregate['message_samples'][:ANALYTICS_SAMPLE_LIMIT - len(merged['message_samples'])]
+        )
+        merged['length_sum'] += aggregate['length_sum']
+        merged['length_max'] = max(merged['length_max'], aggregate['length_max'])
+        if aggregate['length_min'] is not None:
+            merged['length_min'] = aggregate['length_min'] if merged['length_min'] is None else min(merged['length_min'], aggregate['length_min'])
+        for name, bucket in aggregate['length_buckets'].items():
+            target = merged['length_buckets'][name]
+            target['count'] += bucket['count']
+            target['length_sum'] += bucket['length_sum']
+            target['samples'].extend(bucket['samples'][:ANALYTICS_CLUSTER_SAMPLES - len(target['samples'])])
+        for group, counts in aggregate['keywords'].items():
+            target = merged['keywords'][group]
+            for word, count in counts.items():
+                target[word] = target.get(word, 0) + count
+        for name, count in aggregate['patterns'].items():
+            merged['patterns'][name] += count
+        merged['science_words'] += aggregate['science_words']
+        merged['science_hits'] += aggregate['science_hits']
+        merged['science_terms'].extend(
+            aggregate['science_terms'][:ANALYTICS_SCIENCE_TERM_LIMIT - len(merged['science_terms'])]
+        )
+    return merged
 
-    if isinstance(logs, list):
-        logs = list(_flatten(logs))
-    else:
-        logs = []
-    prediction_logs = [log for log in logs if log.get('log_type') == 'prediction_chat']
-    reflection_logs = [log for log in logs if log.get('log_type') == 'reflection_chat']
+
+def load_day_aggregates(dates):
+    """日別の分析集計を (date, 集計) として dates の順に返す
+    
+    過去日の集計は一度作れば再計算しない。まだ書き込まれうる日（_is_mutable_log_date）は
+    ストレージのログの版が変わったときだけ作り直す。
+    """
+    aggregates = {}
+    versions = {}
+    missing = []
+    for d in dict.fromkeys(dates):
+        mutable = _is_mutable_log_date(d)
+        stored = None
+        if analytics_store is not None:
+            try:
+                stored = analytics_store.get(d)
+            except Exception as e:
+                print(f"[ANALYSIS] aggregate read failed for {d}: {e}")
+        if stored is not None and stored[1].get('closed'):
+            aggregates[d] = stored[1]
+            continue
+        try:
+            versions[d] = storage_backend.log_version(d)
+        except Exception as e:
+            print(f"[ANALYSIS] log version check failed for {d}: {type(e).__name__}: {e}")
+            versions[d] = None
+            missing.append(d)
+            continue
+        if stored is not None and stored[0] == versions[d]:
+            aggregates[d] = stored[1]
+            if not mutable:
+                # 書き込まれなくなった日は以後検証しない
+                stored[1]['closed'] = True
+                try:
+                    analytics_store.put(d, versions[d], stored[1])
+                except Exception as e:
+                    print(f"[ANALYSIS] Failed to store aggregate for {d}: {e}")
+            continue
+        missing.append(d)
+    
+    for d, logs in load_learning_logs_range(missing, on_error=None):
+        if logs is None:
+            # 読み込みに失敗した日は今回だけ空で集計し、保存しない（次回また読み込む）
+            aggregates[d] = aggregate_day_logs([])
+            continue
+        aggregate = aggregate_day_logs(logs)
+        # 版が分からない日は閉じない（次回、版を確かめ直す）
+        aggregate['closed'] = versions.get(d) is not None and not _is_mutable_log_date(d)
+        aggregates[d] = aggregate
+        if analytics_store is not None:
+            try:
+                analytics_store.put(d, versions.get(d), aggregate)
+            except Exception as e:
+                print(f"[ANALYSIS] Failed to store aggregate for {d}: {e}")
+        print(f"[ANALYSIS] Aggregated {len(logs)} logs from {d}")
+    
+    for d in dates:
+        yield d, aggregates[d]
+
+
+def analyze_aggregates(day_aggregates, unit_filter='', refresh_insights=False):
+    """日別集計（日付順）を合算し、analyze_logs_simple と同じ形式の分析結果を返す
+    
+    predictions_by_unit / reflections_by_unit は先頭 ANALYTICS_SAMPLE_LIMIT 件のサンプルで、
+    件数は prediction_counts_by_unit / reflection_counts_by_unit に入る。
+    refresh_insights=True のときは AI分析のキャッシュを使わずに作り直す。
+    """
+    stage_aggregates = {'prediction': {}, 'reflection': {}}
+    total_logs = 0
+    for day in day_aggregates:
+        entries = [e for e in day['units'] if not unit_filter or e['unit'] == unit_filter]
+        total_logs += sum(e['log_count'] for e in entries)
+        for stage, by_unit in stage_aggregates.items():
+            # 単元の並びはその段階の最初のログの順（従来の結果と同じ）
+            staged = sorted((e for e in entries if stage in e['stages']),
+                            key=lambda e: e['stages'][stage]['first_index'])
+            for e in staged:
+                by_unit.setdefault(e['label'], []).append(e['stages'][stage])
+    
+    predictions = {unit: merge_stage_aggregates(aggs) for unit, aggs in stage_aggregates['prediction'].items()}
+    reflections = {unit: merge_stage_aggregates(aggs) for unit, aggs in stage_aggregates['reflection'].items()}
     
     result = {
-        'total_logs': len(logs),
-        'prediction_chats': len(prediction_logs),
-        'reflection_chats': len(reflection_logs),
-        'predictions_by_unit': {},
-        'reflections_by_unit': {},
+        'total_logs': total_logs,
+        'prediction_chats': sum(a['chats'] for a in predictions.values()),
+        'reflection_chats': sum(a['chats'] for a in reflections.values()),
+        'predictions_by_unit': {unit: a['samples'] for unit, a in predictions.items()},
+        'reflections_by_unit': {unit: a['samples'] for unit, a in reflections.items()},
+        'prediction_counts_by_unit': {unit: a['chats'] for unit, a in predictions.items()},
+        'reflection_counts_by_unit': {unit: a['chats'] for unit, a in reflections.items()},
         'text_analysis': {},
         'ai_insights': {},
         'dialogue_clusters': {}
     }
     
-    # 単元ごとに分類
-    for log in prediction_logs:
-        unit = log.get('unit', '不明')
-        if unit not in result['predictions_by_unit']:
-            result['predictions_by_unit'][unit] = []
-        
-        data = log.get('data', {})
-        result['predictions_by_unit'][unit].append({
-            'student': f"{log.get('class_num', 0)}_{log.get('seat_num', 0)}",
-            'user_message': data.get('user_message', ''),
-            'ai_response': data.get('ai_response', '')
-        })
-    
-    for log in reflection_logs:
-        unit = log.get('unit', '不明')
-        if unit not in result['reflections_by_unit']:
-            result['reflections_by_unit'][unit] = []
-        
-        data = log.get('data', {})
-        result['reflections_by_unit'][unit].append({
-            'student': f"{log.get('class_num', 0)}_{log.get('seat_num', 0)}",
-            'user_message': data.get('user_message', ''),
-            'ai_response': data.get('ai_response', '')
-        })
-    
-    # 単元ごとのテキスト分析とAI分析
-    for unit in result['predictions_by_unit']:
-        prediction_messages = [
-            p['user_message'] for p in result['predictions_by_unit'][unit] if p['user_message']
-        ]
-        reflection_messages = [
-            r['user_message'] for r in result.get('reflections_by_unit', {}).get(unit, [])
-            if r['user_message']
-        ]
-        
-        # テキスト統計分析
-        result['text_analysis'][unit] = {
-            'prediction': analyze_text(prediction_messages, unit),
-            'reflection': analyze_text(reflection_messages, unit)
-        }
-        
-        # 対話パターンのクラスタリング
-        all_messages = prediction_messages + reflection_messages
-        clustering_result = cluster_dialogue_patterns(all_messages)
-        result['dialogue_clusters'][unit] = clustering_result
-        print(f"[CLUSTERING] Unit '{unit}': {clustering_result.get('cluster_count', 0)} clusters found")
-        
-        # 生成AIで傾向分析とプロンプト改善提案
+    # 単元ごとのテキスト分析とAI分析を並列に実行（待ち時間は最も遅い単元の分だけ）
+    units = [(unit, prediction, reflections.get(unit) or _new_stage_aggregate())
+             for unit, prediction in predictions.items()]
+    futures = [
+        _analysis_executor.submit(_analyze_unit, unit, prediction, reflection, refresh_insights)
+        for unit, prediction, reflection in units
+    ]
+    # 待ち時間はリクエスト全体で ANALYSIS_UNIT_TIMEOUT_SEC まで
+    # （プールは他のリクエストと共有なので、単元数から待ち時間を見積もらない）
+    deadline = time.monotonic() + ANALYSIS_UNIT_TIMEOUT_SEC
+    timed_out = []
+    for (unit, prediction, reflection), future in zip(units, futures):
         try:
-            ai_analysis = generate_ai_insights(prediction_messages, reflection_messages, unit)
-            result['ai_insights'][unit] = ai_analysis
-        except Exception as e:
-            print(f"[AI_INSIGHTS] Error for {unit}: {e}")
-            result['ai_insights'][unit] = {
-                'error': str(e),
-                'analysis_text': 'AI分析に失敗しました'
+            text_analysis, clustering_result, ai_analysis = future.result(timeout=max(0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            # 間に合わなかった単元は集計だけで返す。キャンセルはせず、実行待ちの単元も
+            # 裏で最後まで分析させて、AI分析をキャッシュに残す（次回の表示で使われる）
+            timed_out.append(unit)
+            print(f"[ANALYSIS] Unit '{unit}' not finished within the {ANALYSIS_UNIT_TIMEOUT_SEC}s request deadline")
+            text_analysis, clustering_result, _ = _analyze_unit(unit, prediction, reflection, refresh_insights,
+                                                                with_insights=False)
+            ai_analysis = {
+                'error': 'timeout',
+                'analysis_text': 'AI分析が時間内に終わりませんでした。しばらくしてから再度読み込んでください',
+                'prediction_count': prediction['messages'],
+                'reflection_count': reflection['messages'],
+                'timed_out': True
             }
+        result['text_analysis'][unit] = text_analysis
+        result['dialogue_clusters'][unit] = clustering_result
+        result['ai_insights'][unit] = ai_analysis
     
+    if timed_out:
+        result['partial'] = True
+        result['timed_out_units'] = timed_out
     return result
 
 
-def generate_ai_insights(prediction_messages, reflection_messages, unit):
-    """OpenAI APIで傾向分析とプロンプト改善提案を生成"""
+def _analyze_unit(unit, prediction, reflection, refresh_insights, with_insights=True):
+    """1単元分のテキスト分析・クラスタリング・AI分析"""
+    # テキスト統計分析
+    text_analysis = {
+        'prediction': _text_analysis_from_aggregate(prediction, unit),
+        'reflection': _text_analysis_from_aggregate(reflection, unit)
+    }
+    
+    # 対話パターンのクラスタリング
+    clustering_result = _clusters_from_aggregates(prediction, reflection)
+    if not with_insights:
+        return text_analysis, clustering_result, None
+    print(f"[CLUSTERING] Unit '{unit}': {clustering_result.get('cluster_count', 0)} clusters found")
+    
+    # 生成AIで傾向分析とプロンプト改善提案
+    try:
+        ai_analysis = generate_ai_insights(
+            prediction['message_samples'], reflection['message_samples'], unit,
+            prediction_count=prediction['messages'], reflection_count=reflection['messages'],
+            refresh=refresh_insights,
+        )
+    except Exception as e:
+        print(f"[AI_INSIGHTS] Error for {unit}: {e}")
+        ai_analysis = {
+            'error': str(e),
+            'analysis_text': 'AI分析に失敗しました'
+        }
+    return text_analysis, clustering_result, ai_analysis
+
+
+def _text_analysis_from_aggregate(aggregate, unit):
+    """段階の集計から analyze_text と同じ形式のテキスト分析を作る"""
+    if not aggregate['messages']:
+        return analyze_text([], unit)
+    
+    word_freq = Counter()
+    for counts in aggregate['keywords'].values():
+        word_freq.update(counts)
+    
+    science_term_ratio = 0.0
+    science_terms_found = []
+    if unit and unit in SCIENCE_TERMS and aggregate['science_words']:
+        science_term_ratio = aggregate['science_hits'] / aggregate['science_words'] * 100
+        science_terms_found = aggregate['science_terms']
+    
+    return {
+        'total_messages': aggregate['messages'],
+        'average_length': aggregate['length_sum'] / aggregate['messages'],
+        'max_length': aggregate['length_max'],
+        'min_length': aggregate['length_min'],
+        'keywords': [{'word': word, 'count': count} for word, count in word_freq.most_common(10)],  # トップ10
+        'patterns': dict(aggregate['patterns']),
+        'science_term_ratio': round(science_term_ratio, 2),
+        'science_terms': science_terms_found[:ANALYTICS_SCIENCE_TERM_LIMIT]  # トップ15
+    }
+
+
+def _clusters_from_aggregates(prediction, reflection):
+    """予想・考察の集計から cluster_dialogue_patterns と同じ形式の結果を作る"""
+    total_messages = prediction['messages'] + reflection['messages']
+    if total_messages < 3:
+        return cluster_dialogue_patterns([])
+    
+    result_clusters = []
+    for name, _, label in _LENGTH_BUCKETS:
+        first = prediction['length_buckets'][name]
+        second = reflection['length_buckets'][name]
+        count = first['count'] + second['count']
+        if count:
+            result_clusters.append({
+                'label': label,
+                'count': count,
+                'samples': (first['samples'] + second['samples'])[:ANALYTICS_CLUSTER_SAMPLES],
+                'avg_length': (first['length_sum'] + second['length_sum']) / count
+            })
+    return {
+        'clusters': result_clusters,
+        'cluster_count': len(result_clusters),
+        'total_messages': total_messages
+    }
+
+
+def analyze_logs_simple(logs):
+    """簡易ログ分析（GCSデータ対応、生成AIで傾向分析とプロンプト改善提案）"""
+    return analyze_aggregates([aggregate_day_logs(logs)])
+
+
+def generate_ai_insights(prediction_messages, reflection_messages, unit, prediction_count=None, reflection_count=None,
+                         refresh=False):
+    """OpenAI APIで傾向分析とプロンプト改善提案を生成
+    
+    同じ単元・同じサンプルの結果は ai_insights_cache から返す（refresh=True で作り直す）。
+    
+    prediction_count / reflection_count: 全体の件数（メッセージをサンプルだけ渡す場合）
+    """
+    if prediction_count is None:
+        prediction_count = len(prediction_messages)
+    if reflection_count is None:
+        reflection_count = len(reflection_messages)
     try:
         # サンプルデータを作成（最大20件ずつ）
         pred_sample = prediction_messages[:20] if len(prediction_messages) > 20 else prediction_messages
@@ -3008,6 +3508,23 @@ def generate_ai_insights(prediction_messages, reflection_messages, unit):
                 'reflection_count': 0
             }
         
+        cache_key = insight_key(unit, AI_INSIGHTS_MODEL, AI_INSIGHTS_PROMPT_VERSION, [pred_sample, refl_sample])
+        if ai_insights_cache is not None and not refresh:
+            try:
+                cached = ai_insights_cache.get(cache_key)
+            except Exception as e:
+                print(f"[AI_ANALYSIS] Cache read failed: {e}")
+                cached = None
+            if cached is not None:
+                print(f"[AI_ANALYSIS] Cache hit for unit: {unit}")
+                return {
+                    'analysis_text': cached['analysis_text'],
+                    'prediction_count': prediction_count,
+                    'reflection_count': reflection_count,
+                    'sample_size': cached['sample_size'],
+                    'cached': True
+                }
+        
         # プロンプトを構築
         analysis_prompt = f"""以下は理科の単元「{unit}」における児童の予想と考察の記録です。
 
@@ -3028,7 +3545,7 @@ def generate_ai_insights(prediction_messages, reflection_messages, unit):
         
         # OpenAI APIで分析
         response = client.chat.completions.create(
-            model="gpt-4o-mini",
+            model=AI_INSIGHTS_MODEL,
             messages=[
                 {"role": "system", "content": "あなたは小学校の理科教員です。児童の学習ログから対話パターンを分析し、プロンプト改善を提案します。"},
                 {"role": "user", "content": analysis_prompt}
@@ -3039,12 +3556,19 @@ def generate_ai_insights(prediction_messages, reflection_messages, unit):
         
         ai_response = response.choices[0].message.content.strip()
         print(f"[AI_ANALYSIS] OpenAI response received: {len(ai_response)} chars")
+        sample_size = f"予想{len(pred_sample)}件、考察{len(refl_sample)}件を分析"
+        
+        if ai_insights_cache is not None:
+            try:
+                ai_insights_cache.put(cache_key, {'analysis_text': ai_response, 'sample_size': sample_size})
+            except Exception as e:
+                print(f"[AI_ANALYSIS] Cache write failed: {e}")
         
         return {
             'analysis_text': ai_response,
-            'prediction_count': len(prediction_messages),
-            'reflection_count': len(reflection_messages),
-            'sample_size': f"予想{len(pred_sample)}件、考察{len(refl_sample)}件を分析"
+            'prediction_count': prediction_count,
+            'reflection_count': reflection_count,
+            'sample_size': sample_size
         }
         
     except Exception as e:
@@ -3053,8 +3577,8 @@ def generate_ai_insights(prediction_messages, reflection_messages, unit):
         traceback.print_exc()
         return {
             'analysis_text': f'AI分析でエラーが発生しました: {str(e)}',
-            'prediction_count': len(prediction_messages),
-            'reflection_count': len(reflection_messages),
+            'prediction_count': prediction_count,
+            'reflection_count': reflection_count,
             'error': str(e)
         }
 
@@ -3170,32 +3694,48 @@ def analyze_text(messages, unit=None):
         return {'error': str(e)}
 
 
+# キーワード抽出：3文字以上の連続した仮名・2文字以上の漢字（この順で数える）
+KEYWORD_PATTERNS = (
+    ('hiragana', re.compile(r'[ぁ-ん]{3,}')),
+    ('katakana', re.compile(r'[ァ-ヴー]{3,}')),
+    ('kanji', re.compile(r'[\u4e00-\u9fff]{2,}')),
+)
+# ストップワード（一般的な助詞などを除外）
+KEYWORD_STOPWORDS = {'思う', 'ます', 'です', 'ある', 'する', 'なる', 'いる', 'できる', 'みたい', 'ような', 'いっぱい', 'すごく'}
+
+# 表現パターンとその手がかりになる語
+PATTERN_KEYWORDS = {
+    'prediction_expressions': ['思う', 'と思う', 'だと思う', 'と予想'],   # 「〜だと思う」「〜と思う」など
+    'causal_expressions': ['だから', 'なぜなら', 'ので', 'わけ'],         # 「〜だから」「なぜなら」など
+    'comparison_expressions': ['より', 'ほうが', '比べて', 'より大きい'],  # 「〜より」「〜ほうが」など
+    'experience_references': ['前に', 'この前', '経験', 'やったことある'],  # 「前に」「この前」など
+    'uncertainty_expressions': ['たぶん', 'かもしれない', 'わからない', 'かな'],  # 「たぶん」「かもしれない」など
+}
+
+PATTERN_NAMES = tuple(PATTERN_KEYWORDS)
+
+# 表現パターンと has_substantive_content の語をまとめた照合器（共通の語は1回だけ照合する）
+KEYWORD_MATCHER = KeywordMatcher({**PATTERN_KEYWORDS, 'substantive': SUBSTANTIVE_KEYWORDS})
+
+
+def _keyword_groups(text):
+    """テキストから種類（ひらがな・カタカナ・漢字）ごとのキーワード候補を抽出"""
+    return {
+        group: [w for w in pattern.findall(text) if w not in KEYWORD_STOPWORDS]
+        for group, pattern in KEYWORD_PATTERNS
+    }
+
+
 def extract_keywords(messages):
     """キーワード抽出（日本語対応）"""
     try:
-        import re
-        from collections import Counter
-        
         # 複合メッセージを結合
         combined_text = ' '.join(messages)
         
-        # ひらがなとカタカナの単語を抽出
-        # 3文字以上の連続した仮名を抽出
-        hiragana_pattern = r'[ぁ-ん]{3,}'
-        katakana_pattern = r'[ァ-ヴー]{3,}'
-        kanji_pattern = r'[\u4e00-\u9fff]{2,}'
-        
-        words = []
-        words.extend(re.findall(hiragana_pattern, combined_text))
-        words.extend(re.findall(katakana_pattern, combined_text))
-        words.extend(re.findall(kanji_pattern, combined_text))
-        
-        # ストップワード（一般的な助詞などを除外）
-        stopwords = {'思う', 'ます', 'です', 'ある', 'する', 'なる', 'いる', 'できる', 'みたい', 'ような', 'いっぱい', 'すごく'}
-        words = [w for w in words if w not in stopwords]
-        
-        # 頻度を計算
-        word_freq = Counter(words)
+        # 頻度を計算（ひらがな → カタカナ → 漢字の順に数える）
+        word_freq = Counter()
+        for words in _keyword_groups(combined_text).values():
+            word_freq.update(words)
         
         # 頻度順に返す
         return [{'word': word, 'count': count} for word, count in word_freq.most_common()]
@@ -3208,38 +3748,7 @@ def extract_keywords(messages):
 def detect_patterns(messages):
     """パターン検出（予想の表現、因果関係など）"""
     try:
-        patterns = {
-            'prediction_expressions': 0,  # 「〜だと思う」「〜と思う」など
-            'causal_expressions': 0,      # 「〜だから」「なぜなら」など
-            'comparison_expressions': 0,   # 「〜より」「〜ほうが」など
-            'experience_references': 0,    # 「前に」「この前」など
-            'uncertainty_expressions': 0  # 「たぶん」「かもしれない」など
-        }
-        
-        prediction_keywords = ['思う', 'と思う', 'だと思う', 'と予想']
-        causal_keywords = ['だから', 'なぜなら', 'ので', 'わけ']
-        comparison_keywords = ['より', 'ほうが', '比べて', 'より大きい']
-        experience_keywords = ['前に', 'この前', '経験', 'やったことある']
-        uncertainty_keywords = ['たぶん', 'かもしれない', 'わからない', 'かな']
-        
-        for message in messages:
-            for keyword in prediction_keywords:
-                if keyword in message:
-                    patterns['prediction_expressions'] += 1
-            for keyword in causal_keywords:
-                if keyword in message:
-                    patterns['causal_expressions'] += 1
-            for keyword in comparison_keywords:
-                if keyword in message:
-                    patterns['comparison_expressions'] += 1
-            for keyword in experience_keywords:
-                if keyword in message:
-                    patterns['experience_references'] += 1
-            for keyword in uncertainty_keywords:
-                if keyword in message:
-                    patterns['uncertainty_expressions'] += 1
-        
-        return patterns
+        return KEYWORD_MATCHER.present_many(messages, PATTERN_NAMES)
     
     except Exception as e:
         print(f"[PATTERN_DETECTION] Error: {e}")
@@ -3279,144 +3788,116 @@ def api_student_history():
     return jsonify(history_data)
 
 def load_student_history(student_id):
-    """学習者の履歴を読み込む（GCS/Firestore優先、ローカルはフォールバック）
+    """学習者の履歴を読み込む（ストレージバックエンド経由）
     
-    会話データは以下の優先順で取得：
-    1. サマリーストレージ（最近のデータ）
-    2. 学習ログから直接抽出（既存のデータの補完）
+    サマリー保存・セッション保存のたびに差分更新される履歴ドキュメントを
+    1回の読み込みで返す。ドキュメントが無い（または形式が古い）場合だけ
+    サマリー・セッション・学習ログから作り直して保存する。
     """
-    history = {}
+    doc = storage_backend.load_history(student_id)
+    if not is_current_history_doc(doc):
+        with get_lock_for_path(f"history:{student_id}"):
+            doc = _build_student_history_doc(student_id)
+            if doc['summaries'] or doc['conversations']:
+                built = doc
+                try:
+                    # 他のプロセスが先に作った（または更新した）ドキュメントは上書きしない
+                    storage_backend.update_history(
+                        student_id, lambda current: None if is_current_history_doc(current) else built
+                    )
+                except Exception as e:
+                    print(f"[HISTORY] Failed to save history document for {student_id}: {e}")
+    return render_history(doc)
+
+
+def _update_student_history(student_id, apply, build_missing=True):
+    """履歴ドキュメントを差分更新する（失敗しても元の保存は成功扱い）
     
-    # GCSから読み込み
-    if USE_GCS and bucket:
-        try:
-            # summariesディレクトリ内の該当学習者のファイルを列挙
-            blobs = list(bucket.list_blobs(prefix=f"summaries/{student_id}_"))
-            print(f"[HISTORY] GCS: found {len(blobs)} summary blobs for {student_id}")
-            
-            for blob in blobs:
-                # ファイル名から単元とステージを抽出
-                # 形式: summaries/{student_id}_{unit}_{stage}
-                filename = blob.name.replace(f"summaries/{student_id}_", "")
-                parts = filename.rsplit("_", 1)
-                
-                if len(parts) == 2:
-                    unit, stage = parts[0], parts[1]
-                    
-                    try:
-                        data = json.loads(blob.download_as_string().decode('utf-8'))
-                        
-                        if unit not in history:
-                            history[unit] = {}
-                        
-                        history[unit][stage] = data
-                        print(f"[HISTORY] GCS loaded {unit}/{stage}")
-                    except Exception as e:
-                        print(f"[HISTORY] Error reading blob {blob.name}: {e}")
-            
-            # GCS からサマリーが見つかった場合、会話を補完して返す
-            if history:
-                print(f"[HISTORY] GCS: supplementing conversations")
-                _supplement_conversation_from_logs(history, student_id)
-                return history
-            else:
-                print(f"[HISTORY] GCS: no summaries found, falling back to local")
-        except Exception as e:
-            print(f"[HISTORY] GCS read failed: {e}, falling back to local")
+    読み込み・更新・書き込みはバックエンドの update_history で不可分に行うので、
+    複数のプロセス（gunicorn ワーカー・Cloud Run インスタンス・RQ ワーカー）からの
+    同時更新で他の更新が失われない。更新できなかったときはドキュメントを無効にし、
+    次の表示で作り直させる。
     
-    # ローカルJSONから読み込み
+    Args:
+        student_id: 学習者ID
+        apply: ドキュメントを更新する関数（競合時は読み直したドキュメントで再度呼ばれる）
+        build_missing: ドキュメントが無いときに全体から作るか
+            （作る場合は保存済みのデータから組み立てるので apply は不要）
+    """
     try:
-        summary_file = 'summary_storage.json'
-        
-        if os.path.exists(summary_file):
-            with open(summary_file, 'r', encoding='utf-8') as f:
-                all_summaries = json.load(f)
-            
-            # 該当学習者のみ抽出
-            for key, data in all_summaries.items():
-                if key.startswith(student_id + "_"):
-                    parts = key.replace(student_id + "_", "").rsplit("_", 1)
-                    
-                    if len(parts) == 2:
-                        unit, stage = parts[0], parts[1]
-                        
-                        if unit not in history:
-                            history[unit] = {}
-                        
-                        history[unit][stage] = data
-                        print(f"[HISTORY] Local loaded {unit}/{stage}")
+        built = None
+        if build_missing and not is_current_history_doc(storage_backend.load_history(student_id)):
+            # 組み立ては時間がかかるので排他の外で行う
+            built = _build_student_history_doc(student_id)
+
+        def mutate(doc):
+            if is_current_history_doc(doc):
+                apply(doc)
+                return doc
+            return built
+
+        storage_backend.update_history(student_id, mutate)
     except Exception as e:
-        print(f"[HISTORY] Local read failed: {e}")
-    
-    # 会話データを補完（学習ログまたはセッションストレージから）
-    _supplement_conversation_from_logs(history, student_id)
-    
-    return history
+        print(f"[HISTORY] Failed to update history document for {student_id}: {e}")
+        try:
+            storage_backend.save_history(student_id, invalidated_history_doc())
+        except Exception as e:
+            print(f"[HISTORY] Failed to invalidate history document for {student_id}: {e}")
 
 
-def _supplement_conversation_from_logs(history, student_id):
-    """学習ログから会話データを取得して、履歴に補完する
+def _build_student_history_doc(student_id):
+    """サマリー・セッション・学習ログから履歴ドキュメントを組み立てる
     
-    優先順：
-    1. セッションストレージから取得
-    2. 学習ログから直接抽出（GCS または ローカル）
+    会話データは以下の優先順で取得：
+    1. サマリーストレージ（サマリーと一緒に保存された会話）
+    2. セッションストレージ
+    3. 学習ログから直接抽出（既存のデータの補完）
     """
+    doc = new_history_doc()
+    for stages in storage_backend.load_student_summaries(student_id).values():
+        for entry in stages.values():
+            apply_summary(doc, entry)
+    
     try:
-        # セッションストレージから取得
-        sessions = _read_json_file(SESSION_STORAGE_FILE)
-        if sessions:
-            for key, session_data in sessions.items():
-                if key.startswith(student_id + "_"):
-                    parts = key.replace(student_id + "_", "").rsplit("_", 1)
-                    if len(parts) == 2:
-                        unit, stage = parts[0], parts[1]
-                        if unit in history and stage in history[unit]:
-                            if 'conversation' not in history[unit][stage]:
-                                conversation = session_data.get('conversation', [])
-                                if conversation:
-                                    history[unit][stage]['conversation'] = conversation
-                                    print(f"[HISTORY] Supplemented {unit}/{stage} with {len(conversation)} messages from session")
+        sessions = storage_backend.load_student_sessions(student_id)
+        for unit, stages in sessions.items():
+            for stage, session_data in stages.items():
+                apply_conversation(doc, unit, stage, session_data.get('conversation', []))
     except Exception as e:
         print(f"[HISTORY] Error reading session storage: {e}")
     
-    # セッションストレージでも見つからない場合、学習ログから抽出
-    # GCS から学習ログを読み込み
-    if USE_GCS and bucket:
-        try:
-            # 学習ログファイルを列挙
-            blobs = list(bucket.list_blobs(prefix="logs/learning_log_"))
-            print(f"[HISTORY] GCS: found {len(blobs)} log files")
-            
-            for blob in blobs:
-                try:
-                    content = blob.download_as_string()
-                    logs = json.loads(content.decode('utf-8'))
-                    
-                    _extract_conversations_from_logs(logs, student_id, history)
-                except Exception as e:
-                    print(f"[HISTORY] Error reading GCS log {blob.name}: {e}")
-            
-            # 会話が補完されたら終了
-            if _has_conversations(history):
-                return
-        except Exception as e:
-            print(f"[HISTORY] GCS log read failed: {e}, falling back to local")
-    
-    # ローカル学習ログから抽出
+    history = render_history(doc)
+    if any('conversation' not in entry for stages in history.values() for entry in stages.values()):
+        _supplement_conversation_from_logs(history, student_id)
+        for unit, stages in history.items():
+            for stage, entry in stages.items():
+                if 'conversation' in entry and 'conversation' not in doc['summaries'][unit][stage]:
+                    if not doc['conversations'].get(unit, {}).get(stage):
+                        apply_conversation(doc, unit, stage, entry['conversation'])
+    return doc
+
+
+def _supplement_conversation_from_logs(history, student_id):
+    """学習ログから会話データを抽出して、会話の無い履歴エントリに補完する"""
     try:
-        log_files = glob.glob('logs/learning_log_*.json')
-        print(f"[HISTORY] Local: found {len(log_files)} log files")
+        log_dates = sorted(storage_backend.list_log_dates())
+        print(f"[HISTORY] found {len(log_dates)} log dates")
+        
+        class_part, _, seat_part = str(student_id).partition('_')
+        if class_part.isdigit() and seat_part.isdigit():
+            # 学習者インデックスでこの学習者のログだけを読む
+            logs = load_student_logs(int(class_part), int(seat_part), log_dates)
+            _extract_conversations_from_logs(logs, student_id, history)
+            return
         
-        for log_file in log_files:
+        for log_date in log_dates:
             try:
-                with open(log_file, 'r', encoding='utf-8') as f:
-                    logs = json.load(f)
-                
+                logs = storage_backend.load_logs(log_date) or []
                 _extract_conversations_from_logs(logs, student_id, history)
             except Exception as e:
-                print(f"[HISTORY] Error reading local log {log_file}: {e}")
+                print(f"[HISTORY] Error reading log {log_date}: {e}")
     except Exception as e:
-        print(f"[HISTORY] Local log read failed: {e}")
+        print(f"[HISTORY] Log read failed: {e}")
 
 
 def _extract_conversations_from_logs(logs, student_id, history):
@@ -0,0 +1,83 @@
+"""Per-day analytics aggregates of the learning logs.
+
+The analysis dashboard reduces each day's logs to small per-(unit, stage)
+aggregates (counts, length buckets, keyword and pattern counts, science
+term hits, a few sample messages). Each aggregate is stored together with
+the storage's ``log_version`` of the day it was built from, so a closed
+day is computed once and the current day is recomputed only after new
+logs arrived. Analysis over a date range then merges the stored
+aggregates instead of re-reading raw logs.
+
+The aggregates live in their own SQLite (WAL) file and can be deleted at
+any time; they are rebuilt on the next read.
+"""
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS day_aggregates (
+    date TEXT PRIMARY KEY,
+    format INTEGER NOT NULL,
+    log_version TEXT,
+    data TEXT NOT NULL,
+    computed_at TEXT NOT NULL
+);
+"""
+
+
+class DailyAggregateStore:
+    """SQLite-backed ``date -> aggregate`` table.
+
+    Args:
+        path: SQLite file
+        format_version: layout version of the aggregates; rows of another
+            version are treated as missing
+    """
+
+    def __init__(self, path: str, format_version: int, timeout: float = 30.0):
+        self.path = path
+        self.format_version = format_version
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # the file is created on first use, not when the store is constructed
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def get(self, date: str) -> Optional[Tuple[Optional[str], Dict[str, Any]]]:
+        """``(log_version, aggregate)`` of `date`, or None when not stored."""
+        row = self._conn().execute(
+            "SELECT log_version, data FROM day_aggregates WHERE date = ? AND format = ?",
+            (date, self.format_version),
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def put(self, date: str, log_version: Optional[str], aggregate: Dict[str, Any]) -> None:
+        self._conn().execute(
+            "INSERT INTO day_aggregates (date, format, log_version, data, computed_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(date) DO UPDATE SET format=excluded.format, log_version=excluded.log_version, "
+            "data=excluded.data, computed_at=excluded.computed_at",
+            (date, self.format_version, log_version,
+             json.dumps(aggregate, ensure_ascii=False, separators=(',', ':')),
+             datetime.now(timezone.utc).isoformat()),
+        )
+
+    def clear(self) -> None:
+        with self._conn() as conn:
+            conn.execute("DELETE FROM day_aggregates")
@@ -0,0 +1,1173 @@
+"""Pluggable storage backends.
+
+``app.py`` talks to exactly one :class:`StorageBackend`, selected once at
+start-up by :func:`build_backend`. Backends are chained: each one handles
+the data it stores and hands everything else -- or anything that fails or
+is not found -- to its ``fallback``::
+
+    FirestoreBackend   sessions / summaries / progress
+      -> GCSBackend    sessions / summaries / learning logs / error logs
+        -> LocalBackend  everything (JSON files, JSONL segments or SQLite)
+
+:class:`InMemoryBackend` keeps everything in process memory, for
+benchmarks and experiments without cloud credentials.
+
+Session and summary entries are dicts carrying ``student_id``, ``unit`` and
+``stage``; they are stored under the key ``{student_id}_{unit}_{stage}``.
+"""
+import copy
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    from typing import Protocol
+except ImportError:  # pragma: no cover - Python < 3.8
+    Protocol = object
+
+from .local_files import atomic_write_json, exclusive_lock, read_json_file
+
+Entry = Dict[str, Any]
+# {unit: {stage: entry}}
+StudentEntries = Dict[str, Dict[str, Entry]]
+# stored history document (or None) -> document to store (None: leave as is).
+# May be called more than once when a concurrent writer wins the race.
+HistoryMutation = Callable[[Optional[Dict[str, Any]]], Optional[Dict[str, Any]]]
+
+
+def entry_key(entry: Entry) -> str:
+    return f"{entry['student_id']}_{entry['unit']}_{entry['stage']}"
+
+
+def _group_student_entries(entries: Dict[str, Entry], student_id: str) -> StudentEntries:
+    """Group ``{key: entry}`` of one student into ``{unit: {stage: entry}}``."""
+    grouped: StudentEntries = {}
+    prefix = f"{student_id}_"
+    for key, entry in entries.items():
+        if not key.startswith(prefix) or not isinstance(entry, dict):
+            continue
+        parts = key[len(prefix):].rsplit('_', 1)
+        if len(parts) != 2:
+            continue
+        unit, stage = parts
+        grouped.setdefault(unit, {})[stage] = entry
+    return grouped
+
+
+def _flatten_logs(items):
+    """Recursively flatten nested lists, keeping only dict entries."""
+    for it in items:
+        if isinstance(it, list):
+            yield from _flatten_logs(it)
+        elif isinstance(it, dict):
+            yield it
+
+
+class StorageBackend(Protocol):
+    """Operations every storage backend provides."""
+
+    name: str
+
+    # sessions
+    def save_session(self, entry: Entry) -> None: ...
+    def load_session(self, student_id: str, unit: str, stage: str) -> Optional[List[Dict[str, Any]]]: ...
+    def load_student_sessions(self, student_id: str) -> StudentEntries: ...
+
+    # summaries
+    def save_summary(self, entry: Entry) -> None: ...
+    def load_student_summaries(self, student_id: str) -> StudentEntries: ...
+
+    # learning progress {student_id: {unit: {...}}}
+    def load_progress(self) -> Dict[str, Dict[str, Any]]: ...
+    def save_progress(self, progress: Dict[str, Dict[str, Any]]) -> None: ...
+    def load_student_progress(self, student_id: str) -> Optional[Dict[str, Any]]: ...
+    def save_student_progress(self, student_id: str, data: Dict[str, Any]) -> None: ...
+    def delete_student_progress(self, student_id: str) -> None: ...
+
+    # materialized per-student history document
+    def load_history(self, student_id: str) -> Optional[Dict[str, Any]]: ...
+    def save_history(self, student_id: str, doc: Dict[str, Any]) -> None: ...
+    def update_history(self, student_id: str, mutate: HistoryMutation) -> None: ...
+
+    # daily learning logs
+    def append_log(self, date: str, entry: Entry) -> Optional[str]: ...
+    def load_logs(self, date: str) -> Optional[List[Entry]]: ...
+    def list_log_dates(self) -> List[str]: ...
+    def log_version(self, date: str) -> Optional[str]: ...
+
+    # daily error logs
+    def append_error(self, date: str, entry: Entry) -> None: ...
+    def load_errors(self, date: str) -> Optional[List[Entry]]: ...
+
+
+class ChainedBackend:
+    """Base class: every operation not overridden goes to ``fallback``."""
+
+    name = 'chained'
+
+    def __init__(self, fallback: Optional['ChainedBackend'] = None):
+        self.fallback = fallback
+
+    def _next(self, op: str) -> 'ChainedBackend':
+        if self.fallback is None:
+            raise NotImplementedError(f"{self.name} backend does not support {op}")
+        return self.fallback
+
+    def describe(self) -> str:
+        chain = [self.name]
+        backend = self.fallback
+        while backend is not None:
+            chain.append(backend.name)
+            backend = backend.fallback
+        return ' -> '.join(chain)
+
+    def save_session(self, entry):
+        self._next('save_session').save_session(entry)
+
+    def load_session(self, student_id, unit, stage):
+        return self._next('load_session').load_session(student_id, unit, stage)
+
+    def load_student_sessions(self, student_id):
+        return self._next('load_student_sessions').load_student_sessions(student_id)
+
+    def save_summary(self, entry):
+        self._next('save_summary').save_summary(entry)
+
+    def load_student_summaries(self, student_id):
+        return self._next('load_student_summaries').load_student_summaries(student_id)
+
+    def load_progress(self):
+        return self._next('load_progress').load_progress()
+
+    def save_progress(self, progress):
+        self._next('save_progress').save_progress(progress)
+
+    def load_student_progress(self, student_id):
+        return self._next('load_student_progress').load_student_progress(student_id)
+
+    def save_student_progress(self, student_id, data):
+        self._next('save_student_progress').save_student_progress(student_id, data)
+
+    def delete_student_progress(self, student_id):
+        self._next('delete_student_progress').delete_student_progress(student_id)
+
+    def load_history(self, student_id):
+        return self._next('load_history').load_history(student_id)
+
+    def save_history(self, student_id, doc):
+        self._next('save_history').save_history(student_id, doc)
+
+    def update_history(self, student_id, mutate):
+        """Atomically replace the history document with ``mutate(current)``."""
+        self._next('update_history').update_history(student_id, mutate)
+
+    def append_log(self, date, entry):
+        return self._next('append_log').append_log(date, entry)
+
+    def load_logs(self, date):
+        return self._next('load_logs').load_logs(date)
+
+    def list_log_dates(self):
+        return self._next('list_log_dates').list_log_dates()
+
+    def log_version(self, date):
+        """Token that changes whenever the day's logs change; None when the day has no logs."""
+        return self._next('log_version').log_version(date)
+
+    def append_error(self, date, entry):
+        self._next('append_error').append_error(date, entry)
+
+    def load_errors(self, date):
+        return self._next('load_errors').load_errors(date)
+
+
+# ----------------------------------------------------------------------
+# Local files
+# ----------------------------------------------------------------------
+class LocalBackend(ChainedBackend):
+    """JSON files (or SQLite) for sessions/summaries/progress, files for logs.
+
+    Args:
+        log_dir: directory of ``learning_log_*`` / ``error_log_*`` files
+        session_file / summary_file / progress_file: legacy JSON documents
+        history_dir: directory of per-student history documents (JSON engine)
+        db: optional :class:`storage.sqlite_store.SQLiteStore` replacing the JSON documents
+        log_format: ``'json'`` (daily array) or ``'jsonl'`` (append-only segments)
+        segments: :class:`storage.jsonl_segments.SegmentedLogStore` for learning logs
+    """
+
+    name = 'local'
+
+    def __init__(self, log_dir='logs', session_file='session_storage.json',
+                 summary_file='summary_storage.json', progress_file='learning_progress.json',
+                 db=None, log_format='json', segments=None, history_dir='student_history'):
+        super().__init__(fallback=None)
+        self.log_dir = log_dir
+        self.history_dir = history_dir
+        self.session_file = session_file
+        self.summary_file = summary_file
+        self.progress_file = progress_file
+        self.db = db
+        self.log_format = log_format
+        self.segments = segments
+
+    # sessions ----------------------------------------------------------
+    def save_session(self, entry):
+        key = entry_key(entry)
+        try:
+            if self.db is not None:
+                self.db.put_session(key, entry)
+                print(f"[SESSION_SAVE] SQLite - {key}")
+                return
+            sessions = read_json_file(self.session_file) or {}
+            sessions[key] = entry
+            atomic_write_json(self.session_file, sessions)
+            print(f"[SESSION_SAVE] Local - {key}")
+        except Exception as e:
+            print(f"[SESSION_SAVE] Local Error: {e}")
+
+    def load_session(self, student_id, unit, stage):
+        key = f"{student_id}_{unit}_{stage}"
+        try:
+            if self.db is not None:
+                entry = self.db.get_session(key)
+            else:
+                entry = (read_json_file(self.session_file) or {}).get(key)
+            if entry:
+                print(f"[SESSION_LOAD] Local - {key}")
+                return entry.get('conversation', [])
+        except Exception as e:
+            print(f"[SESSION_LOAD] Local Error: {e}")
+        return []
+
+    def load_student_sessions(self, student_id):
+        try:
+            if self.db is not None:
+                sessions = self.db.sessions_for_student(student_id)
+            else:
+                sessions = read_json_file(self.session_file) or {}
+            return _group_student_entries(sessions, student_id)
+        except Exception as e:
+            print(f"[HISTORY] Error reading session storage: {e}")
+            return {}
+
+    # summaries ---------------------------------------------------------
+    def save_summary(self, entry):
+        key = entry_key(entry)
+        try:
+            if self.db is not None:
+                self.db.put_summary(key, entry)
+                print(f"[SUMMARY_SAVE_LOCAL] {key} saved to SQLite")
+                return
+            if os.path.exists(self.summary_file):
+                with open(self.summary_file, 'r', encoding='utf-8') as f:
+                    summaries = json.load(f)
+            else:
+                summaries = {}
+            summaries[key] = entry
+            with open(self.summary_file, 'w', encoding='utf-8') as f:
+                json.dump(summaries, f, ensure_ascii=False, indent=2)
+            print(f"[SUMMARY_SAVE_LOCAL] {key} saved to {self.summary_file}")
+        except Exception as e:
+            print(f"[SUMMARY_SAVE_LOCAL] Error: {e}")
+
+    def load_student_summaries(self, student_id):
+        try:
+            if self.db is not None:
+                summaries = self.db.summaries_for_student(student_id)
+            elif os.path.exists(self.summary_file):
+                with open(self.summary_file, 'r', encoding='utf-8') as f:
+                    summaries = json.load(f)
+            else:
+                summaries = {}
+            return _group_student_entries(summaries, student_id)
+        except Exception as e:
+            print(f"[HISTORY] Local read failed: {e}")
+            return {}
+
+    # progress ----------------------------------------------------------
+    def load_progress(self):
+        if self.db is not None:
+            return self.db.all_progress()
+        return read_json_file(self.progress_file) or {}
+
+    def save_progress(self, progress):
+        try:
+            if self.db is not None:
+                # 変更のあった児童の行だけが書き換わる
+                self.db.put_progress_many(progress)
+                print(f"[PROGRESS_SAVE] SQLite saved successfully")
+                return
+            atomic_write_json(self.progress_file, progress)
+            print(f"[PROGRESS_SAVE] Local file saved successfully")
+        except Exception as e:
+            print(f"[PROGRESS_SAVE] Error: {e}")
+
+    def load_student_progress(self, student_id):
+        if self.db is not None:
+            return self.db.get_progress(student_id)
+        return (read_json_file(self.progress_file) or {}).get(str(student_id))
+
+    def save_student_progress(self, student_id, data):
+        try:
+            if self.db is not None:
+                self.db.put_progress(student_id, data)
+                print(f"[PROGRESS_SAVE] SQLite - {student_id}")
+                return
+            # JSON エンジンは単一ファイルのため、この児童のキーだけ差し替えて書き戻す
+            progress = read_json_file(self.progress_file) or {}
+            progress[str(student_id)] = data
+            atomic_write_json(self.progress_file, progress)
+            print(f"[PROGRESS_SAVE] Local - {student_id}")
+        except Exception as e:
+            print(f"[PROGRESS_SAVE] Error: {e}")
+
+    def delete_student_progress(self, student_id):
+        if self.db is not None:
+            self.db.delete_progress(student_id)
+            return
+        progress = read_json_file(self.progress_file) or {}
+        if progress.pop(str(student_id), None) is not None:
+            atomic_write_json(self.progress_file, progress)
+
+    # history -----------------------------------------------------------
+    def _history_path(self, student_id):
+        return os.path.join(self.history_dir, f"{student_id}.json")
+
+    def load_history(self, student_id):
+        if self.db is not None:
+            return self.db.get_history(student_id)
+        return read_json_file(self._history_path(student_id))
+
+    def save_history(self, student_id, doc):
+        try:
+            if self.db is not None:
+                self.db.put_history(student_id, doc)
+                return
+            os.makedirs(self.history_dir, exist_ok=True)
+            atomic_write_json(self._history_path(student_id), doc)
+        except Exception as e:
+            print(f"[HISTORY_SAVE] Local Error: {e}")
+
+    def update_history(self, student_id, mutate):
+        if self.db is not None:
+            self.db.update_history(student_id, mutate)
+            return
+        path = self._history_path(student_id)
+        os.makedirs(self.history_dir, exist_ok=True)
+        with exclusive_lock(path):
+            doc = mutate(read_json_file(path))
+            if doc is not None:
+                atomic_write_json(path, doc)
+
+    # learning logs -----------------------------------------------------
+    def append_log(self, date, entry):
+        """Append one learning log entry; returns its ``segment:offset`` locator in jsonl mode."""
+        if self.log_format == 'jsonl' and self.segments is not None:
+            # 追記専用セグメント: 当日の件数に関係なく1行追記のみ
+            segment, offset = self.segments.append(date, entry)
+            return f"{segment}:{offset}"
+
+        os.makedirs(self.log_dir, exist_ok=True)
+        log_file = os.path.join(self.log_dir, f"learning_log_{date}.json")
+        logs = []
+        if os.path.exists(log_file):
+            try:
+                with open(log_file, 'r', encoding='utf-8') as f:
+                    logs = json.load(f)
+            except (json.JSONDecodeError, FileNotFoundError):
+                logs = []
+        logs.append(entry)
+        with open(log_file, 'w', encoding='utf-8') as f:
+            json.dump(logs, f, ensure_ascii=False, indent=2)
+
+    def load_logs(self, date):
+        """Legacy JSON array followed by append-only segment records."""
+        logs = []
+        log_file = os.path.join(self.log_dir, f"learning_log_{date}.json")
+        if os.path.exists(log_file):
+            try:
+                with open(log_file, 'r', encoding='utf-8') as f:
+                    legacy_logs = json.load(f)
+                if isinstance(legacy_logs, list):
+                    logs = list(_flatten_logs(legacy_logs))
+            except (json.JSONDecodeError, FileNotFoundError):
+                logs = []
+
+        if self.segments is not None:
+            try:
+                logs.extend(self.segments.iter_records(date))
+            except Exception as e:
+                print(f"[LOG_LOAD] Segment read error for {date}: {e}")
+        return logs
+
+    def iter_logs_with_locators(self, date):
+        """Yield ``(locator, entry)``; locator is ``segment:offset`` or '' for legacy JSON entries."""
+        log_file = os.path.join(self.log_dir, f"learning_log_{date}.json")
+        if os.path.exists(log_file):
+            try:
+                with open(log_file, 'r', encoding='utf-8') as f:
+                    legacy_logs = json.load(f)
+                if isinstance(legacy_logs, list):
+                    for entry in _flatten_logs(legacy_logs):
+                        yield '', entry
+            except (json.JSONDecodeError, FileNotFoundError):
+                pass
+        if self.segments is not None:
+            for segment, offset, entry in self.segments.iter_records_with_offsets(date):
+                yield f"{segment}:{offset}", entry
+
+    def read_log_at(self, date, locator):
+        """Read the single entry at a ``segment:offset`` locator (None if unavailable)."""
+        if self.segments is None or ':' not in locator:
+            return None
+        segment, offset = locator.rsplit(':', 1)
+        try:
+            return self.segments.read_at(date, segment, int(offset))
+        except ValueError:
+            return None
+
+    def list_log_dates(self):
+        dates = set()
+        try:
+            names = os.listdir(self.log_dir)
+        except FileNotFoundError:
+            names = []
+        for filename in names:
+            if filename.startswith('learning_log_') and filename.endswith('.json'):
+                date_str = filename[13:-5]  # learning_log_YYYYMMDD.json
+                if len(date_str) == 8 and date_str.isdigit():
+                    dates.add(date_str)
+        if self.segments is not None:
+            dates.update(self.segments.available_dates())
+        return sorted(dates)
+
+    def log_version(self, date):
+        paths = [os.path.join(self.log_dir, f"learning_log_{date}.json")]
+        if self.segments is not None:
+            day_dir = self.segments.day_dir(date)
+            paths.extend(os.path.join(day_dir, name) for name in self.segments.segments(date))
+        parts = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            parts.append(f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns}")
+        if not parts:
+            return None
+        return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+    # error logs --------------------------------------------------------
+    def append_error(self, date, entry):
+        os.makedirs(self.log_dir, exist_ok=True)
+        error_log_file = os.path.join(self.log_dir, f"error_log_{date}.json")
+        logs = []
+        if os.path.exists(error_log_file):
+            try:
+                with open(error_log_file, 'r', encoding='utf-8') as f:
+                    logs = json.load(f)
+            except (json.JSONDecodeError, FileNotFoundError):
+                logs = []
+        logs.append(entry)
+        with open(error_log_file, 'w', encoding='utf-8') as f:
+            json.dump(logs, f, ensure_ascii=False, indent=2)
+
+    def load_errors(self, date):
+        error_log_file = os.path.join(self.log_dir, f"error_log_{date}.json")
+        if not os.path.exists(error_log_file):
+            return []
+        try:
+            with open(error_log_file, 'r', encoding='utf-8') as f:
+                logs = json.load(f)
+            print(f"[ERROR_LOAD] Local - {error_log_file} loaded ({len(logs)} entries)")
+            return logs
+        except (json.JSONDecodeError, FileNotFoundError):
+            return []
+
+
+# ----------------------------------------------------------------------
+# Google Cloud Storage
+# ----------------------------------------------------------------------
+class GCSBackend(ChainedBackend):
+    """Cloud Storage for sessions, summaries and logs.
+
+    Learning and error logs are always mirrored to the fallback (local)
+    backend as well, as the app has always done. When `learning_events` /
+    `error_events` (:class:`storage.gcs_events.GcsEventLog`) are given, logs
+    are written as per-event objects instead of rewriting the daily blob.
+    With a `date_manifest` (:class:`storage.date_manifest.DateManifest`) the
+    list of log dates is read from one small object instead of listing blobs.
+    With a `log_cache` (:class:`storage.log_cache.TieredLogCache`) parsed
+    learning logs are cached by date and object generation; days older than
+    `mutable_days` are served from the cache without contacting GCS.
+    """
+
+    name = 'gcs'
+
+    def __init__(self, bucket, fallback, learning_events=None, error_events=None, compact_interval=60.0,
+                 date_manifest=None, log_cache=None, mutable_days=1):
+        super().__init__(fallback=fallback)
+        self.bucket = bucket
+        self.learning_events = learning_events
+        self.error_events = error_events
+        self.compact_interval = compact_interval
+        self.date_manifest = date_manifest
+        self.log_cache = log_cache
+        self.mutable_days = mutable_days
+
+    # sessions ----------------------------------------------------------
+    def save_session(self, entry):
+        gcs_path = f"sessions/{entry['student_id']}/{entry['unit']}/{entry['stage']}.json"
+        try:
+            self.bucket.blob(gcs_path).upload_from_string(
+                json.dumps(entry, ensure_ascii=False, indent=2),
+                content_type='application/json'
+            )
+            print(f"[SESSION_SAVE] GCS - {gcs_path}")
+            return
+        except Exception as e:
+            print(f"[SESSION_SAVE] GCS failed: {e}, falling back to local")
+        self.fallback.save_session(entry)
+
+    def load_session(self, student_id, unit, stage):
+        gcs_path = f"sessions/{student_id}/{unit}/{stage}.json"
+        try:
+            blob = self.bucket.blob(gcs_path)
+            if blob.exists():
+                data = json.loads(blob.download_as_string().decode('utf-8'))
+                print(f"[SESSION_LOAD] GCS - {gcs_path}")
+                return data.get('conversation', [])
+        except Exception as e:
+            print(f"[SESSION_LOAD] GCS failed: {e}, trying local")
+        return self.fallback.load_session(student_id, unit, stage)
+
+    def load_student_sessions(self, student_id):
+        prefix = f"sessions/{student_id}/"
+        grouped = {}
+        try:
+            for blob in self.bucket.list_blobs(prefix=prefix):
+                # sessions/{student_id}/{unit}/{stage}.json
+                rest = blob.name[len(prefix):]
+                if '/' not in rest or not rest.endswith('.json'):
+                    continue
+                unit, stage = rest[:-5].rsplit('/', 1)
+                try:
+                    grouped.setdefault(unit, {})[stage] = json.loads(blob.download_as_string().decode('utf-8'))
+                except Exception as e:
+                    print(f"[HISTORY] Error reading blob {blob.name}: {e}")
+        except Exception as e:
+            print(f"[HISTORY] GCS session listing failed: {e}, falling back to local")
+        return grouped or self.fallback.load_student_sessions(student_id)
+
+    # summaries ---------------------------------------------------------
+    def save_summary(self, entry):
+        key = f"summaries/{entry_key(entry)}"
+        try:
+            self.bucket.blob(key).upload_from_string(
+                json.dumps(entry, ensure_ascii=False), content_type='application/json'
+            )
+            print(f"[SUMMARY_SAVE_GCS] {key} saved to GCS")
+            return
+        except Exception as e:
+            print(f"[SUMMARY_SAVE] GCS failed: {e}, falling back to local")
+        self.fallback.save_summary(entry)
+
+    def load_student_summaries(self, student_id):
+        history = {}
+        prefix = f"summaries/{student_id}_"
+        try:
+            blobs = list(self.bucket.list_blobs(prefix=prefix))
+            print(f"[HISTORY] GCS: found {len(blobs)} summary blobs for {student_id}")
+            for blob in blobs:
+                # 形式: summaries/{student_id}_{unit}_{stage}
+                parts = blob.name[len(prefix):].rsplit('_', 1)
+                if len(parts) != 2:
+                    continue
+                unit, stage = parts
+                try:
+                    history.setdefault(unit, {})[stage] = json.loads(blob.download_as_string().decode('utf-8'))
+                    print(f"[HISTORY] GCS loaded {unit}/{stage}")
+                except Exception as e:
+                    print(f"[HISTORY] Error reading blob {blob.name}: {e}")
+        except Exception as e:
+            print(f"[HISTORY] GCS read failed: {e}, falling back to local")
+        if history:
+            return history
+        print(f"[HISTORY] GCS: no summaries found, falling back to local")
+        return self.fallback.load_student_summaries(student_id)
+
+    # history -----------------------------------------------------------
+    def load_history(self, student_id):
+        try:
+            blob = self.bucket.blob(f"histories/{student_id}.json")
+            return json.loads(blob.download_as_string().decode('utf-8'))
+        except Exception as e:
+            if type(e).__name__ != 'NotFound':
+                print(f"[HISTORY] GCS history read failed: {e}, trying local")
+        return self.fallback.load_history(student_id)
+
+    def save_history(self, student_id, doc):
+        try:
+            self.bucket.blob(f"histories/{student_id}.json").upload_from_string(
+                json.dumps(doc, ensure_ascii=False), content_type='application/json'
+            )
+            return
+        except Exception as e:
+            print(f"[HISTORY_SAVE] GCS failed: {e}, falling back to local")
+        self.fallback.save_history(student_id, doc)
+
+    def update_history(self, student_id, mutate, max_retries=10):
+        """Read-modify-write guarded by ``if_generation_match`` (retried when another writer won)."""
+        from google.api_core import exceptions as gexc
+
+        name = f"histories/{student_id}.json"
+        try:
+            for _ in range(max_retries):
+                blob = self.bucket.get_blob(name)
+                if blob is None:
+                    current, generation = self.fallback.load_history(student_id), 0
+                else:
+                    current, generation = json.loads(blob.download_as_bytes().decode('utf-8')), blob.generation
+                doc = mutate(current)
+                if doc is None:
+                    return
+                try:
+                    self.bucket.blob(name).upload_from_string(
+                        json.dumps(doc, ensure_ascii=False), content_type='application/json',
+                        if_generation_match=generation,
+                    )
+                    return
+                except gexc.PreconditionFailed:
+                    continue
+        except Exception as e:
+            print(f"[HISTORY_SAVE] GCS update failed: {e}, falling back to local")
+            self.fallback.update_history(student_id, mutate)
+            return
+        raise RuntimeError(f"history update for {student_id} lost {max_retries} races")
+
+    # learning logs -----------------------------------------------------
+    def append_log(self, date, entry):
+        if self.learning_events is not None:
+            # イベントモード: 1件1オブジェクトでアップロード（日次ファイルの再アップロードなし）
+            try:
+                self.learning_events.append(date, entry)
+                self.learning_events.start_compactor(self.compact_interval)
+                print(f"[LOG_SAVE] GCS EVENT SUCCESS - class: {entry.get('class_display')}, "
+                      f"unit: {entry.get('unit')}, type: {entry.get('log_type')}")
+                self._record_date(date)
+            except Exception as e:
+                print(f"[LOG_SAVE] GCS EVENT ERROR - {type(e).__name__}: {str(e)}, continue with local save")
+        else:
+            log_filename = f"logs/learning_log_{date}.json"
+            try:
+                print(f"[LOG_SAVE] GCS START - path: {log_filename}, class: {entry.get('class_display')}, "
+                      f"unit: {entry.get('unit')}, type: {entry.get('log_type')}")
+                blob = self.bucket.blob(log_filename)
+                try:
+                    logs = json.loads(blob.download_as_string().decode('utf-8'))
+                except Exception:
+                    logs = []
+                logs.append(entry)
+                blob.upload_from_string(
+                    json.dumps(logs, ensure_ascii=False, indent=2).encode('utf-8'),
+                    content_type='application/json'
+                )
+                print(f"[LOG_SAVE] GCS SUCCESS - saved to GCS (local copy will also be written)")
+                self._record_date(date)
+            except Exception as e:
+                print(f"[LOG_SAVE] GCS ERROR - {type(e).__name__}: {str(e)}, continue with local save")
+
+        # ローカルファイルにも必ず保存
+        return self.fallback.append_log(date, entry)
+
+    def _is_mutable(self, date):
+        """Today (and `mutable_days` before it) may still receive writes or compaction."""
+        oldest_mutable = (datetime.now() - timedelta(days=self.mutable_days)).strftime('%Y%m%d')
+        return date >= oldest_mutable
+
+    def _log_version(self, date):
+        """Cache version of a day's GCS logs from object generations; None when nothing exists."""
+        names = [f"logs/learning_log_{date}.json"]
+        if self.learning_events is not None:
+            names.append(self.learning_events.compacted_name(date))
+        parts = []
+        for name in names:
+            blob = self.bucket.get_blob(name)
+            parts.append(str(blob.generation) if blob is not None else '0')
+        if self.learning_events is not None:
+            pending = self.learning_events.pending_names(date)
+            parts.append(hashlib.sha1('\n'.join(pending).encode('utf-8')).hexdigest()[:12] if pending else '0')
+        if all(p == '0' for p in parts):
+            return None
+        return '-'.join(parts)
+
+    def log_version(self, date):
+        version = self._log_version(date)
+        return version if version is not None else self.fallback.log_version(date)
+
+    def load_logs(self, date):
+        if self.log_cache is None:
+            return self._load_logs_uncached(date)
+
+        if not self._is_mutable(date):
+            cached = self.log_cache.get_latest(date)
+            if cached is not None:
+                return cached
+        try:
+            version = self._log_version(date)
+        except Exception as e:
+            print(f"[LOG_CACHE] version check failed for {date}: {type(e).__name__}: {e}")
+            return self._load_logs_uncached(date)
+        if version is None:
+            # GCS にこの日のログが無い
+            return self.fallback.load_logs(date)
+        cached = self.log_cache.get(date, version)
+        if cached is not None:
+            return cached
+
+        logs = self._download_logs(date)
+        if logs is None:
+            return self.fallback.load_logs(date)
+        self.log_cache.put(date, version, logs)
+        return logs
+
+    def _load_logs_uncached(self, date):
+        logs = self._download_logs(date)
+        return logs if logs is not None else self.fallback.load_logs(date)
+
+    def _download_logs(self, date):
+        """Logs of `date` from GCS, or None when GCS has none (or failed)."""
+        log_filename = f"logs/learning_log_{date}.json"
+        try:
+            print(f"[LOG_LOAD] GCS START - loading logs from: {log_filename}")
+            logs = None
+            try:
+                content = self.bucket.blob(log_filename).download_as_string()
+                logs = json.loads(content.decode('utf-8'))
+                if isinstance(logs, list):
+                    logs = list(_flatten_logs(logs))
+            except Exception:
+                print(f"[LOG_LOAD] GCS file not found: {log_filename}")
+
+            # イベントモード: 集約済みファイル + 未集約イベントをマージ
+            if self.learning_events is not None:
+                event_logs = self.learning_events.read(date)
+                if event_logs:
+                    logs = (logs if isinstance(logs, list) else []) + event_logs
+
+            if logs is not None:
+                print(f"[LOG_LOAD] GCS SUCCESS - loaded {len(logs)} logs from {date}")
+                return logs
+        except Exception as e:
+            print(f"[LOG_LOAD] GCS ERROR - {type(e).__name__}: {str(e)}")
+        return None
+
+    def _record_date(self, date):
+        """Add `date` to the manifest (a no-op after this process's first write of the day)."""
+        if self.date_manifest is None:
+            return
+        try:
+            self.date_manifest.add(date)
+        except Exception as e:
+            print(f"[DATES] manifest update failed: {type(e).__name__}: {e}")
+
+    def list_log_dates(self):
+        if self.date_manifest is not None:
+            try:
+                manifest_dates = self.date_manifest.dates()
+                if manifest_dates is not None:
+                    return manifest_dates
+                print(f"[DATES] manifest not found, building it from a bucket listing")
+            except Exception as e:
+                print(f"[DATES] manifest read failed: {type(e).__name__}: {e}, listing bucket")
+
+        dates = set()
+        blob_count = 0
+        try:
+            print(f"[DATES] Checking GCS bucket for log files...")
+            # ページネーションを使用して段階的に処理（メモリ効率化）
+            for blob in self.bucket.list_blobs(prefix='logs/learning_log_', page_size=50):
+                blob_count += 1
+                if blob_count > 1000:  # 最大 1000 ブロブまでに制限
+                    print(f"[DATES] Reached limit of 1000 blobs, stopping enumeration")
+                    break
+                filename = os.path.basename(blob.name)
+                if filename.startswith('learning_log_') and filename.endswith(('.json', '.jsonl')):
+                    date_str = filename[13:].split('.', 1)[0]  # learning_log_YYYYMMDD.json(l)
+                    if len(date_str) == 8 and date_str.isdigit():
+                        dates.add(date_str)
+            # イベントモード: まだ集約されていない日付も含める
+            if self.learning_events is not None:
+                dates.update(self.learning_events.pending_dates())
+            print(f"[DATES] Found {len(dates)} dates in GCS (scanned {blob_count} blobs)")
+        except Exception as e:
+            print(f"[DATES] GCS ERROR: {str(e)}, falling back to local")
+        if dates:
+            if self.date_manifest is not None and blob_count <= 1000:
+                # 一覧が完全な場合のみマニフェストを作成する
+                try:
+                    self.date_manifest.rebuild(dates)
+                except Exception as e:
+                    print(f"[DATES] manifest rebuild failed: {type(e).__name__}: {e}")
+            return sorted(dates)
+        dates_list = self.fallback.list_log_dates()
+        print(f"[DATES] Fallback: Found {len(dates_list)} dates in local")
+        return dates_list
+
+    # error logs --------------------------------------------------------
+    def append_error(self, date, entry):
+        try:
+            if self.error_events is not None:
+                # イベントモード: 1件1オブジェクトでアップロード
+                self.error_events.append(date, entry)
+                self.error_events.start_compactor(self.compact_interval)
+                print(f"[ERROR_LOG_GCS] event saved for {date}")
+            else:
+                gcs_path = f"error_logs/error_log_{date}.json"
+                blob = self.bucket.blob(gcs_path)
+                logs = []
+                if blob.exists():
+                    try:
+                        logs = json.loads(blob.download_as_string().decode('utf-8'))
+                    except Exception:
+                        logs = []
+                logs.append(entry)
+                blob.upload_from_string(
+                    json.dumps(logs, ensure_ascii=False, indent=2),
+                    content_type='application/json'
+                )
+                print(f"[ERROR_LOG_GCS] {gcs_path} saved")
+        except Exception as e:
+            print(f"[ERROR_LOG_GCS] Error: {e}")
+
+        # ローカルにも保存
+        self.fallback.append_error(date, entry)
+
+    def load_errors(self, date):
+        gcs_path = f"error_logs/error_log_{date}.json"
+        try:
+            blob = self.bucket.blob(gcs_path)
+            logs = None
+            if blob.exists():
+                logs = json.loads(blob.download_as_string().decode('utf-8'))
+            if self.error_events is not None:
+                event_logs = self.error_events.read(date)
+                if event_logs:
+                    logs = (logs or []) + event_logs
+            if logs is not None:
+                print(f"[ERROR_LOAD] GCS - {gcs_path} loaded ({len(logs)} entries)")
+                return logs
+            print(f"[ERROR_LOAD] GCS - {gcs_path} not found, trying local")
+        except Exception as e:
+            print(f"[ERROR_LOAD] GCS Error: {e}, trying local")
+        return self.fallback.load_errors(date)
+
+
+# ----------------------------------------------------------------------
+# Firestore
+# ----------------------------------------------------------------------
+class FirestoreBackend(ChainedBackend):
+    """Firestore for sessions, summaries and learning progress.
+
+    Logs are not stored in Firestore and go straight to the fallback.
+    Reads fall back when a document is missing, so data written before
+    Firestore was enabled stays visible.
+    """
+
+    name = 'firestore'
+    SESSION_COLLECTION = 'sb_session_storage'
+    SUMMARY_COLLECTION = 'sb_summary_storage'
+    PROGRESS_COLLECTION = 'sb_learning_progress'
+    HISTORY_COLLECTION = 'sb_student_history'
+
+    def __init__(self, client, fallback):
+        super().__init__(fallback=fallback)
+        self.client = client
+
+    def _student_docs(self, collection, student_id):
+        query = self.client.collection(collection).where('student_id', '==', str(student_id))
+        return {doc.id: doc.to_dict() for doc in query.stream()}
+
+    # sessions ----------------------------------------------------------
+    def save_session(self, entry):
+        key = entry_key(entry)
+        try:
+            self.client.collection(self.SESSION_COLLECTION).document(key).set(entry)
+            print(f"[SESSION_SAVE] Firestore - {key}")
+            return
+        except Exception as e:
+            print(f"[SESSION_SAVE] Firestore failed: {e}, falling back to next storage")
+        self.fallback.save_session(entry)
+
+    def load_session(self, student_id, unit, stage):
+        key = f"{student_id}_{unit}_{stage}"
+        try:
+            doc = self.client.collection(self.SESSION_COLLECTION).document(key).get()
+            if doc.exists:
+                print(f"[SESSION_LOAD] Firestore - {key}")
+                return (doc.to_dict() or {}).get('conversation', [])
+        except Exception as e:
+            print(f"[SESSION_LOAD] Firestore failed: {e}, trying next storage")
+        return self.fallback.load_session(student_id, unit, stage)
+
+    def load_student_sessions(self, student_id):
+        try:
+            grouped = _group_student_entries(self._student_docs(self.SESSION_COLLECTION, student_id), student_id)
+            if grouped:
+                return grouped
+        except Exception as e:
+            print(f"[HISTORY] Firestore session query failed: {e}")
+        return self.fallback.load_student_sessions(student_id)
+
+    # summaries ---------------------------------------------------------
+    def save_summary(self, entry):
+        key = entry_key(entry)
+        try:
+            self.client.collection(self.SUMMARY_COLLECTION).document(key).set(entry)
+            print(f"[SUMMARY_SAVE] Firestore - {key}")
+            return
+        except Exception as e:
+            print(f"[SUMMARY_SAVE] Firestore failed: {e}, falling back to next storage")
+        self.fallback.save_summary(entry)
+
+    def load_student_summaries(self, student_id):
+        try:
+            grouped = _group_student_entries(self._student_docs(self.SUMMARY_COLLECTION, student_id), student_id)
+            if grouped:
+                print(f"[HISTORY] Firestore: found summaries for {student_id}")
+                return grouped
+        except Exception as e:
+            print(f"[HISTORY] Firestore summary query failed: {e}")
+        return self.fallback.load_student_summaries(student_id)
+
+    # history -----------------------------------------------------------
+    def load_history(self, student_id):
+        try:
+            doc = self.client.collection(self.HISTORY_COLLECTION).document(str(student_id)).get()
+            if doc.exists:
+                return doc.to_dict()
+        except Exception as e:
+            print(f"[HISTORY] Firestore history read failed: {e}, trying next storage")
+        return self.fallback.load_history(student_id)
+
+    def save_history(self, student_id, doc):
+        try:
+            self.client.collection(self.HISTORY_COLLECTION).document(str(student_id)).set(doc)
+            return
+        except Exception as e:
+            print(f"[HISTORY_SAVE] Firestore failed: {e}, falling back to next storage")
+        self.fallback.save_history(student_id, doc)
+
+    def update_history(self, student_id, mutate):
+        """Read-modify-write in a Firestore transaction (retried by the client on contention)."""
+        try:
+            from google.cloud import firestore
+
+            ref = self.client.collection(self.HISTORY_COLLECTION).document(str(student_id))
+
+            @firestore.transactional
+            def run(transaction):
+                snapshot = ref.get(transaction=transaction)
+                current = snapshot.to_dict() if snapshot.exists else self.fallback.load_history(student_id)
+                doc = mutate(current)
+                if doc is not None:
+                    transaction.set(ref, doc)
+
+            run(self.client.transaction())
+            return
+        except Exception as e:
+            print(f"[HISTORY_SAVE] Firestore update failed: {e}, falling back to next storage")
+        self.fallback.update_history(student_id, mutate)
+
+    # progress ----------------------------------------------------------
+    def load_progress(self):
+        try:
+            progress = {doc.id: doc.to_dict() for doc in self.client.collection(self.PROGRESS_COLLECTION).stream()}
+            if progress:
+                return progress
+        except Exception as e:
+            print(f"[PROGRESS_LOAD] Firestore failed: {e}, falling back to next storage")
+        return self.fallback.load_progress()
+
+    def save_progress(self, progress):
+        try:
+            # progress は {student_id: {unit: {...}}}
+            batch = self.client.batch()
+            count = 0
+            for student_id, student_obj in progress.items():
+                doc_ref = self.client.collection(self.PROGRESS_COLLECTION).document(str(student_id))
+                batch.set(doc_ref, student_obj)
+                count += 1
+                if count >= 500:
+                    batch.commit()
+                    batch = self.client.batch()
+                    count = 0
+            if count > 0:
+                batch.commit()
+            print(f"[PROGRESS_SAVE] Firestore: imported {len(progress)} student progress entries")
+            return
+        except Exception as e:
+            print(f"[PROGRESS_SAVE] Firestore failed: {e}, falling back to local file")
+        self.fallback.save_progress(progress)
+
+    def load_student_progress(self, student_id):
+        try:
+            doc = self.client.collection(self.PROGRESS_COLLECTION).document(str(student_id)).get()
+            if doc.exists:
+                return doc.to_dict() or {}
+        except Exception as e:
+            print(f"[PROGRESS_LOAD] Firestore failed: {e}, falling back to next storage")
+        return self.fallback.load_student_progress(student_id)
+
+    def save_student_progress(self, student_id, data):
+        try:
+            self.client.collection(self.PROGRESS_COLLECTION).document(str(student_id)).set(data)
+            print(f"[PROGRESS_SAVE] Firestore - {student_id}")
+            return
+        except Exception as e:
+            print(f"[PROGRESS_SAVE] Firestore failed: {e}, falling back to local file")
+        self.fallback.save_student_progress(student_id, data)
+
+    def delete_student_progress(self, student_id):
+        try:
+            self.client.collection(self.PROGRESS_COLLECTION).document(str(student_id)).delete()
+        except Exception as e:
+            print(f"[PROGRESS_SAVE] Firestore delete failed: {e}")
+        # 移行前のデータが下位ストレージに残っていることがあるため、そちらも削除する
+        self.fallback.delete_student_progress(student_id)
+
+
+# ----------------------------------------------------------------------
+# In-memory
+# ----------------------------------------------------------------------
+class InMemoryBackend(ChainedBackend):
+    """Process-local fake holding everything in dicts.
+
+    Values are deep-copied on the way in and out, so callers observe the
+    same isolation as with a real serialized store.
+    """
+
+    name = 'memory'
+
+    def __init__(self):
+        super().__init__(fallback=None)
+        self._lock = threading.Lock()
+        self.sessions: Dict[str, Entry] = {}
+        self.summaries: Dict[str, Entry] = {}
+        self.progress: Dict[str, Dict[str, Any]] = {}
+        self.histories: Dict[str, Dict[str, Any]] = {}
+        self.logs: Dict[str, List[Entry]] = {}
+        self.errors: Dict[str, List[Entry]] = {}
+
+    def save_session(self, entry):
+        with self._lock:
+            self.sessions[entry_key(entry)] = copy.deepcopy(entry)
+
+    def load_session(self, student_id, unit, stage):
+        with self._lock:
+            entry = self.sessions.get(f"{student_id}_{unit}_{stage}")
+            return copy.deepcopy(entry.get('conversation', [])) if entry else []
+
+    def load_student_sessions(self, student_id):
+        with self._lock:
+            return copy.deepcopy(_group_student_entries(self.sessions, student_id))
+
+    def save_summary(self, entry):
+        with self._lock:
+            self.summaries[entry_key(entry)] = copy.deepcopy(entry)
+
+    def load_student_summaries(self, student_id):
+        with self._lock:
+            return copy.deepcopy(_group_student_entries(self.summaries, student_id))
+
+    def load_progress(self):
+        with self._lock:
+            return copy.deepcopy(self.progress)
+
+    def save_progress(self, progress):
+        with self._lock:
+            self.progress = copy.deepcopy(progress)
+
+    def load_student_progress(self, student_id):
+        with self._lock:
+            return copy.deepcopy(self.progress.get(str(student_id)))
+
+    def save_student_progress(self, student_id, data):
+        with self._lock:
+            self.progress[str(student_id)] = copy.deepcopy(data)
+
+    def delete_student_progress(self, student_id):
+        with self._lock:
+            self.progress.pop(str(student_id), None)
+
+    def load_history(self, student_id):
+        with self._lock:
+            return copy.deepcopy(self.histories.get(str(student_id)))
+
+    def save_history(self, student_id, doc):
+        with self._lock:
+            self.histories[str(student_id)] = copy.deepcopy(doc)
+
+    def update_history(self, student_id, mutate):
+        with self._lock:
+            doc = mutate(copy.deepcopy(self.histories.get(str(student_id))))
+            if doc is not None:
+                self.histories[str(student_id)] = copy.deepcopy(doc)
+
+    def append_log(self, date, entry):
+        with self._lock:
+            self.logs.setdefault(date, []).append(copy.deepcopy(entry))
+
+    def load_logs(self, date):
+        with self._lock:
+            return copy.deepcopy(self.logs.get(date, []))
+
+    def list_log_dates(self):
+        with self._lock:
+            return sorted(self.logs)
+
+    def log_version(self, date):
+        # append-only: the record count identifies the content
+        with self._lock:
+            count = len(self.logs.get(date, []))
+        return str(count) if count else None
+
+    def append_error(self, date, entry):
+        with self._lock:
+            self.errors.setdefault(date, []).append(copy.deepcopy(entry))
+
+    def load_errors(self, date):
+        with self._lock:
+            return copy.deepcopy(self.errors.get(date, []))
+
+
+def build_backend(kind: str, local: LocalBackend, bucket=None, firestore_client=None,
+                  learning_events=None, error_events=None, compact_interval: float = 60.0,
+                  date_manifest=None, log_cache=None, mutable_days: int = 1) -> ChainedBackend:
+    """Build the backend chain once at start-up.
+
+    kind:
+        ``'auto'``      Firestore / GCS when configured, local otherwise
+        ``'local'``     local files only
+        ``'gcs'``       GCS (when a bucket is available) -> local
+        ``'firestore'`` Firestore -> GCS (when available) -> local
+        ``'memory'``    in-memory fake, no persistence
+    """
+    kind = (kind or 'auto').lower()
+    if kind == 'memory':
+        return InMemoryBackend()
+    if kind not in ('auto', 'local', 'gcs', 'firestore'):
+        raise ValueError(f"unknown storage backend: {kind}")
+
+    backend: ChainedBackend = local
+    if kind in ('auto', 'gcs', 'firestore') and bucket is not None:
+        backend = GCSBackend(bucket, fallback=backend, learning_events=learning_events,
+                             error_events=error_events, compact_interval=compact_interval,
+                             date_manifest=date_manifest, log_cache=log_cache, mutable_days=mutable_days)
+    if kind in ('auto', 'firestore') and firestore_client is not None:
+        backend = FirestoreBackend(firestore_client, fallback=backend)
+    return backend
@@ -0,0 +1,123 @@
+"""Small GCS manifest object listing the dates that have learning logs.
+
+Listing ``logs/learning_log_*`` pages through every daily blob; teacher
+pages need the date list on every request. The log writer instead records
+each new date in one JSON object::
+
+    logs/_log_dates.json   {"dates": ["20250101", ...], "updated_at": "..."}
+
+Each process adds a date at most once (on its first write of that day),
+with a generation precondition so concurrent writers never drop each
+other's dates. Readers keep the parsed list for a short TTL.
+"""
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional
+
+DEFAULT_MANIFEST_NAME = 'logs/_log_dates.json'
+
+
+class DateManifest:
+    """Date manifest stored as a single GCS object.
+
+    Args:
+        bucket: ``google.cloud.storage.Bucket``
+        name: object name of the manifest
+        ttl: seconds a read is served from the in-process cache
+        max_retries: attempts when another writer updated the manifest concurrently
+    """
+
+    def __init__(self, bucket, name: str = DEFAULT_MANIFEST_NAME, ttl: float = 30.0, max_retries: int = 5):
+        self.bucket = bucket
+        self.name = name
+        self.ttl = ttl
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._cached: Optional[List[str]] = None
+        self._cached_at = 0.0
+        # dates this process has already recorded (skip the read on later writes)
+        self._recorded = set()
+
+    def _read(self):
+        """Return (dates, generation); generation 0 when the manifest does not exist."""
+        blob = self.bucket.get_blob(self.name)
+        if blob is None:
+            return None, 0
+        data = json.loads(blob.download_as_bytes().decode('utf-8'))
+        dates = data.get('dates', []) if isinstance(data, dict) else []
+        return sorted(set(dates)), blob.generation
+
+    def _write(self, dates: Iterable[str], generation: int) -> None:
+        payload = {
+            'dates': sorted(set(dates)),
+            'updated_at': datetime.now(timezone.utc).isoformat(),
+        }
+        self.bucket.blob(self.name).upload_from_string(
+            json.dumps(payload, ensure_ascii=False),
+            content_type='application/json',
+            if_generation_match=generation,
+        )
+
+    def _remember(self, dates: List[str]) -> None:
+        with self._lock:
+            self._cached = dates
+            self._cached_at = time.monotonic()
+
+    def dates(self) -> Optional[List[str]]:
+        """Dates in ascending order, or None when no manifest exists yet."""
+        with self._lock:
+            if self._cached is not None and time.monotonic() - self._cached_at < self.ttl:
+                return list(self._cached)
+        dates, _ = self._read()
+        if dates is not None:
+            self._remember(dates)
+        return None if dates is None else list(dates)
+
+    def add(self, date: str) -> bool:
+        """Record `date`; returns True when the manifest object was updated.
+
+        Does nothing until the manifest has been created by :meth:`rebuild`.
+        """
+        with self._lock:
+            if date in self._recorded:
+                return False
+        from google.api_core import exceptions as gexc
+
+        for _ in range(self.max_retries):
+            dates, generation = self._read()
+            if dates is None:
+                # only a full listing may create the manifest (see rebuild), otherwise
+                # it would hide every date written before it existed
+                return False
+            if date in dates:
+                updated = False
+            else:
+                dates = sorted(dates + [date])
+                try:
+                    self._write(dates, generation)
+                except gexc.PreconditionFailed:
+                    continue
+                updated = True
+            with self._lock:
+                self._recorded.add(date)
+            self._remember(dates)
+            return updated
+        print(f"[DATES] manifest update for {date} lost {self.max_retries} races, will retry on next write")
+        return False
+
+    def rebuild(self, dates: Iterable[str]) -> None:
+        """Seed the manifest from a full listing, merging with any concurrent writes."""
+        from google.api_core import exceptions as gexc
+
+        dates = set(dates)
+        for _ in range(self.max_retries):
+            current, generation = self._read()
+            merged = sorted(dates.union(current or []))
+            try:
+                self._write(merged, generation)
+            except gexc.PreconditionFailed:
+                continue
+            self._remember(merged)
+            return
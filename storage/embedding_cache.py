@@ -0,0 +1,177 @@
+"""Content-addressed cache of text embeddings on memory-mapped storage.
+
+Embeddings are keyed by ``sha256(model, normalized text)`` (see
+:func:`embedding_key`), so the same student message is embedded once no
+matter which analysis asks for it. Per model, the cache keeps two files::
+
+    <directory>/<model>.f32    float32 rows, appended only
+    <directory>/<model>.db     SQLite (WAL): key -> row, dimension and row count
+
+Rows are read through a read-only memory map, so cached vectors cost page
+cache rather than process memory and are shared by every process (web
+and RQ workers) that points at the same directory. Appends run inside an
+IMMEDIATE transaction: writers in different processes never hand out the
+same rows, and a row becomes visible only after its bytes are written.
+Both files can be deleted at any time; the cache then starts over empty.
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from typing import Iterable, List, Optional, Sequence
+
+import numpy as np
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    dim INTEGER NOT NULL,
+    rows INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS vectors (
+    key TEXT PRIMARY KEY,
+    row INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+_LOOKUP_BATCH = 500
+
+
+def normalize_text(text: str) -> str:
+    """NFKC with runs of whitespace collapsed (what the cache key is computed from)."""
+    return ' '.join(unicodedata.normalize('NFKC', text).split())
+
+
+def embedding_key(model: str, text: str) -> str:
+    payload = f"{model}\0{normalize_text(text)}"
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """Embeddings of one model in `directory`.
+
+    Args:
+        directory: where the row file and the index are kept
+        model: embedding model name (part of every key and of the file names)
+    """
+
+    def __init__(self, directory: str, model: str, timeout: float = 30.0):
+        self.directory = os.path.abspath(directory)
+        self.model = model
+        self.timeout = timeout
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', model)
+        self.data_path = os.path.join(self.directory, f"{name}.f32")
+        self.index_path = os.path.join(self.directory, f"{name}.db")
+        self._local = threading.local()
+        self._map = None
+        self._map_ino = None
+        self._map_lock = threading.Lock()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # the directory is created on first use, not when the store is constructed
+            os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(self.index_path, timeout=self.timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def _matrix(self, rows: int, dim: int) -> Optional[np.ndarray]:
+        """Memory map covering at least `rows` rows when the file has them.
+
+        Remapped after other processes appended and after the file was replaced.
+        """
+        try:
+            st = os.stat(self.data_path)
+        except FileNotFoundError:
+            return None
+        with self._map_lock:
+            if (self._map is None or self._map_ino != st.st_ino
+                    or self._map.shape[0] < rows or self._map.shape[1] != dim):
+                count = st.st_size // (dim * 4)
+                self._map = np.memmap(self.data_path, dtype=np.float32, mode='r', shape=(count, dim)) if count else None
+                self._map_ino = st.st_ino
+            return self._map
+
+    def _rows(self, conn: sqlite3.Connection, keys: Iterable[str]) -> dict:
+        keys = list(keys)
+        rows = {}
+        for i in range(0, len(keys), _LOOKUP_BATCH):
+            batch = keys[i:i + _LOOKUP_BATCH]
+            rows.update(conn.execute(
+                f"SELECT key, row FROM vectors WHERE key IN ({','.join('?' * len(batch))})", batch
+            ))
+        return rows
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """Cached embedding of each text, or None where there is none."""
+        keys = [embedding_key(self.model, text) for text in texts]
+        conn = self._conn()
+        meta = conn.execute("SELECT dim FROM meta WHERE id = 0").fetchone()
+        if meta is None or not keys:
+            return [None] * len(keys)
+        rows = self._rows(conn, set(keys))
+        if not rows:
+            return [None] * len(keys)
+        matrix = self._matrix(max(rows.values()) + 1, meta[0])
+        available = matrix.shape[0] if matrix is not None else 0
+        return [
+            matrix[rows[key]].tolist() if rows.get(key, available) < available else None
+            for key in keys
+        ]
+
+    def put_many(self, texts: Sequence[str], embeddings: Sequence[Optional[Sequence[float]]]) -> int:
+        """Store the embeddings that are not cached yet; returns the number of rows added.
+
+        Vectors whose length differs from the cache's dimension (set by the
+        first stored vector) are skipped.
+        """
+        items = {}
+        for text, embedding in zip(texts, embeddings):
+            if embedding is not None and len(embedding):
+                items.setdefault(embedding_key(self.model, text), embedding)
+        if not items:
+            return 0
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            meta = conn.execute("SELECT dim, rows FROM meta WHERE id = 0").fetchone()
+            dim, count = meta if meta else (len(next(iter(items.values()))), 0)
+            try:
+                size = os.path.getsize(self.data_path)
+            except FileNotFoundError:
+                size = 0
+            if size < count * dim * 4:
+                # the row file was removed or truncated: start over
+                conn.execute("DELETE FROM vectors")
+                count = 0
+            existing = self._rows(conn, items)
+            new = [(key, embedding) for key, embedding in items.items()
+                   if key not in existing and len(embedding) == dim]
+            if new:
+                block = np.asarray([embedding for _, embedding in new], dtype=np.float32)
+                fd = os.open(self.data_path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    os.pwrite(fd, block.tobytes(), count * dim * 4)
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                conn.executemany("INSERT INTO vectors (key, row) VALUES (?, ?)",
+                                 [(key, count + i) for i, (key, _) in enumerate(new)])
+                conn.execute(
+                    "INSERT INTO meta (id, dim, rows) VALUES (0, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET rows=excluded.rows",
+                    (dim, count + len(new)),
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return len(new)
@@ -0,0 +1,239 @@
+"""Disk-backed export artifacts (CSV and dialogue ZIP).
+
+The CSV export is written one day at a time (:func:`csv_chunks`), either
+streamed to the client or into an artifact file. The dialogue export
+groups every log record by ``(unit, student)`` and writes one
+``talk/{unit}/student_{id}.json`` entry per group. Instead of building
+that grouping and the archive in memory, records are spooled day by day
+into a temporary SQLite file, and the archive is then written straight to
+disk one group at a time::
+
+    <directory>/<key>.zip            finished artifact (served with Range support)
+    <directory>/<key>.csv
+    <directory>/<key>.status.json    progress of the build
+
+``key`` is a hash of the export parameters and of the version of the logs
+they cover, so repeated or resumed downloads of the same export reuse the
+finished artifact until new logs arrive.
+"""
+import csv
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import zipfile
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+Record = Dict[str, Any]
+DayBatches = Iterable[Tuple[str, List[Record]]]
+Progress = Optional[Callable[[Dict[str, Any]], None]]
+
+
+def csv_chunks(days: DayBatches, fieldnames: List[str], make_row: Callable[[Record], Dict[str, Any]],
+               matches: Callable[[Record], bool],
+               on_day: Optional[Callable[[str, int, int], None]] = None) -> Iterator[bytes]:
+    """UTF-8 (BOM) CSV bytes, one chunk per day; ``on_day(date, loaded, exported)`` after each day."""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames)
+    writer.writeheader()
+    yield '\ufeff'.encode('utf-8') + buffer.getvalue().encode('utf-8')
+    for date, logs in days:
+        buffer.seek(0)
+        buffer.truncate()
+        count = 0
+        for log in logs:
+            if not matches(log):
+                continue
+            writer.writerow(make_row(log))
+            count += 1
+        if on_day is not None:
+            on_day(date, len(logs), count)
+        if count:
+            yield buffer.getvalue().encode('utf-8')
+
+
+class ExportArtifacts:
+    """Finished archives and build status files in one directory.
+
+    Args:
+        directory: where archives and status files are kept
+        max_age: seconds after which unused archives are deleted by :meth:`prune`
+    """
+
+    def __init__(self, directory: str, max_age: float = 24 * 3600):
+        self.directory = os.path.abspath(directory)
+        self.max_age = max_age
+
+    def workdir(self) -> str:
+        """The artifact directory, created on first use."""
+        os.makedirs(self.directory, exist_ok=True)
+        return self.directory
+
+    @staticmethod
+    def key(params: Dict[str, Any]) -> str:
+        payload = json.dumps(params, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:20]
+
+    def path(self, key: str, ext: str = 'zip') -> str:
+        return os.path.join(self.directory, f"{key}.{ext}")
+
+    def _status_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.status.json")
+
+    def exists(self, key: str, ext: str = 'zip') -> bool:
+        return os.path.exists(self.path(key, ext))
+
+    def status(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._status_path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_status(self, key: str, progress: Progress = None, **fields: Any) -> None:
+        """Replace the status file of `key` (and pass the fields on to `progress`)."""
+        fields['updated_at'] = datetime.now(timezone.utc).isoformat()
+        fd, tmp = tempfile.mkstemp(prefix='.tmp_', suffix='.json', dir=self.workdir())
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(fields, f, ensure_ascii=False)
+        os.replace(tmp, self._status_path(key))
+        if progress is not None:
+            progress(fields)
+
+    def prune(self) -> None:
+        """Delete archives and status files older than ``max_age``."""
+        now = time.time()
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.stat(path).st_mtime > self.max_age:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def tee(self, key: str, ext: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Pass `chunks` through while saving them; the artifact appears only when all were sent."""
+        dest = self.path(key, ext)
+        fd, tmp = tempfile.mkstemp(prefix='.tee_', suffix=f'.{ext}', dir=self.workdir())
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            os.replace(tmp, dest)
+            tmp = None
+        finally:
+            if tmp and os.path.exists(tmp):
+                os.remove(tmp)
+
+    def build_csv(self, key: str, days: DayBatches, days_total: int, fieldnames: List[str],
+                  make_row: Callable[[Record], Dict[str, Any]], matches: Callable[[Record], bool],
+                  progress: Progress = None) -> int:
+        """Write the CSV artifact of `key` from `days`; returns the number of exported rows."""
+        counts = {'days_done': 0, 'records': 0}
+
+        def on_day(date, loaded, exported):
+            counts['days_done'] += 1
+            counts['records'] += exported
+            self.write_status(key, progress, state='loading', days_total=days_total, **counts)
+
+        self.write_status(key, progress, state='loading', days_total=days_total, **counts)
+        try:
+            for _ in self.tee(key, 'csv', csv_chunks(days, fieldnames, make_row, matches, on_day)):
+                pass
+        except Exception as e:
+            self.write_status(key, progress, state='failed', error=str(e))
+            raise
+        self.write_status(key, progress, state='done', days_total=days_total,
+                          size=os.path.getsize(self.path(key, 'csv')), **counts)
+        return counts['records']
+
+    def build(self, key: str, days: DayBatches, days_total: int,
+              matches: Callable[[Record], bool], make_document: Callable[[Any, Any, List[Record]], Dict[str, Any]],
+              progress: Progress = None) -> int:
+        """Write the dialogue archive of `key` from `days`; returns the number of exported records.
+
+        Progress is reported through the status file and `progress`
+        (``loading`` while days are read, ``writing`` while entries are
+        written, then ``done`` or ``failed``).
+        """
+        dest = self.path(key)
+        fd, spool_path = tempfile.mkstemp(prefix='.spool_', suffix='.db', dir=self.workdir())
+        os.close(fd)
+        tmp_zip = f"{dest}.{os.getpid()}.tmp"
+        conn = sqlite3.connect(spool_path, isolation_level=None)
+        try:
+            conn.execute('PRAGMA journal_mode=OFF')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute(
+                "CREATE TABLE records (unit TEXT, student TEXT, seq INTEGER, data TEXT)"
+            )
+            groups = {}  # unit_key -> (unit, {student_key: student_id})
+            seq = 0
+            days_done = 0
+            self.write_status(key, progress, state='loading', days_done=0, days_total=days_total, records=0)
+            for _, logs in days:
+                rows = []
+                for log in logs:
+                    if not matches(log):
+                        continue
+                    unit = log.get('unit', 'unknown')
+                    student_id = log.get('student_number', 'unknown')
+                    unit_key = json.dumps(unit, ensure_ascii=False)
+                    student_key = json.dumps(student_id, ensure_ascii=False)
+                    groups.setdefault(unit_key, (unit, {}))[1][student_key] = student_id
+                    rows.append((unit_key, student_key, seq, json.dumps(log, ensure_ascii=False)))
+                    seq += 1
+                conn.execute('BEGIN')
+                conn.executemany("INSERT INTO records VALUES (?, ?, ?, ?)", rows)
+                conn.execute('COMMIT')
+                days_done += 1
+                self.write_status(key, progress, state='loading', days_done=days_done, days_total=days_total, records=seq)
+            conn.execute("CREATE INDEX idx_records_group ON records (unit, student, seq)")
+
+            # same entry order as before: units sorted, then students sorted
+            entries = sorted(
+                ((unit, unit_key, sorted(students.items(), key=lambda kv: kv[1]))
+                 for unit_key, (unit, students) in groups.items()),
+                key=lambda e: e[0],
+            )
+            entries_total = sum(len(students) for _, _, students in entries)
+
+            written = 0
+            with zipfile.ZipFile(tmp_zip, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                for unit, unit_key, students in entries:
+                    for student_key, student_id in students:
+                        logs_for_student = [
+                            json.loads(row[0]) for row in conn.execute(
+                                "SELECT data FROM records WHERE unit = ? AND student = ? ORDER BY seq",
+                                (unit_key, student_key),
+                            )
+                        ]
+                        document = make_document(unit, student_id, logs_for_student)
+                        file_path = f"talk/{unit}/student_{student_id}.json"
+                        zip_file.writestr(file_path, json.dumps(document, ensure_ascii=False, indent=2).encode('utf-8'))
+                        written += 1
+                        if written % 50 == 0:
+                            self.write_status(key, progress, state='writing', days_done=days_done, days_total=days_total,
+                                              records=seq, entries_done=written, entries_total=entries_total)
+            os.replace(tmp_zip, dest)
+            self.write_status(key, progress, state='done', days_done=days_done, days_total=days_total,
+                              records=seq, entries_done=written, entries_total=entries_total,
+                              size=os.path.getsize(dest))
+            return seq
+        except Exception as e:
+            self.write_status(key, progress, state='failed', error=str(e))
+            raise
+        finally:
+            conn.close()
+            for path in (spool_path, tmp_zip):
+                if os.path.exists(path):
+                    os.remove(path)
@@ -0,0 +1,216 @@
+"""Per-event GCS objects compacted into a daily blob with GCS compose.
+
+Instead of downloading the whole daily log, appending one entry and
+uploading it again, every event is uploaded as its own small object::
+
+    events/learning_log/20250101/20250101T093015123456_<uuid>.json
+
+A background compactor periodically concatenates pending event objects onto
+the daily compacted blob with ``Blob.compose`` and deletes them::
+
+    logs/learning_log_20250101.jsonl
+
+Compose is a byte-level concatenation, so both event objects and the
+compacted blob use JSON Lines (one record per line). Each line carries an
+``_event_id`` so readers can drop duplicates when an event is briefly
+visible both in the compacted blob and as a pending object.
+"""
+import json
+import threading
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+EVENT_ID_KEY = '_event_id'
+# GCS compose accepts at most 32 source objects; one slot is the destination itself
+COMPOSE_MAX_SOURCES = 32
+
+
+class GcsEventLog:
+    """Write path and reader for one kind of daily log (learning / error).
+
+    Args:
+        bucket: ``google.cloud.storage.Bucket``
+        event_prefix: prefix for pending event objects, e.g. ``events/learning_log/``
+        compacted_name: callable ``date -> blob name`` of the compacted daily blob
+    """
+
+    def __init__(self, bucket, event_prefix: str, compacted_name: Callable[[str], str]):
+        self.bucket = bucket
+        self.event_prefix = event_prefix if event_prefix.endswith('/') else event_prefix + '/'
+        self.compacted_name = compacted_name
+        self._compactor: Optional[threading.Thread] = None
+        self._compactor_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    # ------------------------------------------------------------------
+    # writes
+    # ------------------------------------------------------------------
+    def append(self, date: str, entry: Dict[str, Any]) -> str:
+        """Upload `entry` as a new event object and return its object name."""
+        event_id = uuid.uuid4().hex
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+        name = f"{self.event_prefix}{date}/{stamp}_{event_id}.json"
+        record = dict(entry)
+        record[EVENT_ID_KEY] = event_id
+        blob = self.bucket.blob(name)
+        # if_generation_match=0: create-only, never overwrite another writer's event
+        blob.upload_from_string(
+            (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'),
+            content_type='application/x-ndjson',
+            if_generation_match=0,
+        )
+        return name
+
+    # ------------------------------------------------------------------
+    # compaction
+    # ------------------------------------------------------------------
+    def pending_dates(self) -> List[str]:
+        """Dates that still have uncompacted event objects."""
+        iterator = self.bucket.list_blobs(prefix=self.event_prefix, delimiter='/')
+        # prefixes are only populated once the iterator has been consumed
+        for _ in iterator:
+            pass
+        dates = []
+        for prefix in getattr(iterator, 'prefixes', ()) or ():
+            date_str = prefix[len(self.event_prefix):].rstrip('/')
+            if len(date_str) == 8 and date_str.isdigit():
+                dates.append(date_str)
+        return sorted(dates)
+
+    def _pending_blobs(self, date: str) -> List[Any]:
+        blobs = self.bucket.list_blobs(prefix=f"{self.event_prefix}{date}/")
+        return sorted(blobs, key=lambda b: b.name)
+
+    def pending_names(self, date: str) -> List[str]:
+        """Object names of the uncompacted events of `date`, in write order."""
+        return [b.name for b in self._pending_blobs(date)]
+
+    def compact(self, date: str) -> int:
+        """Compose pending events of `date` onto the compacted daily blob.
+
+        Each compose is guarded by ``if_generation_match`` on the destination,
+        so two compactors (e.g. two gunicorn workers) never overwrite each
+        other; the loser simply retries on its next cycle.
+        Returns the number of events compacted.
+        """
+        from google.api_core import exceptions as gexc
+
+        pending = self._pending_blobs(date)
+        if not pending:
+            return 0
+
+        dest = self.bucket.blob(self.compacted_name(date))
+        compacted = 0
+        for start in range(0, len(pending), COMPOSE_MAX_SOURCES - 1):
+            chunk = pending[start:start + COMPOSE_MAX_SOURCES - 1]
+            try:
+                dest.reload()
+                generation = dest.generation
+                sources = [dest] + chunk
+            except gexc.NotFound:
+                generation = 0
+                sources = chunk
+            dest.content_type = 'application/x-ndjson'
+            try:
+                dest.compose(sources, if_generation_match=generation)
+            except gexc.PreconditionFailed:
+                print(f"[LOG_COMPACT] {date}: destination changed concurrently, retry next cycle")
+                break
+            for blob in chunk:
+                try:
+                    blob.delete()
+                except gexc.NotFound:
+                    pass
+            compacted += len(chunk)
+        return compacted
+
+    def compact_all(self) -> int:
+        total = 0
+        for date in self.pending_dates():
+            try:
+                count = self.compact(date)
+                if count:
+                    print(f"[LOG_COMPACT] {self.event_prefix}{date}: composed {count} events")
+                total += count
+            except Exception as e:
+                print(f"[LOG_COMPACT] {self.event_prefix}{date} failed: {type(e).__name__}: {e}")
+        return total
+
+    def start_compactor(self, interval_sec: float) -> None:
+        """Start the background compaction thread once per process."""
+        with self._compactor_lock:
+            if self._compactor is not None and self._compactor.is_alive():
+                return
+
+            def _run():
+                while not self._stop.wait(interval_sec):
+                    try:
+                        self.compact_all()
+                    except Exception as e:
+                        print(f"[LOG_COMPACT] cycle error: {type(e).__name__}: {e}")
+
+            self._stop.clear()
+            self._compactor = threading.Thread(target=_run, name=f"compactor:{self.event_prefix}", daemon=True)
+            self._compactor.start()
+
+    def stop_compactor(self) -> None:
+        self._stop.set()
+
+    # ------------------------------------------------------------------
+    # reads
+    # ------------------------------------------------------------------
+    @staticmethod
+    def _parse_lines(data: bytes) -> Iterable[Dict[str, Any]]:
+        for raw in data.decode('utf-8').splitlines():
+            raw = raw.strip()
+            if not raw:
+                continue
+            try:
+                record = json.loads(raw)
+            except ValueError:
+                continue
+            if isinstance(record, dict):
+                yield record
+
+    def read(self, date: str) -> List[Dict[str, Any]]:
+        """Return compacted records followed by pending events, deduplicated.
+
+        Pending events are listed *before* the compacted blob is downloaded,
+        so an event compacted in between is found in the blob. An event that
+        is compacted and deleted after the blob was downloaded is gone when
+        we fetch it; since compose precedes the delete, the blob is then
+        downloaded again to pick it up.
+        """
+        from google.api_core import exceptions as gexc
+
+        def _compacted() -> List[Dict[str, Any]]:
+            try:
+                return list(self._parse_lines(self.bucket.blob(self.compacted_name(date)).download_as_bytes()))
+            except gexc.NotFound:
+                return []
+
+        pending = self._pending_blobs(date)
+        compacted = _compacted()
+        events: List[Dict[str, Any]] = []
+        vanished = False
+        for blob in pending:
+            try:
+                events.extend(self._parse_lines(blob.download_as_bytes()))
+            except gexc.NotFound:
+                # compacted and deleted after the compacted blob was downloaded
+                vanished = True
+        if vanished:
+            compacted = _compacted()
+        records = compacted + events
+
+        seen = set()
+        result = []
+        for record in records:
+            event_id = record.pop(EVENT_ID_KEY, None)
+            if event_id is not None:
+                if event_id in seen:
+                    continue
+                seen.add(event_id)
+            result.append(record)
+        return result
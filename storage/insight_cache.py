@@ -0,0 +1,90 @@
+"""Persistent cache of generated AI insights.
+
+The analysis dashboard asks the model for a per-unit summary of the
+sampled student messages. The answer only depends on the unit, the model,
+the prompt and the sampled messages, so it is stored under a hash of
+those (see :func:`insight_key`) and served again until it expires.
+
+Entries older than ``ttl`` seconds are ignored and purged; beyond
+``max_entries`` the least recently used entries are evicted.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS insights (
+    key TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_insights_accessed ON insights(accessed_at);
+"""
+
+
+def insight_key(unit: str, model: str, prompt_version: int, samples: List[List[str]]) -> str:
+    payload = json.dumps([unit, model, prompt_version, samples], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class InsightCache:
+    """SQLite-backed TTL + LRU cache of insight results (JSON objects)."""
+
+    def __init__(self, path: str, ttl: float = 7 * 24 * 3600, max_entries: int = 500, timeout: float = 30.0):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # the file is created on first use, not when the store is constructed
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT data FROM insights WHERE key = ? AND created_at > ?", (key, now - self.ttl)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE insights SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def put(self, key: str, data: Dict[str, Any]) -> None:
+        now = time.time()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                "INSERT INTO insights (key, data, created_at, accessed_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET data=excluded.data, created_at=excluded.created_at, "
+                "accessed_at=excluded.accessed_at",
+                (key, json.dumps(data, ensure_ascii=False), now, now),
+            )
+            conn.execute("DELETE FROM insights WHERE created_at <= ?", (now - self.ttl,))
+            conn.execute(
+                "DELETE FROM insights WHERE key IN ("
+                " SELECT key FROM insights ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (max(1, int(self.max_entries)),),
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
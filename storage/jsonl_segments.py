@@ -0,0 +1,307 @@
+"""Append-only JSONL segment store for daily logs.
+
+Each day is stored as a directory of numbered segments::
+
+    logs/learning_log_20250101/seg_000001.jsonl
+    logs/learning_log_20250101/seg_000002.jsonl
+
+Writers append one JSON record per line, so the cost of a write does not
+depend on how many entries the day already holds. When the active segment
+grows past ``max_segment_bytes`` it is sealed with a footer line and a new
+segment is started. The footer is a small index of the sealed segment::
+
+    {"__segment_footer__": {"records": 120, "data_bytes": 98765,
+                             "first_timestamp": "...", "last_timestamp": "..."}}
+
+Readers skip footer lines and any partially written trailing line, and
+the next append cuts such a line off before writing, so a crash
+mid-append never makes the day unreadable nor corrupts the next record.
+"""
+import json
+import os
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+FOOTER_KEY = '__segment_footer__'
+SEGMENT_PREFIX = 'seg_'
+SEGMENT_SUFFIX = '.jsonl'
+DEFAULT_MAX_SEGMENT_BYTES = 4 * 1024 * 1024
+
+
+def _segment_name(number: int) -> str:
+    return f"{SEGMENT_PREFIX}{number:06d}{SEGMENT_SUFFIX}"
+
+
+def _segment_number(name: str) -> Optional[int]:
+    if not (name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)):
+        return None
+    digits = name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]
+    return int(digits) if digits.isdigit() else None
+
+
+class SegmentedLogStore:
+    """Daily append-only log store made of rotated JSONL segments.
+
+    `name_prefix` is prepended to the date to build the per-day directory
+    name, e.g. ``learning_log_`` -> ``logs/learning_log_YYYYMMDD/``.
+    Appends are serialized with an in-process lock plus an ``flock`` on a
+    per-day lock file, so several gunicorn workers on one host can share
+    the same directory.
+    """
+
+    def __init__(self, base_dir: str, name_prefix: str, max_segment_bytes: int = DEFAULT_MAX_SEGMENT_BYTES):
+        self.base_dir = base_dir
+        self.name_prefix = name_prefix
+        self.max_segment_bytes = max(1024, int(max_segment_bytes))
+        self._lock = threading.Lock()
+        # day_dir -> active segment number (validated under the file lock)
+        self._active: Dict[str, int] = {}
+
+    # ------------------------------------------------------------------
+    # paths
+    # ------------------------------------------------------------------
+    def day_dir(self, date: str) -> str:
+        return os.path.join(self.base_dir, f"{self.name_prefix}{date}")
+
+    def segments(self, date: str) -> List[str]:
+        """Return segment file names for `date` in write order."""
+        day_dir = self.day_dir(date)
+        try:
+            names = os.listdir(day_dir)
+        except FileNotFoundError:
+            return []
+        numbered = [(n, name) for name in names if (n := _segment_number(name)) is not None]
+        return [name for _, name in sorted(numbered)]
+
+    def available_dates(self) -> List[str]:
+        """Return every date (YYYYMMDD) that has a segment directory."""
+        dates = []
+        try:
+            names = os.listdir(self.base_dir)
+        except FileNotFoundError:
+            return dates
+        for name in names:
+            if not name.startswith(self.name_prefix):
+                continue
+            date_str = name[len(self.name_prefix):]
+            if len(date_str) == 8 and date_str.isdigit() and os.path.isdir(os.path.join(self.base_dir, name)):
+                dates.append(date_str)
+        return sorted(dates)
+
+    # ------------------------------------------------------------------
+    # writes
+    # ------------------------------------------------------------------
+    def append(self, date: str, record: Dict[str, Any]) -> Tuple[str, int]:
+        """Append `record` to the active segment of `date`.
+
+        Returns ``(segment_name, byte_offset)`` of the written line so that
+        callers can build secondary indexes pointing at the record.
+        """
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        day_dir = self.day_dir(date)
+        os.makedirs(day_dir, exist_ok=True)
+
+        with self._lock, open(os.path.join(day_dir, '.lock'), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                number = self._active_segment(day_dir)
+                path = os.path.join(day_dir, _segment_name(number))
+                fd, size = self._open_for_append(path)
+                if size and size + len(line) > self.max_segment_bytes:
+                    os.close(fd)
+                    self._seal(path)
+                    number += 1
+                    path = os.path.join(day_dir, _segment_name(number))
+                    self._active[day_dir] = number
+                    fd, size = self._open_for_append(path)
+
+                try:
+                    offset = os.lseek(fd, 0, os.SEEK_END)
+                    view = memoryview(line)
+                    while view:
+                        written = os.write(fd, view)
+                        view = view[written:]
+                finally:
+                    os.close(fd)
+                return _segment_name(number), offset
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    @classmethod
+    def _open_for_append(cls, path: str) -> Tuple[int, int]:
+        """Open a segment for appending; returns ``(fd, size)`` after :meth:`_truncate_partial_line`."""
+        fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            return fd, cls._truncate_partial_line(fd)
+        except BaseException:
+            os.close(fd)
+            raise
+
+    @staticmethod
+    def _truncate_partial_line(fd: int) -> int:
+        """Cut off a partially written last line (crash mid-append); returns the file size.
+
+        Must be called under the day's file lock. The cut record was never
+        acknowledged to its writer, and without the cut the next record
+        would be glued onto it and lost as well.
+        """
+        size = os.fstat(fd).st_size
+        if not size or os.pread(fd, 1, size - 1) == b'\n':
+            return size
+        keep = 0
+        end = size
+        while end > 0:
+            start = max(0, end - 65536)
+            newline = os.pread(fd, end - start, start).rfind(b'\n')
+            if newline >= 0:
+                keep = start + newline + 1
+                break
+            end = start
+        os.ftruncate(fd, keep)
+        return keep
+
+    def _active_segment(self, day_dir: str) -> int:
+        """Return the number of the segment currently accepting appends.
+
+        The cached number is re-validated with a single ``stat`` of the next
+        segment, which another process creates when it rotates.
+        """
+        number = self._active.get(day_dir)
+        if number is None or os.path.exists(os.path.join(day_dir, _segment_name(number + 1))):
+            numbers = [n for name in os.listdir(day_dir) if (n := _segment_number(name)) is not None]
+            number = max(numbers) if numbers else 1
+            self._active[day_dir] = number
+        return number
+
+    def _seal(self, path: str) -> None:
+        """Write the footer index line that closes a full segment."""
+        records = 0
+        first_ts = last_ts = None
+        data_bytes = 0
+        for record, _offset, length in self._iter_lines(path):
+            records += 1
+            data_bytes += length
+            ts = record.get('timestamp') if isinstance(record, dict) else None
+            if ts:
+                first_ts = first_ts or ts
+                last_ts = ts
+        footer = {FOOTER_KEY: {
+            'records': records,
+            'data_bytes': data_bytes,
+            'first_timestamp': first_ts,
+            'last_timestamp': last_ts,
+        }}
+        with open(path, 'ab') as f:
+            f.write((json.dumps(footer, ensure_ascii=False) + '\n').encode('utf-8'))
+            f.flush()
+            try:
+                os.fsync(f.fileno())
+            except OSError:
+                pass
+
+    # ------------------------------------------------------------------
+    # reads
+    # ------------------------------------------------------------------
+    @staticmethod
+    def _iter_lines(path: str) -> Iterator[Tuple[Any, int, int]]:
+        """Yield ``(record, offset, length)`` for every data line in `path`."""
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            offset = 0
+            for raw in f:
+                length = len(raw)
+                line_offset = offset
+                offset += length
+                if not raw.endswith(b'\n'):
+                    # partially written tail (crash mid-append)
+                    break
+                try:
+                    record = json.loads(raw)
+                except ValueError:
+                    continue
+                if isinstance(record, dict) and FOOTER_KEY in record:
+                    continue
+                yield record, line_offset, length
+
+    def iter_records(self, date: str) -> Iterator[Dict[str, Any]]:
+        """Yield every record of `date` in write order."""
+        day_dir = self.day_dir(date)
+        for name in self.segments(date):
+            for record, _offset, _length in self._iter_lines(os.path.join(day_dir, name)):
+                if isinstance(record, dict):
+                    yield record
+
+    def iter_records_with_offsets(self, date: str) -> Iterator[Tuple[str, int, Dict[str, Any]]]:
+        """Yield ``(segment_name, offset, record)`` for every record of `date`."""
+        day_dir = self.day_dir(date)
+        for name in self.segments(date):
+            for record, offset, _length in self._iter_lines(os.path.join(day_dir, name)):
+                if isinstance(record, dict):
+                    yield name, offset, record
+
+    def read_records(self, date: str) -> List[Dict[str, Any]]:
+        return list(self.iter_records(date))
+
+    def read_at(self, date: str, segment: str, offset: int) -> Optional[Dict[str, Any]]:
+        """Read the single record stored at `offset` in `segment`."""
+        if _segment_number(segment) is None:
+            return None
+        path = os.path.join(self.day_dir(date), segment)
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                raw = f.readline()
+        except (FileNotFoundError, OSError):
+            return None
+        if not raw.endswith(b'\n'):
+            return None
+        try:
+            record = json.loads(raw)
+        except ValueError:
+            return None
+        if not isinstance(record, dict) or FOOTER_KEY in record:
+            return None
+        return record
+
+    def segment_footer(self, date: str, segment: str) -> Optional[Dict[str, Any]]:
+        """Return the footer index of a sealed segment, or None if still active."""
+        path = os.path.join(self.day_dir(date), segment)
+        try:
+            with open(path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell()
+                f.seek(max(0, size - 4096))
+                tail = f.read().splitlines()
+        except (FileNotFoundError, OSError):
+            return None
+        if not tail:
+            return None
+        try:
+            record = json.loads(tail[-1])
+        except ValueError:
+            return None
+        if isinstance(record, dict) and FOOTER_KEY in record:
+            return record[FOOTER_KEY]
+        return None
+
+    def count(self, date: str) -> int:
+        """Count records of `date`, using footers for sealed segments."""
+        total = 0
+        day_dir = self.day_dir(date)
+        for name in self.segments(date):
+            footer = self.segment_footer(date, name)
+            if footer is not None:
+                total += int(footer.get('records', 0))
+            else:
+                total += sum(1 for _ in self._iter_lines(os.path.join(day_dir, name)))
+        return total
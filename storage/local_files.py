@@ -0,0 +1,125 @@
+"""Local JSON file helpers shared by the storage backends."""
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+# File lock and atomic write utilities to avoid concurrent write corruption.
+# Uses fcntl.flock on Unix-like systems. Also provides an in-process
+# threading.Lock fallback for environments without fcntl.
+_file_locks = {}
+_file_locks_lock = threading.Lock()
+
+
+def get_lock_for_path(path):
+    """Return a threading.Lock object for the given path (process-local).
+    This is used as a fallback for platforms without fcntl, and to
+    serialize atomic replace operations within the same process.
+    """
+    with _file_locks_lock:
+        lock = _file_locks.get(path)
+        if lock is None:
+            lock = threading.Lock()
+            _file_locks[path] = lock
+        return lock
+
+
+@contextmanager
+def exclusive_lock(path):
+    """Hold an exclusive lock on `path` across threads and processes.
+
+    Locks ``<path>.lock`` (created on demand) with fcntl.flock when
+    available, on top of the process-local lock for that file, so a
+    read-modify-write of `path` is not interleaved with another one.
+    """
+    lock_path = f"{path}.lock"
+    with get_lock_for_path(lock_path):
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(lock_path)), exist_ok=True)
+        with open(lock_path, 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def atomic_write_json(path, data):
+    """Atomically write JSON-serializable `data` to `path`.
+
+    Implementation details:
+    - Write to a temporary file in the same directory
+    - fsync the file and directory to ensure durability
+    - os.replace to atomically move into place
+    - Use an in-process lock to avoid races within the same process
+      and also use POSIX fcntl locks when available to coordinate
+      between processes on the same host.
+    """
+    dirpath = os.path.dirname(os.path.abspath(path)) or '.'
+    basename = os.path.basename(path)
+    tmp = None
+    lock = get_lock_for_path(path)
+    with lock:
+        # create temp file in same directory
+        fd, tmp = tempfile.mkstemp(prefix=basename, dir=dirpath)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                # If fcntl available, acquire exclusive lock on temp file
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                except Exception:
+                    pass
+                json.dump(data, f, ensure_ascii=False, indent=2)
+                f.flush()
+                try:
+                    os.fsync(f.fileno())
+                except Exception:
+                    pass
+
+            # ensure directory entry is flushed
+            try:
+                dirfd = os.open(dirpath, os.O_DIRECTORY)
+                try:
+                    os.fsync(dirfd)
+                finally:
+                    os.close(dirfd)
+            except Exception:
+                pass
+
+            # atomic replace
+            os.replace(tmp, path)
+            tmp = None
+        finally:
+            if tmp and os.path.exists(tmp):
+                try:
+                    os.remove(tmp)
+                except Exception:
+                    pass
+
+
+def read_json_file(path):
+    """Read JSON from path safely; returns parsed JSON or None if file missing/invalid."""
+    if not os.path.exists(path):
+        return None
+
+    lock = get_lock_for_path(path)
+    with lock:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                try:
+                    # Try to acquire shared lock where available
+                    fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+                except Exception:
+                    pass
+                data = json.load(f)
+                return data
+        except Exception:
+            return None
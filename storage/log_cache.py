@@ -0,0 +1,183 @@
+"""Two-tier (memory LRU + bounded disk) cache for parsed daily log files.
+
+Entries are keyed by ``(date, version)`` where ``version`` identifies the
+exact GCS object generation(s) the records were read from, so a cached day
+is only ever served for the content it was built from. Past days never
+change, so callers may also ask for the newest cached version of a date
+without revalidating it (:meth:`TieredLogCache.get_latest`).
+
+Disk entries live in ``<disk_dir>/<date>_<version>.json`` and are evicted
+least-recently-used once the directory exceeds ``disk_max_bytes``.
+"""
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+Records = List[Dict[str, Any]]
+
+
+class TieredLogCache:
+    """Memory LRU in front of a size-bounded disk cache.
+
+    Returned lists are fresh shallow copies; the record dicts are shared
+    and must be treated as read-only.
+
+    Args:
+        memory_items: number of days kept parsed in memory (0 disables the tier)
+        disk_dir: directory of the disk tier (None disables it)
+        disk_max_bytes: size bound of the disk tier
+    """
+
+    def __init__(self, memory_items: int = 32, disk_dir: Optional[str] = None,
+                 disk_max_bytes: int = 512 * 1024 * 1024):
+        self.memory_items = max(0, int(memory_items))
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[Tuple[str, str], Records]" = OrderedDict()
+        self._latest: Dict[str, str] = {}
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'disk_evictions': 0}
+        if disk_dir:
+            try:
+                os.makedirs(disk_dir, exist_ok=True)
+            except OSError as e:
+                print(f"[LOG_CACHE] disk tier disabled: {e}")
+                self.disk_dir = None
+
+    # ------------------------------------------------------------------
+    # disk tier
+    # ------------------------------------------------------------------
+    def _disk_path(self, date: str, version: str) -> str:
+        return os.path.join(self.disk_dir, f"{date}_{version}.json")
+
+    def _disk_entries(self):
+        """[(path, size, mtime)] of every disk entry."""
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.disk_dir, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    def _disk_read(self, date: str, version: str) -> Optional[Records]:
+        path = self._disk_path(date, version)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                records = json.load(f)
+            os.utime(path)  # LRU: mark as recently used
+            return records if isinstance(records, list) else None
+        except (OSError, ValueError):
+            return None
+
+    def _disk_latest_version(self, date: str) -> Optional[str]:
+        prefix = f"{date}_"
+        best = None
+        for path, _, mtime in self._disk_entries():
+            name = os.path.basename(path)
+            if name.startswith(prefix) and (best is None or mtime > best[1]):
+                best = (name[len(prefix):-5], mtime)
+        return best[0] if best else None
+
+    def _disk_write(self, date: str, version: str, records: Records) -> None:
+        fd, tmp = tempfile.mkstemp(prefix='.tmp_', suffix='.json', dir=self.disk_dir)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(records, f, ensure_ascii=False)
+            os.replace(tmp, self._disk_path(date, version))
+            tmp = None
+        finally:
+            if tmp and os.path.exists(tmp):
+                os.remove(tmp)
+
+        # drop older versions of the same day, then enforce the size bound
+        entries = self._disk_entries()
+        keep = self._disk_path(date, version)
+        for path, _, _ in entries:
+            if os.path.basename(path).startswith(f"{date}_") and path != keep:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        entries = self._disk_entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in sorted(entries, key=lambda e: e[2]):
+            if total <= self.disk_max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+                self._stats['disk_evictions'] += 1
+            except FileNotFoundError:
+                pass
+
+    # ------------------------------------------------------------------
+    # memory tier
+    # ------------------------------------------------------------------
+    def _memory_put(self, date: str, version: str, records: Records) -> None:
+        old = self._latest.get(date)
+        self._latest[date] = version
+        if old is not None and old != version:
+            self._memory.pop((date, old), None)
+        if self.memory_items == 0:
+            return
+        self._memory[(date, version)] = records
+        self._memory.move_to_end((date, version))
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    # ------------------------------------------------------------------
+    # public API
+    # ------------------------------------------------------------------
+    def get(self, date: str, version: str) -> Optional[Records]:
+        with self._lock:
+            records = self._memory.get((date, version))
+            if records is not None:
+                self._memory.move_to_end((date, version))
+                self._stats['memory_hits'] += 1
+                return list(records)
+        if self.disk_dir:
+            records = self._disk_read(date, version)
+            if records is not None:
+                with self._lock:
+                    self._stats['disk_hits'] += 1
+                    self._memory_put(date, version, records)
+                return list(records)
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def get_latest(self, date: str) -> Optional[Records]:
+        """Newest cached version of `date` without revalidation (for immutable days)."""
+        with self._lock:
+            version = self._latest.get(date)
+        if version is None and self.disk_dir:
+            version = self._disk_latest_version(date)
+        if version is None:
+            return None
+        return self.get(date, version)
+
+    def put(self, date: str, version: str, records: Records) -> None:
+        records = list(records)
+        with self._lock:
+            self._memory_put(date, version, records)
+        if self.disk_dir:
+            try:
+                self._disk_write(date, version, records)
+            except OSError as e:
+                print(f"[LOG_CACHE] disk write failed for {date}: {e}")
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_entries'] = len(self._memory)
+        return stats
@@ -0,0 +1,459 @@
+"""Approximate nearest-neighbour index over student message embeddings.
+
+An IVF (inverted file) index: every vector belongs to the list of its
+nearest centroid, and a query scores only the vectors in the ``nprobe``
+lists whose centroids are closest to it. Vectors are L2-normalized and
+quantized to int8 with one float32 scale per row (a quarter of the float32
+size), so a score is ``(row @ query) * scale``::
+
+    <directory>/vectors.i8     int8 rows, appended only
+    <directory>/scales.f32     one float32 scale per row
+    <directory>/index.db       SQLite (WAL): message metadata and list of each
+                               row, centroids, row count and a generation
+
+Messages are added incrementally. Appends run inside an IMMEDIATE
+transaction like :mod:`storage.embedding_cache`, so writers in different
+processes never hand out the same rows. Until ``min_train`` vectors exist
+all rows live in one list and queries are exact; after that the centroids
+are retrained on a sample whenever the index has grown ``retrain_factor``
+times since the last training, and every row is reassigned. Training runs
+outside the write lock; only the reassignment of the rows is written in one
+transaction, which also bumps the generation.
+
+Dates whose messages could not be indexed (embedding failures, messages
+dropped before they were embedded) are recorded in a ``backfill`` table so
+the caller can re-index those dates later; re-adding is idempotent because
+every message has a unique key.
+
+Each process keeps the list, unit and stage of every row in NumPy arrays
+(a few bytes per row), loads only the rows added since its last query, and
+reloads everything when the generation changes.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence
+
+import numpy as np
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    dim INTEGER NOT NULL,
+    rows INTEGER NOT NULL,
+    trained_rows INTEGER NOT NULL,
+    generation INTEGER NOT NULL,
+    centroids BLOB
+);
+CREATE TABLE IF NOT EXISTS entries (
+    row INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    list INTEGER NOT NULL,
+    unit TEXT,
+    stage TEXT,
+    date TEXT,
+    timestamp TEXT,
+    student_number TEXT,
+    class_num INTEGER,
+    seat_num INTEGER,
+    class_display TEXT,
+    message TEXT
+);
+CREATE TABLE IF NOT EXISTS backfill (
+    date TEXT PRIMARY KEY,
+    marks INTEGER NOT NULL
+);
+"""
+
+# metadata returned with every search result (and stored per row)
+ENTRY_FIELDS = ('unit', 'stage', 'date', 'timestamp', 'student_number',
+                'class_num', 'seat_num', 'class_display', 'message')
+
+_LOOKUP_BATCH = 500
+_ASSIGN_CHUNK = 8192
+
+
+def message_key(timestamp: str, student_number, stage: str, message: str) -> str:
+    """Identity of one message (the same log record always gets the same key)."""
+    payload = json.dumps([timestamp, str(student_number), stage, message], ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def _normalized(vectors) -> np.ndarray:
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def _quantize(matrix: np.ndarray):
+    """Symmetric per-row int8 quantization: ``row ~= codes * scale``."""
+    scales = np.maximum(np.abs(matrix).max(axis=1), 1e-12) / 127.0
+    codes = np.rint(matrix / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def _spherical_kmeans(X: np.ndarray, k: int, iterations: int, rng) -> np.ndarray:
+    """Unit-norm centroids of the rows of `X` (which are unit-norm)."""
+    centroids = X[rng.choice(len(X), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = np.argmax(X @ centroids.T, axis=1)
+        order = np.argsort(labels, kind='stable')
+        sorted_labels = labels[order]
+        present, starts = np.unique(sorted_labels, return_index=True)
+        sums = np.add.reduceat(X[order], starts, axis=0)
+        # a list that lost all its rows keeps its previous centroid
+        centroids[present] = _normalized(sums)
+    return centroids
+
+
+class SimilarityIndex:
+    """IVF index of int8-quantized message embeddings in `directory`.
+
+    Args:
+        directory: where the row files and the catalog are kept
+        min_train: number of vectors before the first training (exact search until then)
+        retrain_factor: retrain when the index has grown this many times since the last training
+        max_lists: upper bound on the number of lists (``sqrt(rows)`` otherwise)
+        nprobe: lists scanned per query by default
+    """
+
+    def __init__(self, directory: str, min_train: int = 2048, retrain_factor: int = 2,
+                 max_lists: int = 1024, nprobe: int = 8, timeout: float = 30.0):
+        self.directory = os.path.abspath(directory)
+        self.min_train = max(2, int(min_train))
+        self.retrain_factor = max(2, int(retrain_factor))
+        self.max_lists = max(1, int(max_lists))
+        self.nprobe = max(1, int(nprobe))
+        self.timeout = timeout
+        self.vectors_path = os.path.join(self.directory, 'vectors.i8')
+        self.scales_path = os.path.join(self.directory, 'scales.f32')
+        self.index_path = os.path.join(self.directory, 'index.db')
+        self._local = threading.local()
+        self._state_lock = threading.Lock()
+        self._train_lock = threading.Lock()
+        self._reset_state(None)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # the directory is created on first use, not when the store is constructed
+            os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(self.index_path, timeout=self.timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    # ------------------------------------------------------------------
+    # row files
+    # ------------------------------------------------------------------
+    def _file_rows(self, dim: int) -> int:
+        try:
+            return min(os.path.getsize(self.vectors_path) // dim, os.path.getsize(self.scales_path) // 4)
+        except FileNotFoundError:
+            return 0
+
+    def _open_rows(self, rows: int, dim: int):
+        """(int8 codes, scales) memory maps of the row files, which must hold `rows` rows."""
+        count = self._file_rows(dim)
+        if count < rows:
+            raise RuntimeError(f"similarity index row files hold {count} of {rows} rows")
+        return (np.memmap(self.vectors_path, dtype=np.int8, mode='r', shape=(count, dim)),
+                np.memmap(self.scales_path, dtype=np.float32, mode='r', shape=(count,)))
+
+    def _rows_view(self, rows: int, dim: int):
+        """Cached :meth:`_open_rows`, remapped after other processes appended."""
+        if self._view is None or self._view[0].shape[0] < rows or self._view[0].shape[1] != dim:
+            self._view = self._open_rows(rows, dim)
+        return self._view
+
+    @staticmethod
+    def _dequantized(view, rows: np.ndarray) -> np.ndarray:
+        codes, scales = view
+        return codes[rows].astype(np.float32) * scales[rows, None]
+
+    @staticmethod
+    def _write_rows(path: str, data: bytes, offset: int):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.pwrite(fd, data, offset)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    # ------------------------------------------------------------------
+    # per-process state
+    # ------------------------------------------------------------------
+    def _reset_state(self, generation):
+        self._generation = generation
+        self._loaded = 0
+        self._centroids = None
+        self._lists = np.zeros(0, dtype=np.int32)
+        self._units = np.zeros(0, dtype=np.int32)
+        self._stages = np.zeros(0, dtype=np.int32)
+        self._codes_of = {'unit': {}, 'stage': {}}
+        self._view = None
+
+    def _code(self, field: str, value) -> int:
+        codes = self._codes_of[field]
+        return codes.setdefault(value, len(codes))
+
+    def _refresh(self, conn: sqlite3.Connection):
+        """Load rows added by any process since the last call; returns (dim, rows)."""
+        conn.execute('BEGIN')
+        try:
+            meta = conn.execute(
+                "SELECT dim, rows, generation, centroids FROM meta WHERE id = 0"
+            ).fetchone()
+            if meta is None:
+                return None, 0
+            dim, rows, generation, centroids = meta
+            if generation != self._generation or rows < self._loaded:
+                self._reset_state(generation)
+                if centroids is not None:
+                    self._centroids = np.frombuffer(centroids, dtype=np.float32).reshape(-1, dim)
+            if self._loaded < rows:
+                fetched = conn.execute(
+                    "SELECT list, unit, stage FROM entries WHERE row >= ? AND row < ? ORDER BY row",
+                    (self._loaded, rows),
+                ).fetchall()
+                code = self._code
+                self._lists = np.concatenate([self._lists, np.fromiter(
+                    (lst for lst, _, _ in fetched), dtype=np.int32, count=len(fetched))])
+                self._units = np.concatenate([self._units, np.fromiter(
+                    (code('unit', unit) for _, unit, _ in fetched), dtype=np.int32, count=len(fetched))])
+                self._stages = np.concatenate([self._stages, np.fromiter(
+                    (code('stage', stage) for _, _, stage in fetched), dtype=np.int32, count=len(fetched))])
+                self._loaded = rows
+            return dim, rows
+        finally:
+            conn.execute('COMMIT')
+
+    # ------------------------------------------------------------------
+    # writes
+    # ------------------------------------------------------------------
+    def add(self, entries: Sequence[Mapping], embeddings: Sequence[Optional[Sequence[float]]]) -> int:
+        """Index the messages that are not indexed yet; returns the number added.
+
+        Each entry carries its ``key`` (see :func:`message_key`) and the
+        :data:`ENTRY_FIELDS`. Entries whose embedding is None or has another
+        dimension than the index are skipped.
+        """
+        items = {}
+        for entry, embedding in zip(entries, embeddings):
+            if embedding is not None and len(embedding):
+                items.setdefault(entry['key'], (entry, embedding))
+        if not items:
+            return 0
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            meta = conn.execute(
+                "SELECT dim, rows, trained_rows, centroids FROM meta WHERE id = 0"
+            ).fetchone()
+            if meta is None or meta[1] == 0:
+                dim, count, trained_rows, centroids = len(next(iter(items.values()))[1]), 0, 0, None
+            else:
+                dim, count, trained_rows, centroids = meta
+            if count and self._file_rows(dim) < count:
+                # the row files were removed or truncated: start over
+                conn.execute("DELETE FROM entries")
+                conn.execute("UPDATE meta SET generation = generation + 1 WHERE id = 0")
+                count, trained_rows, centroids = 0, 0, None
+            existing = set()
+            keys = list(items)
+            for i in range(0, len(keys), _LOOKUP_BATCH):
+                batch = keys[i:i + _LOOKUP_BATCH]
+                existing.update(key for (key,) in conn.execute(
+                    f"SELECT key FROM entries WHERE key IN ({','.join('?' * len(batch))})", batch
+                ))
+            new = [(key, entry, embedding) for key, (entry, embedding) in items.items()
+                   if key not in existing and len(embedding) == dim]
+            if new:
+                matrix = _normalized([embedding for _, _, embedding in new])
+                if centroids is None:
+                    lists = np.zeros(len(new), dtype=np.int64)
+                else:
+                    lists = np.argmax(matrix @ np.frombuffer(centroids, dtype=np.float32).reshape(-1, dim).T, axis=1)
+                codes, scales = _quantize(matrix)
+                self._write_rows(self.vectors_path, codes.tobytes(), count * dim)
+                self._write_rows(self.scales_path, scales.tobytes(), count * 4)
+                conn.executemany(
+                    f"INSERT INTO entries (row, key, list, {', '.join(ENTRY_FIELDS)}) "
+                    f"VALUES (?, ?, ?{', ?' * len(ENTRY_FIELDS)})",
+                    [(count + i, key, int(lists[i]), *(entry.get(field) for field in ENTRY_FIELDS))
+                     for i, (key, entry, _) in enumerate(new)],
+                )
+                count += len(new)
+                conn.execute(
+                    "INSERT INTO meta (id, dim, rows, trained_rows, generation) VALUES (0, ?, ?, 0, 0) "
+                    "ON CONFLICT(id) DO UPDATE SET dim=excluded.dim, rows=excluded.rows, "
+                    "trained_rows=CASE WHEN ? THEN trained_rows ELSE 0 END, "
+                    "centroids=CASE WHEN ? THEN centroids ELSE NULL END",
+                    (dim, count, centroids is not None, centroids is not None),
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if new and count >= self.min_train and count >= self.retrain_factor * trained_rows:
+            self.train()
+        return len(new)
+
+    def train(self, iterations: int = 10, sample_per_list: int = 32, seed: int = 0) -> bool:
+        """Retrain the centroids on a sample and reassign every row to its nearest list.
+
+        Returns False when there was nothing to train or another writer
+        changed the index structure meanwhile (its training then wins).
+        """
+        if not self._train_lock.acquire(blocking=False):
+            return False
+        try:
+            conn = self._conn()
+            meta = conn.execute("SELECT dim, rows, generation FROM meta WHERE id = 0").fetchone()
+            if meta is None or meta[1] < 2:
+                return False
+            dim, rows, generation = meta
+            nlist = int(min(self.max_lists, max(1, np.sqrt(rows)), rows))
+            view = self._open_rows(rows, dim)
+            rng = np.random.default_rng(seed)
+            sample = np.sort(rng.choice(rows, min(rows, nlist * sample_per_list), replace=False))
+            centroids = _spherical_kmeans(_normalized(self._dequantized(view, sample)), nlist, iterations, rng)
+            lists = np.concatenate([
+                np.argmax(self._dequantized(view, np.arange(start, min(start + _ASSIGN_CHUNK, rows))) @ centroids.T,
+                          axis=1)
+                for start in range(0, rows, _ASSIGN_CHUNK)
+            ])
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                current = conn.execute("SELECT dim, rows, generation FROM meta WHERE id = 0").fetchone()
+                if current is None or current[0] != dim or current[2] != generation or current[1] < rows:
+                    conn.execute('ROLLBACK')
+                    return False
+                if current[1] > rows:
+                    # rows appended while training
+                    extra = self._dequantized(self._open_rows(current[1], dim), np.arange(rows, current[1]))
+                    lists = np.concatenate([lists, np.argmax(extra @ centroids.T, axis=1)])
+                conn.executemany("UPDATE entries SET list = ? WHERE row = ?",
+                                 ((int(lst), row) for row, lst in enumerate(lists)))
+                conn.execute(
+                    "UPDATE meta SET trained_rows = ?, generation = ?, centroids = ? WHERE id = 0",
+                    (current[1], generation + 1, centroids.astype(np.float32).tobytes()),
+                )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            return True
+        finally:
+            self._train_lock.release()
+
+    def clear(self):
+        """Drop every indexed message (the next add starts a new index)."""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute("DELETE FROM entries")
+            conn.execute("DELETE FROM backfill")
+            conn.execute(
+                "UPDATE meta SET rows = 0, trained_rows = 0, generation = generation + 1, "
+                "centroids = NULL WHERE id = 0"
+            )
+            # unlink rather than truncate: other processes may still have the old files mapped
+            for path in (self.vectors_path, self.scales_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    # ------------------------------------------------------------------
+    # backfill
+    # ------------------------------------------------------------------
+    def mark_backfill(self, dates: Iterable[str]):
+        """Record that some messages of `dates` are missing from the index."""
+        self._conn().executemany(
+            "INSERT INTO backfill (date, marks) VALUES (?, 1) "
+            "ON CONFLICT(date) DO UPDATE SET marks = marks + 1",
+            [(date,) for date in set(dates) if date],
+        )
+
+    def backfill_marks(self) -> Dict[str, int]:
+        """Dates waiting for a backfill, with their mark counters."""
+        return dict(self._conn().execute("SELECT date, marks FROM backfill"))
+
+    def clear_backfill(self, date: str, marks: int):
+        """Forget `date` unless it was marked again since `marks` was read."""
+        self._conn().execute("DELETE FROM backfill WHERE date = ? AND marks = ?", (date, marks))
+
+    # ------------------------------------------------------------------
+    # queries
+    # ------------------------------------------------------------------
+    def search(self, embedding: Sequence[float], k: int = 10, nprobe: Optional[int] = None,
+               unit: Optional[str] = None, stage: Optional[str] = None,
+               exclude: Iterable[str] = ()) -> List[dict]:
+        """The `k` indexed messages most similar to `embedding` (cosine, best first).
+
+        Only the `nprobe` nearest lists are scanned; when the `unit` / `stage`
+        filters leave fewer than `k` candidates there, more lists are probed.
+        Messages whose key is in `exclude` are left out.
+        """
+        exclude = set(exclude)
+        conn = self._conn()
+        with self._state_lock:
+            dim, rows = self._refresh(conn)
+            if not rows or len(embedding) != dim:
+                return []
+            query = _normalized(embedding)
+            mask = None
+            for field, value, column in (('unit', unit, self._units), ('stage', stage, self._stages)):
+                if value is None:
+                    continue
+                code = self._codes_of[field].get(value)
+                if code is None:
+                    return []
+                mask = column == code if mask is None else mask & (column == code)
+            wanted = k + len(exclude)
+            if self._centroids is None:
+                candidates = np.arange(rows) if mask is None else np.flatnonzero(mask)
+            else:
+                order = np.argsort(-(self._centroids @ query))
+                probe = min(len(order), nprobe or self.nprobe)
+                while True:
+                    probed = np.zeros(len(order), dtype=bool)
+                    probed[order[:probe]] = True
+                    selected = probed[self._lists] if mask is None else probed[self._lists] & mask
+                    candidates = np.flatnonzero(selected)
+                    if len(candidates) >= wanted or probe >= len(order):
+                        break
+                    probe = min(len(order), probe * 2)
+            if not len(candidates):
+                return []
+            codes, scales = self._rows_view(rows, dim)
+            scores = (codes[candidates].astype(np.float32) @ query) * scales[candidates]
+        if len(candidates) > wanted:
+            top = np.argpartition(-scores, wanted - 1)[:wanted]
+        else:
+            top = np.arange(len(candidates))
+        top = top[np.argsort(-scores[top])]
+        scored = {int(candidates[i]): float(scores[i]) for i in top}
+        fetched = conn.execute(
+            f"SELECT row, key, {', '.join(ENTRY_FIELDS)} FROM entries "
+            f"WHERE row IN ({','.join('?' * len(scored))})", list(scored)
+        ).fetchall()
+        by_row = {row[0]: row for row in fetched}
+        results = []
+        for row, score in scored.items():
+            record = by_row.get(row)
+            if record is None or record[1] in exclude:
+                continue
+            results.append({**dict(zip(ENTRY_FIELDS, record[2:])), 'score': round(min(score, 1.0), 4)})
+            if len(results) == k:
+                break
+        return results
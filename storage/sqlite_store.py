@@ -0,0 +1,261 @@
+"""SQLite (WAL) storage engine for sessions, summaries and learning progress.
+
+Replaces the single-document ``session_storage.json`` /
+``summary_storage.json`` / ``learning_progress.json`` files with keyed
+tables, so a point update is a single-row upsert instead of a full
+parse-and-rewrite. WAL mode lets readers proceed while one writer commits,
+and SQLite's own file locking coordinates every gunicorn worker on the host.
+"""
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Optional
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    key TEXT PRIMARY KEY,
+    student_id TEXT NOT NULL,
+    unit TEXT,
+    stage TEXT,
+    data TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_student ON sessions(student_id);
+
+CREATE TABLE IF NOT EXISTS summaries (
+    key TEXT PRIMARY KEY,
+    student_id TEXT NOT NULL,
+    unit TEXT,
+    stage TEXT,
+    data TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_summaries_student ON summaries(student_id);
+
+CREATE TABLE IF NOT EXISTS progress (
+    student_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS histories (
+    student_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+"""
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _dumps(data: Any) -> str:
+    return json.dumps(data, ensure_ascii=False, sort_keys=True)
+
+
+class SQLiteStore:
+    """Thread-safe keyed store backed by one SQLite database file.
+
+    Each thread gets its own connection; SQLite serializes writers across
+    threads and processes, waiting up to `timeout` seconds for the lock.
+    """
+
+    def __init__(self, path: str, timeout: float = 30.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        dirpath = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirpath, exist_ok=True)
+        conn = self._conn()
+        with conn:
+            conn.executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # NORMAL is durable across application crashes in WAL mode and avoids
+            # an fsync per commit
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
+            self._local.conn = conn
+        return conn
+
+    # ------------------------------------------------------------------
+    # sessions / summaries (same shape: key -> entry dict)
+    # ------------------------------------------------------------------
+    def _put_entry(self, table: str, key: str, entry: Dict[str, Any]) -> None:
+        self._conn().execute(
+            f"INSERT INTO {table} (key, student_id, unit, stage, data, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET student_id=excluded.student_id, unit=excluded.unit, "
+            "stage=excluded.stage, data=excluded.data, updated_at=excluded.updated_at",
+            (key, str(entry.get('student_id', '')), entry.get('unit'), entry.get('stage'),
+             _dumps(entry), _now()),
+        )
+
+    def _get_entry(self, table: str, key: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(f"SELECT data FROM {table} WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _entries_for_student(self, table: str, student_id: str) -> Dict[str, Dict[str, Any]]:
+        rows = self._conn().execute(
+            f"SELECT key, data FROM {table} WHERE student_id = ? ORDER BY key", (str(student_id),)
+        ).fetchall()
+        return {key: json.loads(data) for key, data in rows}
+
+    def put_session(self, key: str, entry: Dict[str, Any]) -> None:
+        self._put_entry('sessions', key, entry)
+
+    def get_session(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._get_entry('sessions', key)
+
+    def sessions_for_student(self, student_id: str) -> Dict[str, Dict[str, Any]]:
+        return self._entries_for_student('sessions', student_id)
+
+    def put_summary(self, key: str, entry: Dict[str, Any]) -> None:
+        self._put_entry('summaries', key, entry)
+
+    def get_summary(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._get_entry('summaries', key)
+
+    def summaries_for_student(self, student_id: str) -> Dict[str, Dict[str, Any]]:
+        return self._entries_for_student('summaries', student_id)
+
+    # ------------------------------------------------------------------
+    # learning progress (student_id -> {unit: {...}})
+    # ------------------------------------------------------------------
+    def get_progress(self, student_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            "SELECT data FROM progress WHERE student_id = ?", (str(student_id),)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def all_progress(self) -> Dict[str, Dict[str, Any]]:
+        rows = self._conn().execute("SELECT student_id, data FROM progress").fetchall()
+        return {student_id: json.loads(data) for student_id, data in rows}
+
+    def put_progress(self, student_id: str, data: Dict[str, Any]) -> None:
+        self.put_progress_many({student_id: data})
+
+    def put_progress_many(self, progress: Dict[str, Dict[str, Any]]) -> None:
+        """Upsert several students in one transaction.
+
+        Rows whose serialized value is unchanged are skipped by the
+        ``WHERE`` clause, so passing the whole progress map only writes the
+        students that actually changed.
+        """
+        if not progress:
+            return
+        now = _now()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                "INSERT INTO progress (student_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(student_id) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at "
+                "WHERE progress.data != excluded.data",
+                [(str(sid), _dumps(obj), now) for sid, obj in progress.items()],
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def delete_progress(self, student_id: str) -> None:
+        self._conn().execute("DELETE FROM progress WHERE student_id = ?", (str(student_id),))
+
+    # ------------------------------------------------------------------
+    # materialized per-student history documents
+    # ------------------------------------------------------------------
+    def get_history(self, student_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            "SELECT data FROM histories WHERE student_id = ?", (str(student_id),)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update_history(self, student_id: str, mutate: Callable[[Optional[Dict[str, Any]]], Optional[Dict[str, Any]]]) -> None:
+        """Read, `mutate` and write one history document in a single IMMEDIATE transaction.
+
+        `mutate` gets the stored document (or None) and returns the document
+        to store, or None to leave it unchanged.
+        """
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                "SELECT data FROM histories WHERE student_id = ?", (str(student_id),)
+            ).fetchone()
+            doc = mutate(json.loads(row[0]) if row else None)
+            if doc is not None:
+                conn.execute(
+                    "INSERT INTO histories (student_id, data, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(student_id) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at",
+                    (str(student_id), _dumps(doc), _now()),
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def put_history(self, student_id: str, doc: Dict[str, Any]) -> None:
+        self._conn().execute(
+            "INSERT INTO histories (student_id, data, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(student_id) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at",
+            (str(student_id), _dumps(doc), _now()),
+        )
+
+    # ------------------------------------------------------------------
+    # migration
+    # ------------------------------------------------------------------
+    def import_legacy_json(self, session_file: Optional[str], summary_file: Optional[str],
+                           progress_file: Optional[str]) -> Dict[str, int]:
+        """Import the legacy JSON documents into empty tables (idempotent).
+
+        A table that already has rows is left untouched, so this is safe to
+        call on every start-up.
+        """
+        counts = {'sessions': 0, 'summaries': 0, 'progress': 0}
+        conn = self._conn()
+
+        def _load(path):
+            if not path or not os.path.exists(path):
+                return None
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                return data if isinstance(data, dict) else None
+            except (OSError, ValueError):
+                return None
+
+        def _empty(table):
+            return conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is None
+
+        for table, path in (('sessions', session_file), ('summaries', summary_file)):
+            if not _empty(table):
+                continue
+            data = _load(path)
+            if not data:
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for key, entry in data.items():
+                    if isinstance(entry, dict):
+                        self._put_entry(table, key, entry)
+                        counts[table] += 1
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+        if _empty('progress'):
+            data = _load(progress_file)
+            if data:
+                self.put_progress_many({k: v for k, v in data.items() if isinstance(v, dict)})
+                counts['progress'] = len(data)
+        return counts
@@ -0,0 +1,74 @@
+"""Materialized per-student history document.
+
+The history views (``/history`` and ``/api/student-history``) used to join
+every summary and session of the student and then scan the learning logs
+for missing conversations on each request. The document below keeps that
+join precomputed and is updated in place whenever a summary or a session
+is written, so a view needs a single storage read::
+
+    {
+      "version": 1,
+      "summaries": {unit: {stage: summary_entry}},
+      "conversations": {unit: {stage: [message, ...]}},
+      "updated_at": "..."
+    }
+
+``conversations`` holds the latest session (or log) conversation of each
+stage; it only shows up in the rendered history when the summary entry
+carries no conversation of its own, as before.
+"""
+import copy
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+HISTORY_DOC_VERSION = 1
+
+HistoryDoc = Dict[str, Any]
+
+
+def new_history_doc() -> HistoryDoc:
+    return {'version': HISTORY_DOC_VERSION, 'summaries': {}, 'conversations': {}}
+
+
+def is_current(doc: Optional[HistoryDoc]) -> bool:
+    """True when `doc` exists and has the current layout (else rebuild it)."""
+    return isinstance(doc, dict) and doc.get('version') == HISTORY_DOC_VERSION
+
+
+def invalidated_doc() -> HistoryDoc:
+    """Placeholder stored when an update could not be applied (the next read rebuilds the document)."""
+    return {'version': None}
+
+
+def apply_summary(doc: HistoryDoc, entry: Dict[str, Any]) -> None:
+    """Record a saved summary entry (replaces the stage's previous summary)."""
+    unit, stage = entry.get('unit'), entry.get('stage')
+    if not unit or not stage:
+        return
+    doc['summaries'].setdefault(unit, {})[stage] = entry
+    _touch(doc)
+
+
+def apply_conversation(doc: HistoryDoc, unit: str, stage: str, conversation: List[Any]) -> None:
+    """Record the latest session conversation of a stage."""
+    if not unit or not stage or not conversation:
+        return
+    doc['conversations'].setdefault(unit, {})[stage] = conversation
+    _touch(doc)
+
+
+def render_history(doc: HistoryDoc) -> Dict[str, Dict[str, Any]]:
+    """``{unit: {stage: entry}}`` as returned by the history views."""
+    history = copy.deepcopy(doc.get('summaries', {}))
+    conversations = doc.get('conversations', {})
+    for unit, stages in history.items():
+        for stage, entry in stages.items():
+            if 'conversation' not in entry:
+                conversation = conversations.get(unit, {}).get(stage)
+                if conversation:
+                    entry['conversation'] = copy.deepcopy(conversation)
+    return history
+
+
+def _touch(doc: HistoryDoc) -> None:
+    doc['updated_at'] = datetime.now(timezone.utc).isoformat()
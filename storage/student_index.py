@@ -0,0 +1,139 @@
+"""Per-student secondary index over the daily learning logs.
+
+Maps ``(class_num, seat_num)`` to the days that contain the student's
+records and, where the storage can address single records (JSONL
+segments), to ``segment:offset`` locators. Per-student views then load
+only those days, or only those records, instead of scanning every day.
+
+Postings are added by the log writer and by :meth:`StudentLogIndex.index_day`,
+which (re)indexes a whole day from its records. Only days recorded in
+``indexed_dates`` are trusted as complete; callers scan any other day.
+The index lives in its own SQLite (WAL) file and can be deleted and
+rebuilt at any time.
+"""
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS postings (
+    class_num INTEGER NOT NULL,
+    seat_num INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    locator TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (class_num, seat_num, date, locator)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_postings_date ON postings(date);
+
+CREATE TABLE IF NOT EXISTS indexed_dates (
+    date TEXT PRIMARY KEY,
+    records INTEGER NOT NULL,
+    indexed_at TEXT NOT NULL
+);
+"""
+
+# (class_num, seat_num, locator)
+Posting = Tuple[int, int, str]
+
+
+def student_key(record) -> Optional[Tuple[int, int]]:
+    """(class_num, seat_num) of a log record, or None when it is not attributable."""
+    class_num = record.get('class_num')
+    seat_num = record.get('seat_num')
+    if class_num is None or seat_num is None:
+        return None
+    try:
+        return int(class_num), int(seat_num)
+    except (TypeError, ValueError):
+        return None
+
+
+class StudentLogIndex:
+    """SQLite-backed posting lists keyed by student."""
+
+    def __init__(self, path: str, timeout: float = 30.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # the file is created on first use, not when the store is constructed
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    # ------------------------------------------------------------------
+    # writes
+    # ------------------------------------------------------------------
+    def add(self, date: str, record, locator: Optional[str] = None) -> None:
+        """Add the posting of one newly written record."""
+        key = student_key(record)
+        if key is None:
+            return
+        self._conn().execute(
+            "INSERT OR IGNORE INTO postings (class_num, seat_num, date, locator) VALUES (?, ?, ?, ?)",
+            (key[0], key[1], date, locator or ''),
+        )
+
+    def index_day(self, date: str, postings: Iterable[Posting], record_count: int) -> None:
+        """Replace every posting of `date` and mark the day as completely indexed."""
+        rows = {(c, s, date, loc or '') for c, s, loc in postings}
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute("DELETE FROM postings WHERE date = ?", (date,))
+            conn.executemany(
+                "INSERT OR IGNORE INTO postings (class_num, seat_num, date, locator) VALUES (?, ?, ?, ?)",
+                sorted(rows),
+            )
+            conn.execute(
+                "INSERT INTO indexed_dates (date, records, indexed_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(date) DO UPDATE SET records=excluded.records, indexed_at=excluded.indexed_at",
+                (date, int(record_count), datetime.now(timezone.utc).isoformat()),
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def clear(self) -> None:
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM postings")
+            conn.execute("DELETE FROM indexed_dates")
+
+    # ------------------------------------------------------------------
+    # reads
+    # ------------------------------------------------------------------
+    def indexed_dates(self) -> List[str]:
+        rows = self._conn().execute("SELECT date FROM indexed_dates ORDER BY date").fetchall()
+        return [r[0] for r in rows]
+
+    def lookup(self, class_num: int, seat_num: int) -> Dict[str, List[str]]:
+        """``{date: [locator, ...]}`` of the student's postings (locator '' = day-level)."""
+        rows = self._conn().execute(
+            "SELECT date, locator FROM postings WHERE class_num = ? AND seat_num = ? ORDER BY date, locator",
+            (int(class_num), int(seat_num)),
+        ).fetchall()
+        result: Dict[str, List[str]] = {}
+        for date, locator in rows:
+            result.setdefault(date, []).append(locator)
+        for locators in result.values():
+            locators.sort(key=_locator_order)
+        return result
+
+
+def _locator_order(locator: str):
+    """Sort ``segment:offset`` locators in write order (numeric offsets)."""
+    segment, _, offset = locator.rpartition(':')
+    return (segment, int(offset)) if offset.isdigit() else (locator, -1)
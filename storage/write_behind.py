@@ -0,0 +1,195 @@
+"""In-process write-behind queue for persistence calls.
+
+Request handlers submit persistence callables (``save_session_to_db``,
+``save_learning_log`` ...) and return immediately; background threads run
+them in batches with retry. The queue is bounded: when it is full the call
+runs synchronously in the caller instead of being dropped, so memory stays
+bounded without losing writes.
+
+Tasks submitted with the same ``coalesce_key`` replace each other while
+still pending (e.g. successive full-conversation session saves), and two
+tasks with the same key never run concurrently, so the last write wins.
+"""
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+
+class _Task:
+    __slots__ = ('fn', 'args', 'kwargs', 'enqueued_at', 'attempts')
+
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+
+class WriteBehindQueue:
+    """Bounded, batching, retrying background executor for persistence calls."""
+
+    def __init__(self, max_items: int = 1000, batch_size: int = 20, workers: int = 2,
+                 max_retries: int = 3, retry_backoff: float = 0.5, name: str = 'write-behind'):
+        self.max_items = max(1, int(max_items))
+        self.batch_size = max(1, int(batch_size))
+        self.max_retries = max(0, int(max_retries))
+        self.retry_backoff = retry_backoff
+        self.name = name
+
+        self._pending: "OrderedDict[Any, _Task]" = OrderedDict()
+        self._inflight = set()
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._closed = False
+
+        self._stats = {
+            'enqueued': 0,
+            'coalesced': 0,
+            'completed': 0,
+            'failed': 0,
+            'retried': 0,
+            'sync_fallbacks': 0,
+            'batches': 0,
+            'max_depth': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0,
+            'last_queue_wait_ms': 0.0,
+        }
+
+        self._threads = []
+        for i in range(max(1, int(workers))):
+            t = threading.Thread(target=self._worker, name=f"{name}-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    # ------------------------------------------------------------------
+    # producer side
+    # ------------------------------------------------------------------
+    def submit(self, fn: Callable, *args, coalesce_key: Optional[str] = None, **kwargs) -> bool:
+        """Queue ``fn(*args, **kwargs)``.
+
+        Returns True when the call was queued (or coalesced into a pending
+        one) and False when it had to run synchronously because the queue
+        was full or already shut down.
+        """
+        task = _Task(fn, args, kwargs)
+        with self._cond:
+            if not self._closed:
+                if coalesce_key is not None and coalesce_key in self._pending:
+                    # keep the original position/enqueue time, replace the payload
+                    task.enqueued_at = self._pending[coalesce_key].enqueued_at
+                    self._pending[coalesce_key] = task
+                    self._stats['coalesced'] += 1
+                    return True
+                if len(self._pending) < self.max_items:
+                    key = coalesce_key if coalesce_key is not None else ('_seq', next(self._seq))
+                    self._pending[key] = task
+                    self._stats['enqueued'] += 1
+                    self._stats['max_depth'] = max(self._stats['max_depth'], len(self._pending))
+                    self._cond.notify()
+                    return True
+            self._stats['sync_fallbacks'] += 1
+
+        # backpressure: run in the caller rather than dropping the write
+        self._run(task)
+        return False
+
+    # ------------------------------------------------------------------
+    # consumer side
+    # ------------------------------------------------------------------
+    def _take_batch(self):
+        batch = []
+        for key in list(self._pending.keys()):
+            if key in self._inflight:
+                continue
+            batch.append((key, self._pending.pop(key)))
+            self._inflight.add(key)
+            if len(batch) >= self.batch_size:
+                break
+        return batch
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                batch = self._take_batch()
+                while not batch:
+                    if self._closed and not self._pending:
+                        return
+                    self._cond.wait(timeout=1.0)
+                    batch = self._take_batch()
+
+            started = time.monotonic()
+            wait_ms = (started - batch[0][1].enqueued_at) * 1000
+            for key, task in batch:
+                self._run(task)
+                with self._cond:
+                    self._inflight.discard(key)
+                    self._cond.notify_all()
+            elapsed_ms = (time.monotonic() - started) * 1000
+
+            with self._cond:
+                self._stats['batches'] += 1
+                self._stats['last_flush_ms'] = elapsed_ms
+                self._stats['total_flush_ms'] += elapsed_ms
+                self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'], elapsed_ms)
+                self._stats['last_queue_wait_ms'] = wait_ms
+                self._cond.notify_all()
+
+    def _run(self, task: _Task) -> None:
+        while True:
+            task.attempts += 1
+            try:
+                task.fn(*task.args, **task.kwargs)
+                with self._cond:
+                    self._stats['completed'] += 1
+                return
+            except Exception as e:
+                if task.attempts > self.max_retries:
+                    print(f"[{self.name.upper()}] giving up on {getattr(task.fn, '__name__', task.fn)} "
+                          f"after {task.attempts} attempts: {type(e).__name__}: {e}")
+                    with self._cond:
+                        self._stats['failed'] += 1
+                    return
+                with self._cond:
+                    self._stats['retried'] += 1
+                time.sleep(self.retry_backoff * (2 ** (task.attempts - 1)))
+
+    # ------------------------------------------------------------------
+    # lifecycle / introspection
+    # ------------------------------------------------------------------
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Block until every queued task has run. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._inflight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(timeout=remaining if remaining is not None else 1.0)
+        return True
+
+    def shutdown(self, timeout: float = 10.0) -> bool:
+        """Stop accepting work and drain the queue (called at interpreter exit)."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        drained = self.flush(timeout)
+        for t in self._threads:
+            t.join(timeout=0.1)
+        if not drained:
+            print(f"[{self.name.upper()}] shutdown timed out with {len(self._pending)} pending writes")
+        return drained
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._cond:
+            stats = dict(self._stats)
+            stats['depth'] = len(self._pending)
+            stats['inflight'] = len(self._inflight)
+            stats['capacity'] = self.max_items
+        batches = stats['batches']
+        stats['avg_flush_ms'] = stats['total_flush_ms'] / batches if batches else 0.0
+        return stats
@@ -4,14 +4,28 @@ OpenAI Embeddings APIを使用した高度なテキスト分析
 理科用語の含有率、科学的語彙の獲得率、テキストクラスタリングを分析する
 """
 import json
-import re
 from collections import Counter, defaultdict
 from datetime import datetime
 from pathlib import Path
 import math
-from typing import List, Dict, Tuple
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
 import os
 
+from tools.keyword_matcher import KeywordMatcher
+from tools.term_segmenter import TermSegmenter
+from tools.text_vectorizer import VECTORIZER_AVAILABLE, tfidf_matrix
+
+# NumPy（任意：無い環境ではクラスタリングを純Pythonで行う）
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    np = None
+    NUMPY_AVAILABLE = False
+
 # OpenAI設定（オプション）
 try:
     from openai import OpenAI
@@ -63,6 +77,12 @@ SCIENCE_TERMS = {
     }
 }
 
+# 単元ごとの理科用語の集合（照合用）
+SCIENCE_TERM_SETS = {
+    unit: frozenset(term for terms in categories.values() for term in terms)
+    for unit, categories in SCIENCE_TERMS.items()
+}
+
 # 生活語彙 → 科学用語のマッピング（小学生向け）
 VOCABULARY_MAPPING = {
     "あつい": ["温度が高い", "温度が上がった"],
@@ -77,34 +97,42 @@ VOCABULARY_MAPPING = {
     "変わった": ["様子が変わる", "変化する"]
 }
 
+# 生活語彙を言い換えた科学的な表現（単元に関係なく理科用語として数える）
+SCIENCE_PHRASES = frozenset(term for terms in VOCABULARY_MAPPING.values() for term in terms)
+
+# 理科用語・生活語彙・科学的な表現を辞書にした単語分割器
+TERM_SEGMENTER = TermSegmenter(
+    [term for categories in SCIENCE_TERMS.values() for terms in categories.values() for term in terms]
+    + list(VOCABULARY_MAPPING)
+    + list(SCIENCE_PHRASES)
+)
+
 def extract_nouns_and_verbs(text):
     """
     テキストから名詞と動詞を抽出
-    簡易版：ひらがな、カタカナ、漢字を分離
+    理科用語・生活語彙の辞書で最長一致、辞書に無い部分は文字種の連続で区切る
     """
-    words = []
-    current_word = ""
-    
-    for char in text:
-        if char in "、。！？ ":
-            if current_word:
-                words.append(current_word)
-                current_word = ""
-        else:
-            current_word += char
-    
-    if current_word:
-        words.append(current_word)
-    
-    return [w for w in words if w and len(w) > 1]
+    return TERM_SEGMENTER.segment(text)
+
+def extract_nouns_and_verbs_batch(texts):
+    """
+    複数テキストをまとめて単語に分割
+    """
+    return TERM_SEGMENTER.segment_many(texts)
+
+def find_science_terms(words, unit):
+    """
+    単語列のうち理科用語（単元の用語と科学的な表現）を出現順に返す
+    """
+    science_terms_in_unit = SCIENCE_TERM_SETS.get(unit, frozenset())
+    return [w for w in words if w in science_terms_in_unit or w in SCIENCE_PHRASES]
 
 def detect_vocabulary_transition(first_half, second_half):
     """
     対話前半と後半の語彙変化を検出
     生活語彙→理科用語への変容を分析
     """
-    first_words = extract_nouns_and_verbs(first_half)
-    second_words = extract_nouns_and_verbs(second_half)
+    first_words, second_words = (set(words) for words in extract_nouns_and_verbs_batch([first_half, second_half]))
     
     transitions = []
     
@@ -131,11 +159,7 @@ def calculate_science_term_ratio(text, unit):
     if not words:
         return 0.0, []
     
-    science_terms_in_unit = []
-    for category, terms in SCIENCE_TERMS[unit].items():
-        science_terms_in_unit.extend(terms)
-    
-    found_terms = [w for w in words if w in science_terms_in_unit]
+    found_terms = find_science_terms(words, unit)
     ratio = len(found_terms) / len(words) * 100 if words else 0.0
     
     return ratio, found_terms
@@ -293,18 +317,21 @@ def generate_text_analysis(predictions_by_unit, reflections_by_unit):
     
     return text_analysis
 
+# 言語パターンとその手がかりになる語（一覧の順が照合の優先順位）
+LINGUISTIC_PATTERNS = {
+    "prediction_expressions": ["思う", "考える", "予想", "だと思う"],
+    "causal_expressions": ["から", "ため", "原因", "理由", "なぜなら"],
+    "comparison_expressions": ["より", "ほうが", "同じ", "違う", "異なる"],
+    "experience_references": ["やった", "した", "経験", "前に", "以前"],
+    "uncertainty_expressions": ["かもしれない", "思う", "ような", "ぐらい", "くらい"]
+}
+LINGUISTIC_MATCHER = KeywordMatcher(LINGUISTIC_PATTERNS)
+
 def extract_linguistic_patterns(text):
     """
-    言語パターンを抽出
+    言語パターンを抽出（パターンごとの重ならない出現数）
     """
-    patterns = {
-        "prediction_expressions": len(re.findall(r"(思う|考える|予想|だと思う)", text)),
-        "causal_expressions": len(re.findall(r"(から|ため|原因|理由|なぜなら)", text)),
-        "comparison_expressions": len(re.findall(r"(より|ほうが|同じ|違う|異なる)", text)),
-        "experience_references": len(re.findall(r"(やった|した|経験|前に|以前)", text)),
-        "uncertainty_expressions": len(re.findall(r"(かもしれない|思う|ような|ぐらい|くらい)", text))
-    }
-    return patterns
+    return LINGUISTIC_MATCHER.leftmost(text)
 
 
 def simple_text_embedding(text: str) -> List[float]:
@@ -332,26 +359,188 @@ def simple_text_embedding(text: str) -> List[float]:
     return vector
 
 
+# 埋め込みAPIの設定
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "256"))        # 1リクエストあたりの入力数
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", "100000"))  # 1リクエストあたりのトークン数（見積もり）
+EMBEDDING_INPUT_TOKENS = 8000                                                 # 1入力あたりの上限（超える分は切り詰める）
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))          # 同時に送るリクエスト数
+EMBEDDING_MAX_RETRIES = 2                                                     # 5xx のときの1リクエストあたりの再送回数
+EMBEDDING_RETRY_BUDGET = int(os.getenv("EMBEDDING_RETRY_BUDGET", "16"))      # 1回の呼び出しでの再送・分割送信の合計上限
+
+# 埋め込みのキャッシュ（モデル＋正規化したテキストのハッシュ → ベクトル。プロセス間で共有）
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "embedding_cache")
+embedding_cache = None
+if NUMPY_AVAILABLE:
+    try:
+        from storage.embedding_cache import EmbeddingCache
+        embedding_cache = EmbeddingCache(EMBEDDING_CACHE_DIR, EMBEDDING_MODEL)
+    except Exception as e:
+        print(f"[WARN] Embedding cache disabled: {e}")
+
+
+def _estimate_tokens(text: str) -> int:
+    """トークン数の控えめな見積もり（UTF-8 2バイトあたり1トークン。日本語は1文字1.5トークン）"""
+    return len(text.encode("utf-8")) // 2 + 1
+
+
+def _truncate_for_embedding(text: str) -> str:
+    data = text.encode("utf-8")
+    if len(data) // 2 + 1 <= EMBEDDING_INPUT_TOKENS:
+        return text
+    return data[:(EMBEDDING_INPUT_TOKENS - 1) * 2].decode("utf-8", "ignore")
+
+
+def _embedding_chunks(texts: List[str]) -> List[List[str]]:
+    """入力数・トークン数の上限を超えないようにテキストをリクエスト単位に分ける"""
+    chunks = []
+    current, tokens = [], 0
+    for text in texts:
+        cost = _estimate_tokens(text)
+        if current and (len(current) >= EMBEDDING_BATCH_SIZE or tokens + cost > EMBEDDING_BATCH_TOKENS):
+            chunks.append(current)
+            current, tokens = [], 0
+        current.append(text)
+        tokens += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _is_input_error(error: Exception) -> bool:
+    """特定の入力が原因のエラー（400 など。分けて送り直せば他の入力は埋め込める）"""
+    return getattr(error, "status_code", None) in (400, 413, 422)
+
+
+def _is_transient_error(error: Exception) -> bool:
+    """少し待てば通る可能性のあるサーバー側のエラー（5xx）"""
+    status = getattr(error, "status_code", None)
+    return isinstance(status, int) and status >= 500
+
+
+class _EmbeddingRun:
+    """1回の embed_texts 呼び出しの追加リクエスト予算（リトライ・分割送信）と中断の状態
+
+    並列に送るリクエストで共有する。認証・レート制限・接続のエラーでは
+    呼び出し全体を中断し、残りのリクエストは送らない。
+    """
+
+    def __init__(self, budget: int):
+        self._budget = budget
+        self._lock = threading.Lock()
+        self.error: Optional[Exception] = None
+
+    def take(self) -> bool:
+        with self._lock:
+            if self.error is not None or self._budget <= 0:
+                return False
+            self._budget -= 1
+            return True
+
+    def abort(self, error: Exception):
+        with self._lock:
+            if self.error is None:
+                self.error = error
+                print(f"[WARN] Embedding API error, giving up: {type(error).__name__}: {error}")
+
+
+def _embed_chunk(chunk: List[str], run: _EmbeddingRun) -> List[Optional[List[float]]]:
+    """1リクエスト分を埋め込む。埋め込めなかった入力は None
+
+    入力が原因のエラーは半分ずつに分けて送り直し、5xx は待って送り直す（どちらも
+    `run` の予算の範囲で）。それ以外のエラーでは呼び出し全体を中断する。
+    """
+    attempt = 0
+    while run.error is None:
+        try:
+            response = client.embeddings.create(input=chunk, model=EMBEDDING_MODEL)
+            embeddings = [None] * len(chunk)
+            for item in response.data:
+                embeddings[item.index] = item.embedding
+            return embeddings
+        except Exception as e:
+            if _is_input_error(e):
+                if len(chunk) > 1 and run.take():
+                    mid = len(chunk) // 2
+                    return _embed_chunk(chunk[:mid], run) + _embed_chunk(chunk[mid:], run)
+                print(f"[WARN] Embedding API rejected {len(chunk)} input(s): {e}")
+                break
+            if _is_transient_error(e) and attempt < EMBEDDING_MAX_RETRIES and run.take():
+                attempt += 1
+                time.sleep(attempt)
+                continue
+            run.abort(e)
+    return [None] * len(chunk)
+
+
+def embed_texts(texts: List[str]) -> List[Optional[List[float]]]:
+    """
+    OpenAI Embeddings APIで複数テキストをまとめて埋め込む
+    キャッシュにあるものはAPIに送らない。残りは同じテキストを1回だけ、
+    リクエスト単位に分けて並列に送り、結果をキャッシュに加える。
+    埋め込めなかったテキスト（API利用不可・失敗・空文字）は None
+    """
+    results: List[Optional[List[float]]] = [None] * len(texts)
+    positions: Dict[str, List[int]] = defaultdict(list)
+    for i, text in enumerate(texts):
+        if text and text.strip():
+            positions[_truncate_for_embedding(text)].append(i)
+    if not positions:
+        return results
+    
+    pending = list(positions)
+    if embedding_cache is not None:
+        try:
+            cached = embedding_cache.get_many(pending)
+        except Exception as e:
+            print(f"[WARN] Embedding cache read failed: {e}")
+            cached = [None] * len(pending)
+        for text, embedding in zip(pending, cached):
+            if embedding is not None:
+                for i in positions[text]:
+                    results[i] = embedding
+        pending = [text for text, embedding in zip(pending, cached) if embedding is None]
+    if not pending or not OPENAI_AVAILABLE or not client:
+        return results
+    
+    chunks = _embedding_chunks(pending)
+    run = _EmbeddingRun(EMBEDDING_RETRY_BUDGET)
+    if len(chunks) == 1:
+        embedded = [_embed_chunk(chunks[0], run)]
+    else:
+        with ThreadPoolExecutor(max_workers=min(EMBEDDING_CONCURRENCY, len(chunks))) as executor:
+            embedded = list(executor.map(lambda chunk: _embed_chunk(chunk, run), chunks))
+    
+    for chunk, embeddings in zip(chunks, embedded):
+        for text, embedding in zip(chunk, embeddings):
+            for i in positions[text]:
+                results[i] = embedding
+        if embedding_cache is not None:
+            try:
+                embedding_cache.put_many(chunk, embeddings)
+            except Exception as e:
+                print(f"[WARN] Embedding cache write failed: {e}")
+    return results
+
+
+def get_text_embeddings(texts: List[str]) -> List[List[float]]:
+    """
+    複数テキストの埋め込みベクトル（text-embedding-3-small、1536次元）
+    埋め込めなかったテキストは簡易実装のベクトルになる
+    """
+    return [
+        embedding if embedding is not None else simple_text_embedding(text)
+        for text, embedding in zip(texts, embed_texts(texts))
+    ]
+
+
 def get_text_embedding(text: str) -> List[float]:
     """
     OpenAI Embeddings APIを使用してテキストを埋め込みベクトルに変換
     text-embedding-3-smallモデルを使用（1536次元）
     APIが利用不可の場合は簡易実装を使用
     """
-    if not OPENAI_AVAILABLE or not client:
-        # フォールバック：簡易実装
-        return simple_text_embedding(text)
-    
-    try:
-        response = client.embeddings.create(
-            input=text,
-            model="text-embedding-3-small"
-        )
-        return response.data[0].embedding
-    except Exception as e:
-        print(f"[WARN] Embedding API error: {e}, using fallback embedding")
-        # フォールバック：簡易実装
-        return simple_text_embedding(text)
+    return get_text_embeddings([text])[0]
 
 
 def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
@@ -376,25 +565,95 @@ def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
     return dot_product / (norm1 * norm2)
 
 
-def simple_kmeans_clustering(texts: List[str], k: int = 3) -> Dict:
+def _embedding_matrix(embeddings: List[List[float]]):
+    """埋め込みのリストを行ごとに L2 正規化した行列にする（次元が違う場合は0で埋める）"""
+    dim = max(len(e) for e in embeddings)
+    if all(len(e) == dim for e in embeddings):
+        X = np.array(embeddings, dtype=np.float32)
+    else:
+        X = np.zeros((len(embeddings), dim), dtype=np.float32)
+        for i, e in enumerate(embeddings):
+            X[i, :len(e)] = e
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    X /= np.where(norms > 0, norms, 1.0)
+    return X
+
+
+def _dense_row(X, i: int):
+    return X[i].toarray().ravel() if hasattr(X, 'toarray') else X[i]
+
+
+def _kmeans_once(X, k: int, rng, max_iter: int, tol: float):
+    """k-means++で初期化して1回だけK-meansを回す。戻り値: (類似度の合計, 中心)"""
+    n, dim = X.shape
+    rows = np.arange(n)
+    
+    # k-means++：既存の中心から遠い点ほど選ばれやすくする（単位ベクトル間の距離² = 2 - 2cos）
+    centers = np.empty((k, dim), dtype=np.float32)
+    centers[0] = _dense_row(X, rng.integers(n))
+    best_sim = np.asarray(X @ centers[0])
+    for c in range(1, k):
+        d2 = np.maximum(2.0 - 2.0 * best_sim, 0.0)
+        total = d2.sum()
+        index = rng.choice(n, p=d2 / total) if total > 0 else rng.integers(n)
+        centers[c] = _dense_row(X, index)
+        best_sim = np.maximum(best_sim, np.asarray(X @ centers[c]))
+    
+    for _ in range(max_iter):
+        # 最もコサイン類似度の高い中心に割り当て（行列積1回）
+        labels = np.argmax(np.asarray(X @ centers.T), axis=1)
+        onehot = np.eye(k, dtype=np.float32)[labels]
+        sums = np.asarray(X.T @ onehot).T
+        counts = np.bincount(labels, minlength=k)
+        new_centers = centers.copy()
+        filled = counts > 0
+        new_centers[filled] = sums[filled] / counts[filled, None]
+        lengths = np.linalg.norm(new_centers, axis=1, keepdims=True)
+        new_centers /= np.where(lengths > 0, lengths, 1.0)
+        # 空のクラスタは、今の中心から最も遠い点で作り直す
+        for c in np.flatnonzero(~filled):
+            sims = np.asarray(X @ new_centers.T)[rows, labels]
+            far = int(np.argmin(sims))
+            new_centers[c] = _dense_row(X, far)
+            labels[far] = c
+        shift = float(np.max(np.linalg.norm(new_centers - centers, axis=1)))
+        centers = new_centers
+        if shift <= tol:
+            break
+    
+    return float(np.asarray(X @ centers.T).max(axis=1).sum()), centers
+
+
+def _kmeans_numpy(X, k: int, n_init: int = 3, max_iter: int = 100, tol: float = 1e-4,
+                  random_state: int = 42) -> Tuple[List[int], List[int]]:
     """
-    OpenAI Embeddingsとコサイン類似度を使用したK-meansクラスタリング
+    行を正規化した行列（NumPy の密行列、または TF-IDF の疎行列）でのK-means
+    （コサイン類似度、k-means++で初期化、n_init 回のうち類似度の合計が最大のもの）
+    戻り値: (各テキストのクラスタ番号, 各クラスタの代表テキストの番号（空のクラスタは -1）)
+    """
+    rng = np.random.default_rng(random_state)
+    _, centers = max((_kmeans_once(X, k, rng, max_iter, tol) for _ in range(n_init)), key=lambda r: r[0])
+    
+    similarities = np.asarray(X @ centers.T)
+    labels = np.argmax(similarities, axis=1)
+    sims = similarities[np.arange(X.shape[0]), labels]
+    representatives = []
+    for c in range(k):
+        members = np.flatnonzero(labels == c)
+        representatives.append(int(members[np.argmax(sims[members])]) if len(members) else -1)
+    return labels.tolist(), representatives
+
+
+def _kmeans_python(embeddings: List[List[float]], k: int) -> Tuple[List[int], List[int]]:
+    """
+    NumPy が無い環境用のK-means（最大10イテレーション）
+    戻り値は _kmeans_numpy と同じ
     """
-    if len(texts) < 2:
-        return {"clusters": [{"texts": texts, "size": len(texts), "representative": texts[0] if texts else ""}], "cluster_count": 1}
-    
-    k = min(k, len(texts))
-    
-    # OpenAI Embeddingsでテキストをベクトル化
-    print(f"[INFO] Embedding {len(texts)} texts using OpenAI API...")
-    embeddings = [get_text_embedding(text) for text in texts]
-    
     # 初期クラスタセンターをランダムに選択
     import random
     center_indices = random.sample(range(len(embeddings)), k)
     centers = [embeddings[i] for i in center_indices]
     
-    # K-meansアルゴリズム（最大10イテレーション）
     clusters = [[] for _ in range(k)]
     prev_centers = None
     
@@ -430,21 +689,59 @@ def simple_kmeans_clustering(texts: List[str], k: int = 3) -> Dict:
         prev_centers = centers
         centers = new_centers
     
-    # クラスタを整理
-    result_clusters = []
-    for cluster_indices in clusters:
+    labels = [0] * len(embeddings)
+    representatives = []
+    for c, cluster_indices in enumerate(clusters):
+        for i in cluster_indices:
+            labels[i] = c
         if cluster_indices:
-            cluster_texts = [texts[i] for i in cluster_indices]
             # 代表テキストはクラスタセンターに最も近いテキスト
-            center_idx = centers[len(result_clusters)] if len(result_clusters) < len(centers) else centers[0]
-            distances = [cosine_similarity(embeddings[i], center_idx) for i in cluster_indices]
-            representative_idx = cluster_indices[distances.index(max(distances))]
-            
-            result_clusters.append({
-                "texts": cluster_texts,
-                "size": len(cluster_texts),
-                "representative": texts[representative_idx] if representative_idx < len(texts) else cluster_texts[0]
-            })
+            distances = [cosine_similarity(embeddings[i], centers[c]) for i in cluster_indices]
+            representatives.append(cluster_indices[distances.index(max(distances))])
+        else:
+            representatives.append(-1)
+    return labels, representatives
+
+
+def simple_kmeans_clustering(texts: List[str], k: int = 3) -> Dict:
+    """
+    OpenAI Embeddingsとコサイン類似度を使用したK-meansクラスタリング
+    NumPy があれば正規化した行列の積でまとめて割り当てる。
+    埋め込めないテキストがある時（API利用不可など）は文字 n-gram の TF-IDF を使う
+    """
+    if len(texts) < 2:
+        return {"clusters": [{"texts": texts, "size": len(texts), "representative": texts[0] if texts else ""}], "cluster_count": 1}
+    
+    k = min(k, len(texts))
+    
+    # OpenAI Embeddingsでテキストをベクトル化
+    print(f"[INFO] Embedding {len(texts)} texts using OpenAI API...")
+    embedded = embed_texts(texts)
+    
+    if NUMPY_AVAILABLE and all(e is not None for e in embedded):
+        labels, representatives = _kmeans_numpy(_embedding_matrix(embedded), k)
+    elif NUMPY_AVAILABLE and VECTORIZER_AVAILABLE:
+        # 埋め込めないテキストがある時は、全テキストを文字 n-gram の TF-IDF でベクトル化する
+        print(f"[INFO] Using local TF-IDF vectors for {len(texts)} texts")
+        labels, representatives = _kmeans_numpy(tfidf_matrix(texts), k)
+    else:
+        embeddings = [e if e is not None else simple_text_embedding(t) for t, e in zip(texts, embedded)]
+        if NUMPY_AVAILABLE:
+            labels, representatives = _kmeans_numpy(_embedding_matrix(embeddings), k)
+        else:
+            labels, representatives = _kmeans_python(embeddings, k)
+    
+    # クラスタを整理（空のクラスタは除く）
+    result_clusters = []
+    for c, representative_idx in enumerate(representatives):
+        if representative_idx < 0:
+            continue
+        cluster_texts = [texts[i] for i, label in enumerate(labels) if label == c]
+        result_clusters.append({
+            "texts": cluster_texts,
+            "size": len(cluster_texts),
+            "representative": texts[representative_idx]
+        })
     
     return {
         "clusters": result_clusters,
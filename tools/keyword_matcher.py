@@ -0,0 +1,94 @@
+"""
+複数キーワード辞書の一括照合
+カテゴリごとのキーワード一覧をまとめて1つの照合器にコンパイルし、
+1回の呼び出しで全カテゴリ（または指定カテゴリ）のヒット数を返す
+"""
+import re
+from collections import defaultdict
+from typing import Dict, Hashable, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+
+class KeywordMatcher:
+    """カテゴリ付きキーワード辞書の照合器
+
+    複数のカテゴリ・辞書に出てくる同じキーワードは1つにまとめ、1テキストにつき
+    1回だけ照合する（部分文字列の検索は C 実装の ``in`` を使う。数十語程度の辞書では
+    Python で書いたオートマトンや正規表現の選択より速い）。重ならない出現数は
+    カテゴリごとにコンパイル済みの選択パターンで数える。
+
+    Args:
+        dictionaries: {カテゴリ: [キーワード, ...]}（一覧内の順番が照合の優先順位）
+    """
+
+    def __init__(self, dictionaries: Mapping[Hashable, Sequence[str]]):
+        self.dictionaries = {category: tuple(keywords) for category, keywords in dictionaries.items()}
+        # キーワード -> そのキーワードを含むカテゴリ（一覧に2回あれば2回）
+        self._owners: Dict[str, List[Hashable]] = defaultdict(list)
+        for category, keywords in self.dictionaries.items():
+            for keyword in keywords:
+                if keyword:
+                    self._owners[keyword].append(category)
+        self._alternations = {
+            category: re.compile('(' + '|'.join(map(re.escape, keywords)) + ')')
+            for category, keywords in self.dictionaries.items() if keywords
+        }
+        self._tables: Dict[Optional[Tuple[Hashable, ...]], Tuple[Tuple[str, Tuple[Hashable, ...]], ...]] = {}
+
+    def _table(self, categories: Optional[Tuple[Hashable, ...]]):
+        """照合するキーワードと、それぞれが数えられるカテゴリの一覧（カテゴリの組ごとに作って使い回す）"""
+        table = self._tables.get(categories)
+        if table is None:
+            wanted = set(self.dictionaries if categories is None else categories)
+            table = tuple(
+                (keyword, tuple(c for c in owners if c in wanted))
+                for keyword, owners in self._owners.items()
+                if any(c in wanted for c in owners)
+            )
+            self._tables[categories] = table
+        return table
+
+    def present(self, text: str, categories: Optional[Iterable[Hashable]] = None) -> Dict[Hashable, int]:
+        """カテゴリごとに、テキストに含まれるキーワードの種類数
+
+        カテゴリごとに ``sum(1 for k in keywords if k in text)`` を数えたのと同じ。
+        `categories` を指定するとそのカテゴリだけを数える
+        """
+        categories = tuple(self.dictionaries if categories is None else categories)
+        counts = dict.fromkeys(categories, 0)
+        if not text:
+            return counts
+        for keyword, owners in self._table(categories):
+            if keyword in text:
+                for category in owners:
+                    counts[category] += 1
+        return counts
+
+    def present_many(self, texts: Iterable[str], categories: Optional[Iterable[Hashable]] = None) -> Dict[Hashable, int]:
+        """:meth:`present` を複数のテキストについて合計したもの"""
+        categories = tuple(self.dictionaries if categories is None else categories)
+        totals = dict.fromkeys(categories, 0)
+        table = self._table(categories)
+        for text in texts:
+            if not text:
+                continue
+            for keyword, owners in table:
+                if keyword in text:
+                    for category in owners:
+                        totals[category] += 1
+        return totals
+
+    def contains(self, text: str, category: Hashable) -> bool:
+        """テキストが `category` のキーワードを1つでも含むか"""
+        return bool(text) and any(keyword in text for keyword in self.dictionaries[category])
+
+    def leftmost(self, text: str, categories: Optional[Iterable[Hashable]] = None) -> Dict[Hashable, int]:
+        """カテゴリごとの重ならない出現数
+
+        ``re.findall('(k1|k2|...)', text)`` の件数と同じ（左から、同じ位置では
+        一覧で先のキーワードを採り、その後ろから続ける）
+        """
+        counts = {}
+        for category in (self.dictionaries if categories is None else categories):
+            alternation = self._alternations.get(category)
+            counts[category] = len(alternation.findall(text)) if alternation and text else 0
+        return counts
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""Rebuild the similar-message search index from scratch.
+
+Reads every available log date through the configured storage backend
+(same environment variables as the app), embeds the students' prediction
+and reflection messages (cached embeddings are reused) and rewrites
+SIMILARITY_INDEX_DIR.
+
+Usage:
+  python tools/rebuild_similarity_index.py             # rebuild everything
+  python tools/rebuild_similarity_index.py --backfill  # only re-index the dates marked for backfill
+
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+if __name__ == '__main__':
+    if app.similarity_index is None:
+        print("Similarity index is not available")
+        sys.exit(1)
+    if '--backfill' in sys.argv[1:]:
+        done = app.backfill_similarity_index()
+        print(f"Backfilled {done} date(s) into {app.SIMILARITY_INDEX_DIR}")
+        sys.exit(0)
+    total = app.rebuild_similarity_index()
+    print(f"Indexed {total} messages into {app.SIMILARITY_INDEX_DIR}")
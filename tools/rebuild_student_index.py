@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+"""Rebuild the per-student learning log index from scratch.
+
+Reads every available log date through the configured storage backend
+(same environment variables as the app) and rewrites
+STUDENT_LOG_INDEX_FILE.
+
+Usage:
+  python tools/rebuild_student_index.py
+
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+if __name__ == '__main__':
+    if app.student_log_index is None:
+        print("Student log index is not available")
+        sys.exit(1)
+    total = app.rebuild_student_log_index()
+    print(f"Indexed {total} log records into {app.STUDENT_LOG_INDEX_FILE}")
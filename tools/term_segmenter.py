@@ -0,0 +1,73 @@
+"""
+辞書による最長一致の単語分割
+理科用語・生活語彙の辞書をトライ木にして、各位置で辞書の最長一致を1語として切り出す。
+辞書に無い部分は文字種（漢字・ひらがな・カタカナ・英数字）の連続で区切る
+"""
+import re
+from typing import Iterable, List
+
+_TERM = None  # トライ木の終端（その位置までで1語）
+
+# 文字種（これ以外の句読点・空白・記号は区切り文字）
+HIRAGANA = 'ぁ-ゟ'
+KATAKANA = '゠-ヿㇰ-ㇿｦ-ﾟ'
+KANJI = '一-鿿㐀-䶿々〆'
+ALNUM = rf'^\W_{HIRAGANA}{KATAKANA}{KANJI}'  # 上記以外の文字・数字（否定の文字クラスとして使う）
+
+
+def _trie_pattern(node) -> str:
+    """トライ木を最長一致の正規表現にする（分岐は次の1文字で決まり、終端の先は貪欲に延ばす）"""
+    branches = [re.escape(char) + _trie_pattern(child) for char, child in node.items() if char is not _TERM]
+    if not branches:
+        return ''
+    body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+    return f'(?:{body})?' if _TERM in node else body
+
+
+class TermSegmenter:
+    """辞書最長一致＋文字種による単語分割
+
+    辞書語は1文字でも1語として返し、文字種による区切りはひらがな1文字
+    （助詞など）だけを除く。辞書語の始まる位置では文字種の区切りを打ち切るので、
+    「水のあたたまり方」は「あたたまり」を含めて分割される。
+
+    トライ木は1つの正規表現（辞書語 | 辞書語の始まりで止まる文字種の連続）に
+    コンパイルし、走査は正規表現エンジンで1回だけ行う。
+
+    Args:
+        terms: 辞書語
+    """
+
+    def __init__(self, terms: Iterable[str]):
+        self.terms = frozenset(term for term in terms if term)
+        trie = {}
+        for term in self.terms:
+            node = trie
+            for char in term:
+                node = node.setdefault(char, {})
+            node[_TERM] = term
+        alternatives = []
+        if trie:
+            dictionary = _trie_pattern(trie)
+            alternatives.append(dictionary)
+            stop = f'(?!{dictionary})'
+        else:
+            stop = ''
+        for chars in (f'[{HIRAGANA}]', f'[{KATAKANA}]', f'[{KANJI}]', f'[{ALNUM}]'):
+            alternatives.append(f'{chars}(?:{stop}{chars})*')
+        self._regex = re.compile('|'.join(alternatives))
+
+    def segment(self, text: str) -> List[str]:
+        """テキストを単語の列に分割"""
+        if not text:
+            return []
+        terms = self.terms
+        return [
+            word for word in self._regex.findall(text)
+            if len(word) > 1 or word in terms or not 'ぁ' <= word <= 'ゟ'
+        ]
+
+    def segment_many(self, texts: Iterable[str]) -> List[List[str]]:
+        """複数テキストをまとめて分割"""
+        segment = self.segment
+        return [segment(text) for text in texts]
@@ -0,0 +1,58 @@
+"""
+APIを使わないテキストのベクトル化
+文字2〜3-gramをハッシュして TF-IDF の疎行列にする（単語分割が要らないので日本語にそのまま使える）。
+コーパスごとに1回 fit し、行は L2 正規化済み（内積がコサイン類似度になる）
+"""
+import unicodedata
+from typing import List
+
+# scikit-learn（任意：無い環境では使えない）
+try:
+    from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+    VECTORIZER_AVAILABLE = True
+except ImportError:
+    HashingVectorizer = TfidfTransformer = None
+    VECTORIZER_AVAILABLE = False
+
+N_FEATURES = 2 ** 18
+NGRAM_RANGE = (2, 3)
+
+
+def _normalize(text: str) -> str:
+    """全角・半角をそろえ、小文字にして空白の連続を1つにする"""
+    return ' '.join(unicodedata.normalize('NFKC', text).lower().split())
+
+
+class CharNgramTfidf:
+    """ハッシュ化した文字 n-gram の TF-IDF
+
+    語彙を持たない（ハッシュで列を決める）ので、学習するのは IDF だけ。
+    """
+
+    def __init__(self, n_features: int = N_FEATURES, ngram_range=NGRAM_RANGE):
+        self._hashing = HashingVectorizer(
+            analyzer='char',
+            ngram_range=ngram_range,
+            n_features=n_features,
+            preprocessor=_normalize,
+            alternate_sign=False,
+            norm=None,
+        )
+        self._tfidf = TfidfTransformer(sublinear_tf=True)
+
+    def fit(self, texts: List[str]) -> 'CharNgramTfidf':
+        self._tfidf.fit(self._hashing.transform(texts))
+        return self
+
+    def transform(self, texts: List[str]):
+        """scipy.sparse の CSR 行列（行はテキスト、L2 正規化済み）"""
+        return self._tfidf.transform(self._hashing.transform(texts))
+
+    def fit_transform(self, texts: List[str]):
+        counts = self._hashing.transform(texts)
+        return self._tfidf.fit(counts).transform(counts)
+
+
+def tfidf_matrix(texts: List[str]):
+    """`texts` で fit した TF-IDF 行列"""
+    return CharNgramTfidf().fit_transform(texts)
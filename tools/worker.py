@@ -2,7 +2,7 @@
 """Simple RQ worker launcher for development.
 
 Run this in the project virtualenv to start a worker that processes
-summary jobs. Requires Redis reachable at REDIS_URL.
+summary and export jobs. Requires Redis reachable at REDIS_URL.
 
 Usage:
   source .venv/bin/activate